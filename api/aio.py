@@ -0,0 +1,826 @@
+import time
+import uuid
+import json
+import asyncio
+import itertools
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from .api import FileSystemAPID
+from .auth import request_token
+from . import ranges, archive, sync
+
+try:
+    import jwt
+    from starlette.applications import Starlette
+    from starlette.exceptions import HTTPException
+    from starlette.responses import JSONResponse, StreamingResponse, Response
+    from starlette.routing import Route
+except ImportError:
+    Starlette = None
+
+
+class AsyncFileSystemAPID(FileSystemAPID):
+    """
+    ASGI variant of FileSystemAPID with the same routes and response envelope.
+
+    Requires starlette (and uvicorn to `run`). Disk work is offloaded to two
+    bounded thread pools: `io` for short calls (stat, list, chunk reads and
+    writes) and `bulk` for long ones (rmtree, disk searches, hashing on
+    commit), so a few slow operations cannot starve list and download.
+    Request bodies and responses are streamed chunk by chunk, no thread is
+    held while waiting on the network.
+    """
+
+    def __init__(self, *args, api_io_workers=8, api_bulk_workers=2, **kwargs):
+        if Starlette is None:
+            raise Exception("starlette is required for the async API")
+        self.api_io_workers = api_io_workers
+        self.api_bulk_workers = api_bulk_workers
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=api_io_workers, thread_name_prefix="api-io"
+        )
+        self.bulk_executor = ThreadPoolExecutor(
+            max_workers=api_bulk_workers, thread_name_prefix="api-bulk"
+        )
+        super().__init__(*args, **kwargs)
+
+    async def _io(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def _bulk(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.bulk_executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def _aiter(self, iterator, batch=1):
+        """Drain a blocking iterator on the io pool."""
+        while True:
+            items = await self._io(list, itertools.islice(iterator, batch))
+            if not items:
+                return
+            for item in items:
+                yield item
+
+    def _uni_response(
+        self, flag: bool, message: str = "", data: any = None, status_code: int = None
+    ):
+        return JSONResponse(
+            {
+                "flag": flag,
+                "message": message,
+                "data": data,
+            },
+            status_code=200 if status_code is None else status_code,
+        )
+
+    def _check_upload_size(self, content_length):
+        try:
+            super()._check_upload_size(content_length)
+        except RequestEntityTooLarge as e:
+            raise HTTPException(413, e.description)
+
+    def _content_length(self, request):
+        length = request.headers.get("content-length", None)
+        return None if length is None else int(length)
+
+    def _error_response(self, e):
+        message = (
+            str(e).replace(f"{self.root_path}/", "").replace(f"{self.root_path}", "")
+        )
+        if isinstance(e, FileNotFoundError):
+            return self._uni_response(False, message, None, 404)
+        elif isinstance(e, PermissionError):
+            return self._uni_response(False, message, None, 403)
+        elif isinstance(e, HTTPException):
+            return self._uni_response(False, e.detail, None, e.status_code)
+        else:
+            return self._uni_response(False, message, None, 500)
+
+    async def _check_auth(self, request):
+        if not self.api_auth:
+            return
+        if request.url.path in self.api_auth_whitelist:
+            return
+        token = request_token(request.headers, request.query_params)
+        if token is None:
+            raise Exception("Invild token")
+        if self.token_cache.get(token) is None:
+            self.token_cache.put(
+                token,
+                jwt.decode(token, self.api_auth_secret_key, algorithms=["HS256"]),
+            )
+
+    def _endpoint(self, func):
+        """Wrap a route with the auth check and the global exception handler."""
+
+        async def endpoint(request):
+            try:
+                await self._check_auth(request)
+                return await func(request)
+            except Exception as e:
+                return self._error_response(e)
+
+        return endpoint
+
+    async def _write_body(self, writer, request):
+        """Feed the request body to a FileWriter/PartWriter and commit it."""
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    await self._io(writer.write, chunk)
+            return await self._bulk(writer.commit)
+        except Exception:
+            await self._io(writer.discard)
+            raise
+
+    def _body_reader(self, request):
+        """Blocking file-like view of the request body for code run on a pool."""
+        loop = asyncio.get_running_loop()
+        chunks = request.stream()
+
+        class BodyReader:
+            def __init__(self):
+                self.buffer = b""
+                self.eof = False
+
+            def read(self, size=-1):
+                while not self.eof and (size < 0 or len(self.buffer) < size):
+                    try:
+                        self.buffer += asyncio.run_coroutine_threadsafe(
+                            chunks.__anext__(), loop
+                        ).result()
+                    except StopAsyncIteration:
+                        self.eof = True
+                if size < 0:
+                    size = len(self.buffer)
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+                return data
+
+        return BodyReader()
+
+    def _init_app(self):
+        routes = []
+
+        def route(path, methods):
+            def decorator(func):
+                routes.append(
+                    Route(
+                        f"/{self.api_name}{path}",
+                        self._endpoint(func),
+                        methods=methods,
+                    )
+                )
+                return func
+
+            return decorator
+
+        if self.api_auth:
+
+            @route("/login", ["POST"])
+            async def login(request):
+                form = await request.form()
+                username = form.get("username", None)
+                password = form.get("password", None)
+                if (
+                    username != self.api_auth_username
+                    or password != self.api_auth_password
+                ):
+                    raise Exception("Username or password incorrect!")
+                now = int(time.time())
+                # same claims as flask_jwt_extended, tokens work on both variants
+                token = jwt.encode(
+                    {
+                        "fresh": False,
+                        "iat": now,
+                        "jti": str(uuid.uuid4()),
+                        "type": "access",
+                        "sub": username,
+                        "nbf": now,
+                        "exp": now + int(self.api_auth_token_expires),
+                    },
+                    self.api_auth_secret_key,
+                    algorithm="HS256",
+                )
+                return self._uni_response(True, "Success", token)
+
+        if self.api_support_delete_file:
+
+            @route("/delete/file", ["POST"])
+            async def delete_file_api(request):
+                path = (await request.form()).get("path", None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                success, msg = await self._io(self.fs.delete_file, path)
+                if success:
+                    return self._uni_response(True, "Success")
+                else:
+                    raise Exception(msg)
+
+        if self.api_support_delete_folder:
+
+            @route("/delete/folder", ["POST"])
+            async def delete_folder_api(request):
+                form = await request.form()
+                path = form.get("path", "")
+                if self.jobs is not None and form.get("async", "0") == "1":
+                    return self._job_response(
+                        await self._io(
+                            self.jobs.submit, "delete_folder", {"path": path}
+                        )
+                    )
+                success, msg = await self._bulk(self.fs.delete_folder, path)
+                if success:
+                    return self._uni_response(True, "Success")
+                else:
+                    raise Exception(msg)
+
+        if self.api_support_create_folder:
+
+            @route("/add/folder", ["POST"])
+            async def create_folder_api(request):
+                path = (await request.form()).get("path", "")
+                success, msg = await self._io(self.fs.create_folder, path)
+                if success:
+                    return self._uni_response(True, "Success")
+                else:
+                    raise Exception(msg)
+
+        if self.api_support_list_path:
+
+            @route("/get/list", ["GET"])
+            async def list_path_api(request):
+                args = request.query_params
+                path = args.get("path", "")
+                limit = args.get("limit", None)
+                limit = None if limit is None else int(limit)
+                cursor = args.get("cursor", None)
+                sort = args.get("sort", None)
+                fields = args.get("fields", None)
+                fields = None if fields is None else fields.split(",")
+                if args.get("format", "json") == "ndjson":
+                    if limit is not None or cursor is not None or sort is not None:
+                        raise Exception("ndjson listing does not support paging")
+                    success, data_or_error = await self._io(
+                        self.fs.iter_path_contents, path, fields
+                    )
+                    if not success:
+                        raise Exception(data_or_error)
+
+                    async def lines():
+                        async for entry in self._aiter(data_or_error, 256):
+                            yield json.dumps(entry, separators=(",", ":")) + "\n"
+
+                    return StreamingResponse(lines(), media_type="application/x-ndjson")
+                if limit is None and cursor is None and sort is None and fields is None:
+                    success, data_or_error = await self._io(
+                        self.fs.list_path_contents, path
+                    )
+                else:
+                    if cursor:
+                        valid, error = self.fs.decode_cursor(cursor, sort or "name")
+                        if not valid:
+                            raise HTTPException(400, error)
+                    success, data_or_error = await self._io(
+                        self.fs.list_path_page,
+                        path,
+                        limit=100 if limit is None else limit,
+                        cursor=cursor,
+                        sort="name" if sort is None else sort,
+                        fields=fields,
+                    )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.api_support_search_file:
+
+            @route("/search/file", ["GET"])
+            async def search_api(request):
+                key = request.query_params.get("key", None)
+                path = request.query_params.get("path", "")
+                mode = request.query_params.get("mode", "glob")
+                if key is None or mode not in ("glob", "substring"):
+                    raise Exception("Request parameter missing")
+                if (
+                    self.jobs is not None
+                    and request.query_params.get("async", "0") == "1"
+                ):
+                    return self._job_response(
+                        await self._io(
+                            self.jobs.submit,
+                            "search",
+                            {"key": key, "path": path, "mode": mode},
+                        )
+                    )
+                # answered from memory when the index is enabled
+                run = self._bulk if self.fs.index is None else self._io
+                success, results_or_error = await run(
+                    self.fs.search, key, path, substring=mode == "substring"
+                )
+                if success:
+                    return self._uni_response(True, "Success", results_or_error)
+                else:
+                    raise Exception(results_or_error)
+
+        if self.api_support_upload_file:
+
+            @route("/upload/file", ["POST"])
+            async def upload_file_api(request):
+                self._check_upload_size(self._content_length(request))
+                async with request.form() as form:
+                    path = form.get("path", "")
+                    file = form.get("file", None)
+                    if file is None or isinstance(file, str):
+                        raise Exception("Request parameter missing")
+                    if not file.filename:
+                        raise Exception("No selected file")
+                    success, data_or_error = await self._bulk(
+                        self.fs.write_stream,
+                        Path(path) / secure_filename(file.filename),
+                        file.file,
+                        max_size=self._upload_max_size(),
+                    )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/upload/stream", ["PUT", "POST"])
+            async def upload_stream_api(request):
+                args = request.query_params
+                filename = args.get("filename", "")
+                if secure_filename(filename) == "":
+                    raise Exception("Request parameter missing")
+                success, writer = await self._io(
+                    self.fs.open_writer,
+                    Path(args.get("path", "")) / secure_filename(filename),
+                    max_size=self._stream_max_size(),
+                    expected_hash=args.get(
+                        "sha256", request.headers.get("X-Content-SHA256", None)
+                    ),
+                    size=self._content_length(request),
+                )
+                if not success:
+                    raise Exception(writer)
+                data = await self._write_body(writer, request)
+                return self._uni_response(True, "Success", data)
+
+            @route("/upload/archive", ["PUT", "POST"])
+            async def upload_archive_api(request):
+                args = request.query_params
+                path = args.get("path", "")
+                self._abs_path(path)
+                success, data_or_error = await self._bulk(
+                    archive.extract_tar,
+                    self.fs,
+                    self._body_reader(request),
+                    path,
+                    mode=args.get("mode", "merge"),
+                    strip=int(args.get("strip", 0)),
+                    max_size=(
+                        self.api_archive_max_size
+                        if self.api_archive_max_size > 0
+                        else None
+                    ),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/upload/session/init", ["POST"])
+            async def upload_session_init_api(request):
+                form = await request.form()
+                filename = form.get("filename", "")
+                size = form.get("size", None)
+                part_size = form.get("part_size", None)
+                if secure_filename(filename) == "" or size is None or part_size is None:
+                    raise Exception("Request parameter missing")
+                success, data_or_error = await self._io(
+                    self.uploads.init,
+                    Path(form.get("path", "")) / secure_filename(filename),
+                    int(size),
+                    int(part_size),
+                    form.get("sha256", None),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/upload/session/part", ["PUT"])
+            async def upload_session_part_api(request):
+                args = request.query_params
+                session_id = args.get("id", None)
+                part = args.get("part", None)
+                if session_id is None or part is None:
+                    raise Exception("Request parameter missing")
+                offset = args.get("offset", None)
+                success, writer = await self._io(
+                    self.uploads.open_part,
+                    session_id,
+                    int(part),
+                    offset=None if offset is None else int(offset),
+                    expected_hash=args.get(
+                        "sha256", request.headers.get("X-Content-SHA256", None)
+                    ),
+                )
+                if not success:
+                    raise Exception(writer)
+                data = await self._write_body(writer, request)
+                return self._uni_response(True, "Success", data)
+
+            @route("/upload/session/status", ["GET"])
+            async def upload_session_status_api(request):
+                success, data_or_error = await self._io(
+                    self.uploads.status, request.query_params.get("id", None)
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/upload/session/commit", ["POST"])
+            async def upload_session_commit_api(request):
+                session_id = (await request.form()).get("id", None)
+                success, data_or_error = await self._bulk(
+                    self.uploads.commit, session_id
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/upload/session/abort", ["POST"])
+            async def upload_session_abort_api(request):
+                session_id = (await request.form()).get("id", None)
+                success, msg = await self._io(self.uploads.abort, session_id)
+                if success:
+                    return self._uni_response(True, "Success")
+                else:
+                    raise Exception(msg)
+
+        if self.api_support_jobs:
+
+            @route("/jobs/submit", ["POST"])
+            async def job_submit_api(request):
+                args = dict((await request.form()).items())
+                op = args.pop("op", None)
+                if op is None:
+                    raise Exception("Request parameter missing")
+                return self._job_response(await self._io(self.jobs.submit, op, args))
+
+            @route("/jobs/status", ["GET"])
+            async def job_status_api(request):
+                return self._job_response(
+                    await self._io(self.jobs.status, request.query_params.get("id"))
+                )
+
+            @route("/jobs/list", ["GET"])
+            async def job_list_api(request):
+                return self._job_response(
+                    await self._io(
+                        self.jobs.list,
+                        request.query_params.get("status", None),
+                        int(request.query_params.get("limit", 100)),
+                    )
+                )
+
+            @route("/jobs/cancel", ["POST"])
+            async def job_cancel_api(request):
+                return self._job_response(
+                    await self._io(self.jobs.cancel, (await request.form()).get("id"))
+                )
+
+        if self.api_support_batch:
+
+            @route("/batch", ["POST"])
+            async def batch_api(request):
+                self._check_upload_size(self._content_length(request))
+                files = {}
+                if request.headers.get("content-type", "").startswith(
+                    "application/json"
+                ):
+                    body = await request.json()
+                else:
+                    form = await request.form()
+                    body = {}
+                    for key, value in form.items():
+                        if isinstance(value, str):
+                            body[key] = value
+                        else:
+                            files[key] = value.file
+                    body["operations"] = json.loads(body.get("operations", "[]"))
+                atomic = str(body.get("atomic", False)).lower() in ("1", "true")
+                success, data_or_error = await self._bulk(
+                    self.batch.run,
+                    body.get("operations", None),
+                    atomic=atomic,
+                    concurrency=int(body.get("concurrency", 1)),
+                    files=files,
+                )
+                if not success:
+                    raise Exception(data_or_error)
+                if data_or_error["succeeded"]:
+                    return self._uni_response(True, "Success", data_or_error)
+                if data_or_error["rolled_back"]:
+                    return self._uni_response(
+                        False, "Batch failed, rolled back", data_or_error, 409
+                    )
+                return self._uni_response(
+                    False, "Batch partially failed", data_or_error
+                )
+
+        if self.api_support_checksum:
+
+            @route("/checksum", ["GET"])
+            async def checksum_api(request):
+                path = request.query_params.get("path", None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                self._abs_path(path)
+                success, data_or_error = await self._bulk(
+                    self.hash_cache.checksum,
+                    path,
+                    request.query_params.get("algo", "sha256"),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.usage is not None:
+
+            @route("/usage", ["GET"])
+            async def usage_api(request):
+                success, data_or_error = await self._io(
+                    self.usage.usage,
+                    request.query_params.get("path", ""),
+                    int(request.query_params.get("depth", 1)),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.cache is not None:
+
+            @route("/cache/status", ["GET"])
+            async def cache_status_api(request):
+                success, data_or_error = self.cache.status()
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/cache/preload", ["POST"])
+            async def cache_preload_api(request):
+                path = (await request.form()).get("path", None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                success, data_or_error = await self._bulk(self.cache.preload, path)
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/cache/evict", ["POST"])
+            async def cache_evict_api(request):
+                path = (await request.form()).get("path", "")
+                success, data_or_error = self.cache.evict(path)
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.profiler is not None:
+
+            @route("/profile/{action}", ["GET", "POST"])
+            async def profile_api(request):
+                action = request.path_params["action"]
+                actions = {
+                    "status": self.profiler.status,
+                    "start": self.profiler.start,
+                    "stop": self.profiler.stop,
+                    "toggle": self.profiler.toggle,
+                }
+                if action not in actions or (request.method == "GET") != (
+                    action == "status"
+                ):
+                    raise Exception("Unsupported profile action {}".format(action))
+                success, data_or_error = await self._io(actions[action])
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.reloader is not None:
+
+            @route("/config/reload", ["POST"])
+            async def config_reload_api(request):
+                success, data_or_error = await self._io(self.reloader.reload)
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.audit is not None:
+
+            @route("/audit/status", ["GET"])
+            async def audit_status_api(request):
+                success, data_or_error = self.audit.status()
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/audit/query", ["GET"])
+            async def audit_query_api(request):
+                since = request.query_params.get("since", None)
+                since = None if since is None else time.time() - float(since)
+                success, data_or_error = await self._bulk(
+                    self.audit.query,
+                    since,
+                    int(request.query_params.get("limit", 10)),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.api_support_sync:
+
+            @route("/sync/manifest", ["GET"])
+            async def sync_manifest_api(request):
+                success, data_or_error = await self._bulk(
+                    sync.build_manifest,
+                    self.fs,
+                    request.query_params.get("path", ""),
+                    self.hash_cache,
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @route("/sync/signature", ["GET"])
+            async def sync_signature_api(request):
+                path = request.query_params.get("path", None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                block_size = request.query_params.get("block_size", None)
+                success, data_or_error = await self._bulk(
+                    sync.file_signature,
+                    self.fs,
+                    path,
+                    None if block_size is None else int(block_size),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            if self.api_support_upload_file:
+
+                @route("/sync/delta", ["PUT"])
+                async def sync_delta_api(request):
+                    args = request.query_params
+                    path = args.get("path", None)
+                    block_size = args.get("block_size", None)
+                    if path is None or block_size is None:
+                        raise Exception("Request parameter missing")
+                    success, data_or_error = await self._bulk(
+                        sync.apply_delta,
+                        self.fs,
+                        path,
+                        self._body_reader(request),
+                        int(block_size),
+                        args.get("sha256", None),
+                        max_size=self._stream_max_size(),
+                    )
+                    if success:
+                        return self._uni_response(True, "Success", data_or_error)
+                    else:
+                        raise Exception(data_or_error)
+
+        if self.api_support_events:
+
+            @route("/events/stream", ["GET"])
+            async def events_stream_api(request):
+                last_id = self.events.parse_id(
+                    request.headers.get(
+                        "Last-Event-ID", request.query_params.get("last_event_id", None)
+                    )
+                )
+                path = request.query_params.get("path", "")
+
+                async def chunks():
+                    current = self.events.last_id if last_id is None else last_id
+                    yield "retry: 3000\n\n"
+                    while True:
+                        events, reset = await self.events.wait_async(
+                            current, path, 15.0
+                        )
+                        if events:
+                            current = int(events[-1]["id"])
+                        elif reset:
+                            current = self.events.first_id
+                        if events or reset:
+                            yield self.events.sse(events, reset)
+                        else:
+                            yield ": keepalive\n\n"
+
+                return StreamingResponse(
+                    chunks(),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
+
+            @route("/events/poll", ["GET"])
+            async def events_poll_api(request):
+                args = request.query_params
+                since = self.events.parse_id(args.get("since", None))
+                if since is None:
+                    events, reset, last_id = [], False, self.events.last_id
+                else:
+                    timeout = min(float(args.get("timeout", 30.0)), 60.0)
+                    events, reset = await self.events.wait_async(
+                        since, args.get("path", ""), timeout
+                    )
+                    last_id = int(events[-1]["id"]) if events else since
+                return self._uni_response(
+                    True,
+                    "Success",
+                    {"events": events, "last_id": str(last_id), "reset": reset},
+                )
+
+        if self.api_support_download_file:
+
+            @route("/download/file", ["GET"])
+            async def download_file_api(request):
+                path = request.query_params.get("path", None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                file_path = self._abs_path(path)
+                status, headers, body = await self._io(
+                    ranges.prepare_download,
+                    str(file_path),
+                    request.headers,
+                    self.fs.read_max_bytes,
+                )
+                if body is None:
+                    return Response(status_code=status, headers=headers)
+                if body == "file":
+                    body = ranges.iter_file_range(
+                        str(file_path),
+                        0,
+                        int(headers["Content-Length"]),
+                        self.fs.read_max_bytes,
+                    )
+                return StreamingResponse(
+                    self._aiter(body), status_code=status, headers=headers
+                )
+
+            @route("/download/archive", ["GET"])
+            async def download_archive_api(request):
+                path = request.query_params.get("path", "")
+                fmt = request.query_params.get("format", "tar")
+                if fmt not in archive.ARCHIVE_FORMATS:
+                    raise Exception(
+                        "Unsupported archive format {}, supported: {}".format(
+                            fmt, list(archive.ARCHIVE_FORMATS)
+                        )
+                    )
+                dir_path = self._abs_path(path)
+                if not await self._io(dir_path.is_dir):
+                    raise FileNotFoundError("Folder {} does not exist".format(path))
+                filename = "{}.{}".format(dir_path.name or self.name, fmt)
+                return StreamingResponse(
+                    self._aiter(
+                        archive.iter_tar(str(dir_path), fmt, self.fs.read_max_bytes),
+                        batch=16,
+                    ),
+                    media_type=archive.ARCHIVE_FORMATS[fmt][0],
+                    headers={
+                        "Content-Disposition": ranges.content_disposition(filename)
+                    },
+                )
+
+        self.app = Starlette(routes=routes)
+
+    def run(self):
+        import uvicorn
+
+        uvicorn.run(
+            self.app,
+            host=self.api_host,
+            port=int(self.api_port),
+            timeout_keep_alive=self.api_keepalive,
+            log_level="debug" if self.debug else "info",
+        )
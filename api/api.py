@@ -1,11 +1,22 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_jwt_extended import create_access_token, decode_token, JWTManager
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from pathlib import Path
-import uuid
-import shutil
 import os
+import time
+import json
 from .fs import FileManagementSystem
+from .upload import UploadSessionManager
+from .index import FileIndex
+from .watch import FileWatcher
+from .auth import TokenCache, request_token
+from .jobs import JobManager
+from .batch import BatchExecutor
+from .checksum import HashCache
+from .events import EventBus
+from .usage import UsageTracker
+from . import ranges, archive, sync
 
 
 class FileSystemAPID:
@@ -21,16 +32,48 @@ class FileSystemAPID:
         api_support_search_file: bool = True,
         api_support_upload_file: bool = True,
         api_support_download_file: bool = True,
-        api_file_upload_max_size: int = 1024000,  # byte
+        api_support_jobs: bool = True,
+        api_support_batch: bool = True,
+        api_support_checksum: bool = True,
+        api_support_sync: bool = True,
+        api_support_events: bool = False,
+        api_support_usage: bool = False,
+        api_file_upload_max_size: int = 1024000,  # byte, <= 0 means unlimited
+        api_stream_upload_max_size: int = 0,  # byte, streamed, <= 0 means unlimited
+        api_upload_session_dir: str = None,
+        api_archive_max_size: int = 0,  # byte, extracted size, <= 0 means unlimited
+        api_fs_index: bool = False,
+        api_fs_watch: str = "auto",  # auto, inotify or poll
+        api_fs_poll_interval: float = 5.0,  # second
+        api_jobs_db: str = None,
+        api_jobs_workers: int = 2,
+        api_batch_max_operations: int = 1000,
+        api_batch_max_concurrency: int = 8,
+        api_checksum_db: str = None,
+        api_checksum_workers: int = 2,
+        api_checksum_prefill: bool = True,  # hash new files in the background
+        api_events_buffer: int = 10000,  # events kept for resuming consumers
+        api_quotas: dict = None,  # folder -> max bytes, enables usage tracking
+        api_min_free_space: int = 0,  # byte, disk space uploads must leave free
         api_host: str = "localhost",
         api_port: int = 5000,
+        api_server: str = "flask",  # flask (development), threaded or gunicorn
+        api_workers: int = None,  # gunicorn worker processes, default 2 * cores + 1
+        api_threads: int = 4,  # gunicorn threads per worker
+        api_timeout: int = 60,  # second
+        api_keepalive: int = 5,  # second
         api_auth: bool = False,
         api_auth_secret_key: str = "",
         api_auth_token_expires: int = 86400,
         api_auth_username: str = "",
         api_auth_password: str = "",
+        api_auth_token_cache_size: int = 1024,
         app: Flask = None,
         fs: FileManagementSystem = None,
+        cache=None,  # file content cache shared with a tftp server
+        profiler=None,  # sampling profiler of a tftp server in this process
+        reloader=None,  # reloads the configuration of servers in this process
+        audit=None,  # transfer audit log of a tftp server in this process
         debug: bool = False,
     ) -> None:
         self.name = name
@@ -38,6 +81,10 @@ class FileSystemAPID:
         self.api_name = name if api_name is None else api_name
         self.app = app
         self.fs = fs
+        self.cache = cache
+        self.profiler = profiler
+        self.reloader = reloader
+        self.audit = audit
         self.api_support_delete_file = api_support_delete_file
         self.api_support_delete_folder = api_support_delete_folder
         self.api_support_create_folder = api_support_create_folder
@@ -45,9 +92,36 @@ class FileSystemAPID:
         self.api_support_search_file = api_support_search_file
         self.api_support_upload_file = api_support_upload_file
         self.api_support_download_file = api_support_download_file
+        self.api_support_jobs = api_support_jobs
+        self.api_support_batch = api_support_batch
+        self.api_support_checksum = api_support_checksum
+        self.api_support_sync = api_support_sync
+        self.api_support_events = api_support_events
+        self.api_support_usage = api_support_usage
         self.api_file_upload_max_size = api_file_upload_max_size
+        self.api_stream_upload_max_size = api_stream_upload_max_size
+        self.api_upload_session_dir = api_upload_session_dir
+        self.api_archive_max_size = api_archive_max_size
+        self.api_fs_index = api_fs_index
+        self.api_fs_watch = api_fs_watch
+        self.api_fs_poll_interval = api_fs_poll_interval
+        self.api_jobs_db = api_jobs_db
+        self.api_jobs_workers = api_jobs_workers
+        self.api_batch_max_operations = api_batch_max_operations
+        self.api_batch_max_concurrency = api_batch_max_concurrency
+        self.api_checksum_db = api_checksum_db
+        self.api_checksum_workers = api_checksum_workers
+        self.api_checksum_prefill = api_checksum_prefill
+        self.api_events_buffer = api_events_buffer
+        self.api_quotas = api_quotas or {}
+        self.api_min_free_space = api_min_free_space
         self.api_host = api_host
         self.api_port = api_port
+        self.api_server = api_server
+        self.api_workers = api_workers
+        self.api_threads = api_threads
+        self.api_timeout = api_timeout
+        self.api_keepalive = api_keepalive
         self.debug = debug
         self.api_auth = api_auth
         self.api_auth_secret_key = api_auth_secret_key
@@ -55,11 +129,87 @@ class FileSystemAPID:
         self.api_auth_username = api_auth_username
         self.api_auth_password = api_auth_password
         self.api_auth_whitelist = ["/", f"/{self.api_name}/login"]
+        self.token_cache = TokenCache(api_auth_token_cache_size)
         self.jwt = None
         if app is None:
             self.app = Flask(self.name)
         if fs is None:
             self.fs = FileManagementSystem(root_path, debug=self.debug)
+        self.watcher = None
+        if self.api_fs_index:
+            index = FileIndex(self.fs.root_path)
+            index.build()
+            self.fs.set_index(index)
+            self._get_watcher().add_listener(index.apply)
+        self.events = None
+        if self.api_support_events:
+            # API mutations are reported right away, the watcher adds
+            # out-of-band changes and echoes of the former, which are deduped
+            self.events = EventBus(self.api_events_buffer)
+            self.fs.add_listener(self.events.publish)
+            self._get_watcher().add_listener(self.events.publish)
+        self.usage = None
+        if self.api_support_usage or self.api_quotas or self.api_min_free_space > 0:
+            self.usage = UsageTracker(
+                self.fs.root_path, self.api_quotas, self.api_min_free_space
+            )
+            self.usage.build()
+            self.fs.set_usage(self.usage)
+            self._get_watcher().add_listener(self.usage.apply)
+        if self.cache is not None:
+            self.fs.add_listener(self.cache.apply)
+            if self.watcher is not None:
+                self.watcher.add_listener(self.cache.apply)
+        self.hash_cache = None
+        if self.api_support_checksum:
+            self.hash_cache = HashCache(
+                self.fs, self.api_checksum_db, self.api_checksum_workers
+            )
+            self.fs.set_hash_cache(self.hash_cache)
+            if self.api_checksum_prefill:
+                self.fs.add_listener(self.hash_cache.apply)
+                if self.watcher is not None:
+                    self.watcher.add_listener(self.hash_cache.apply)
+        self.uploads = None
+        if self.api_support_upload_file:
+            self.uploads = UploadSessionManager(
+                self.fs, self.api_upload_session_dir, self._stream_max_size()
+            )
+        self.jobs = None
+        if self.api_support_jobs:
+            self.jobs = JobManager(
+                self.fs, self.api_jobs_db, self.api_jobs_workers, uploads=self.uploads
+            )
+            # jobs can only run operations the API exposes
+            for op, supported in (
+                ("delete_file", self.api_support_delete_file),
+                ("delete_folder", self.api_support_delete_folder),
+                ("create_folder", self.api_support_create_folder),
+                ("search", self.api_support_search_file),
+            ):
+                if not supported:
+                    self.jobs.ops.pop(op, None)
+        self.batch = None
+        if self.api_support_batch:
+            # batches can only run operations the API exposes
+            self.batch = BatchExecutor(
+                self.fs,
+                ops=[
+                    op
+                    for op, supported in (
+                        ("create_folder", self.api_support_create_folder),
+                        ("delete_file", self.api_support_delete_file),
+                        ("delete_folder", self.api_support_delete_folder),
+                        ("upload_file", self.api_support_upload_file),
+                        ("search", self.api_support_search_file),
+                        ("list", self.api_support_list_path),
+                    )
+                    if supported
+                ],
+                max_operations=self.api_batch_max_operations,
+                max_concurrency=self.api_batch_max_concurrency,
+                max_size=self._upload_max_size(),
+            )
         self._init_app()
 
     def _uni_response(
@@ -85,10 +235,51 @@ class FileSystemAPID:
                 status_code,
             )
 
+    def _job_response(self, result):
+        success, data_or_error = result
+        if success:
+            return self._uni_response(True, "Success", data_or_error)
+        else:
+            raise Exception(data_or_error)
+
+    def _get_watcher(self):
+        """Shared watcher for out-of-band changes below the root path."""
+        if self.watcher is None:
+            self.watcher = FileWatcher(
+                self.fs.root_path, self.api_fs_watch, self.api_fs_poll_interval
+            )
+            self.watcher.start()
+        return self.watcher
+
+    def _upload_max_size(self):
+        if self.api_file_upload_max_size > 0:
+            return self.api_file_upload_max_size
+        return None
+
+    def _stream_max_size(self):
+        """Limit of streamed, session and delta uploads, besides quotas."""
+        if self.api_stream_upload_max_size > 0:
+            return self.api_stream_upload_max_size
+        return None
+
+    def _abs_path(self, path):
+        """Absolute path of `path`, PermissionError (403) outside of the root."""
+        valid, abs_path = self.fs._validate_and_get_abs_path(path)
+        if not valid:
+            raise PermissionError("{}: {}".format(abs_path, path))
+        return abs_path
+
+    def _check_upload_size(self, content_length):
+        """Reject a multipart upload or batch body above the upload limit."""
+        limit = self._upload_max_size()
+        if limit is not None and content_length is not None and content_length > limit:
+            raise RequestEntityTooLarge(
+                "Request exceeds max upload size {}".format(limit)
+            )
+
     def _init_app(self):
         app = self.app
         app.config["FS_ROOT_PATH"] = self.root_path
-        app.config["MAX_CONTENT_PATH"] = self.api_file_upload_max_size
         if self.api_auth:
             app.config["JWT_SECRET_KEY"] = self.api_auth_secret_key
             app.config["JWT_ACCESS_TOKEN_EXPIRES"] = self.api_auth_token_expires
@@ -102,12 +293,11 @@ class FileSystemAPID:
                 return
             if url in self.api_auth_whitelist:
                 return
-            token = request.args.get("token", default=None)
-            token = request.form.get("token", token)
+            token = request_token(request.headers, request.args)
             if token is None:
                 raise Exception("Invild token")
-            res = decode_token(str(token).encode())
-            username = res["sub"]
+            if self.token_cache.get(token) is None:
+                self.token_cache.put(token, decode_token(token))
 
         @app.errorhandler(Exception)
         def handle_exception(e):
@@ -130,6 +320,8 @@ class FileSystemAPID:
                     None,
                     403,
                 )
+            elif isinstance(e, HTTPException):
+                return self._uni_response(False, e.description, None, e.code)
             else:
                 return self._uni_response(
                     False,
@@ -172,6 +364,10 @@ class FileSystemAPID:
             @app.route(f"/{self.api_name}/delete/folder", methods=["POST"])
             def delete_folder_api():
                 path = request.form.get("path", "")
+                if self.jobs is not None and request.form.get("async", "0") == "1":
+                    return self._job_response(
+                        self.jobs.submit("delete_folder", {"path": path})
+                    )
                 success, msg = self.fs.delete_folder(path)
                 if success:
                     return self._uni_response(True, "Success")
@@ -194,7 +390,39 @@ class FileSystemAPID:
             @app.route(f"/{self.api_name}/get/list", methods=["GET"])
             def list_path_api():
                 path = request.args.get("path", default="")
-                success, data_or_error = self.fs.list_path_contents(path)
+                limit = request.args.get("limit", default=None, type=int)
+                cursor = request.args.get("cursor", default=None)
+                sort = request.args.get("sort", default=None)
+                fields = request.args.get("fields", default=None)
+                fields = None if fields is None else fields.split(",")
+                if request.args.get("format", default="json") == "ndjson":
+                    # stream entries in directory order, one JSON object per line
+                    if limit is not None or cursor is not None or sort is not None:
+                        raise Exception("ndjson listing does not support paging")
+                    success, data_or_error = self.fs.iter_path_contents(path, fields)
+                    if not success:
+                        raise Exception(data_or_error)
+                    return Response(
+                        stream_with_context(
+                            json.dumps(entry, separators=(",", ":")) + "\n"
+                            for entry in data_or_error
+                        ),
+                        mimetype="application/x-ndjson",
+                    )
+                if limit is None and cursor is None and sort is None and fields is None:
+                    success, data_or_error = self.fs.list_path_contents(path)
+                else:
+                    if cursor:
+                        valid, error = self.fs.decode_cursor(cursor, sort or "name")
+                        if not valid:
+                            raise BadRequest(error)
+                    success, data_or_error = self.fs.list_path_page(
+                        path,
+                        limit=100 if limit is None else limit,
+                        cursor=cursor,
+                        sort="name" if sort is None else sort,
+                        fields=fields,
+                    )
                 if success:
                     return self._uni_response(True, "Success", data_or_error)
                 else:
@@ -206,7 +434,18 @@ class FileSystemAPID:
             def search_api():
                 key = request.args.get("key")
                 path = request.args.get("path", default="")
-                success, results_or_error = self.fs.search(key, path)
+                mode = request.args.get("mode", default="glob")
+                if key is None or mode not in ("glob", "substring"):
+                    raise Exception("Request parameter missing")
+                if self.jobs is not None and request.args.get("async", "0") == "1":
+                    return self._job_response(
+                        self.jobs.submit(
+                            "search", {"key": key, "path": path, "mode": mode}
+                        )
+                    )
+                success, results_or_error = self.fs.search(
+                    key, path, substring=mode == "substring"
+                )
                 if success:
                     return self._uni_response(True, "Success", results_or_error)
                 else:
@@ -216,6 +455,7 @@ class FileSystemAPID:
 
             @app.route(f"/{self.api_name}/upload/file", methods=["POST"])
             def upload_file_api():
+                self._check_upload_size(request.content_length)
                 path = request.form.get("path", "")
                 if "file" not in request.files:
                     raise Exception("Request parameter missing")
@@ -223,24 +463,374 @@ class FileSystemAPID:
                 if file.filename == "":
                     raise Exception("No selected file")
 
-                filename = file.filename
-                filepath = Path(self.fs.root_path) / path / secure_filename(filename)
+                filepath = Path(path) / secure_filename(file.filename)
+                success, data_or_error = self.fs.write_stream(
+                    filepath, file.stream, max_size=self._upload_max_size()
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/stream", methods=["PUT", "POST"])
+            def upload_stream_api():
+                """Stream the raw request body into a file with constant memory."""
+                path = request.args.get("path", default="")
+                filename = request.args.get("filename", default="")
+                if secure_filename(filename) == "":
+                    raise Exception("Request parameter missing")
+                expected_hash = request.args.get(
+                    "sha256", request.headers.get("X-Content-SHA256", None)
+                )
+                filepath = Path(path) / secure_filename(filename)
+                success, data_or_error = self.fs.write_stream(
+                    filepath,
+                    request.stream,
+                    max_size=self._stream_max_size(),
+                    expected_hash=expected_hash,
+                    size=request.content_length,
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/archive", methods=["PUT", "POST"])
+            def upload_archive_api():
+                """Extract a streamed tar into a folder, see `archive.extract_tar`."""
+                path = request.args.get("path", default="")
+                self._abs_path(path)
+                success, data_or_error = archive.extract_tar(
+                    self.fs,
+                    request.stream,
+                    path,
+                    mode=request.args.get("mode", default="merge"),
+                    strip=request.args.get("strip", default=0, type=int),
+                    max_size=(
+                        self.api_archive_max_size
+                        if self.api_archive_max_size > 0
+                        else None
+                    ),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/session/init", methods=["POST"])
+            def upload_session_init_api():
+                path = request.form.get("path", "")
+                filename = request.form.get("filename", "")
+                size = request.form.get("size", None, type=int)
+                part_size = request.form.get("part_size", None, type=int)
+                if secure_filename(filename) == "" or size is None or part_size is None:
+                    raise Exception("Request parameter missing")
+                success, data_or_error = self.uploads.init(
+                    Path(path) / secure_filename(filename),
+                    size,
+                    part_size,
+                    request.form.get("sha256", None),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/session/part", methods=["PUT"])
+            def upload_session_part_api():
+                session_id = request.args.get("id", None)
+                part = request.args.get("part", None, type=int)
+                if session_id is None or part is None:
+                    raise Exception("Request parameter missing")
+                success, data_or_error = self.uploads.write_part(
+                    session_id,
+                    part,
+                    request.stream,
+                    offset=request.args.get("offset", None, type=int),
+                    expected_hash=request.args.get(
+                        "sha256", request.headers.get("X-Content-SHA256", None)
+                    ),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/session/status", methods=["GET"])
+            def upload_session_status_api():
+                success, data_or_error = self.uploads.status(request.args.get("id"))
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/session/commit", methods=["POST"])
+            def upload_session_commit_api():
+                success, data_or_error = self.uploads.commit(request.form.get("id"))
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/upload/session/abort", methods=["POST"])
+            def upload_session_abort_api():
+                success, msg = self.uploads.abort(request.form.get("id"))
+                if success:
+                    return self._uni_response(True, "Success")
+                else:
+                    raise Exception(msg)
+
+        if self.api_support_jobs:
+
+            @app.route(f"/{self.api_name}/jobs/submit", methods=["POST"])
+            def job_submit_api():
+                op = request.form.get("op", None)
+                if op is None:
+                    raise Exception("Request parameter missing")
+                args = request.form.to_dict()
+                args.pop("op")
+                return self._job_response(self.jobs.submit(op, args))
+
+            @app.route(f"/{self.api_name}/jobs/status", methods=["GET"])
+            def job_status_api():
+                return self._job_response(self.jobs.status(request.args.get("id")))
+
+            @app.route(f"/{self.api_name}/jobs/list", methods=["GET"])
+            def job_list_api():
+                return self._job_response(
+                    self.jobs.list(
+                        request.args.get("status", None),
+                        request.args.get("limit", 100, type=int),
+                    )
+                )
+
+            @app.route(f"/{self.api_name}/jobs/cancel", methods=["POST"])
+            def job_cancel_api():
+                return self._job_response(self.jobs.cancel(request.form.get("id")))
+
+        if self.api_support_batch:
+
+            @app.route(f"/{self.api_name}/batch", methods=["POST"])
+            def batch_api():
+                self._check_upload_size(request.content_length)
+                # a JSON body, or a multipart form whose `operations` field holds
+                # the JSON list and whose files are referenced by upload_file ops
+                body = request.get_json(silent=True)
+                if body is None:
+                    body = request.form.to_dict()
+                    body["operations"] = json.loads(body.get("operations", "[]"))
+                atomic = str(body.get("atomic", False)).lower() in ("1", "true")
+                success, data_or_error = self.batch.run(
+                    body.get("operations", None),
+                    atomic=atomic,
+                    concurrency=int(body.get("concurrency", 1)),
+                    files=request.files,
+                )
+                if not success:
+                    raise Exception(data_or_error)
+                if data_or_error["succeeded"]:
+                    return self._uni_response(True, "Success", data_or_error)
+                if data_or_error["rolled_back"]:
+                    return self._uni_response(
+                        False, "Batch failed, rolled back", data_or_error, 409
+                    )
+                return self._uni_response(
+                    False, "Batch partially failed", data_or_error
+                )
+
+        if self.api_support_checksum:
+
+            @app.route(f"/{self.api_name}/checksum", methods=["GET"])
+            def checksum_api():
+                path = request.args.get("path", default=None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                self._abs_path(path)
+                success, data_or_error = self.hash_cache.checksum(
+                    path, request.args.get("algo", default="sha256")
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.usage is not None:
+
+            @app.route(f"/{self.api_name}/usage", methods=["GET"])
+            def usage_api():
+                success, data_or_error = self.usage.usage(
+                    request.args.get("path", default=""),
+                    request.args.get("depth", default=1, type=int),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.cache is not None:
+
+            @app.route(f"/{self.api_name}/cache/status", methods=["GET"])
+            def cache_status_api():
+                success, data_or_error = self.cache.status()
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/cache/preload", methods=["POST"])
+            def cache_preload_api():
+                path = request.form.get("path", None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                success, data_or_error = self.cache.preload(path)
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+            @app.route(f"/{self.api_name}/cache/evict", methods=["POST"])
+            def cache_evict_api():
+                success, data_or_error = self.cache.evict(request.form.get("path", ""))
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.profiler is not None:
+
+            @app.route(f"/{self.api_name}/profile/<action>", methods=["GET", "POST"])
+            def profile_api(action):
+                """Sampling profiler: GET status, POST start, stop or toggle."""
+                actions = {
+                    "status": self.profiler.status,
+                    "start": self.profiler.start,
+                    "stop": self.profiler.stop,
+                    "toggle": self.profiler.toggle,
+                }
+                if action not in actions or (request.method == "GET") != (
+                    action == "status"
+                ):
+                    raise Exception("Unsupported profile action {}".format(action))
+                success, data_or_error = actions[action]()
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.reloader is not None:
 
-                # Generate a unique filename to avoid conflicts
-                temp_filename = f"{filename}-{uuid.uuid4()}.filepart"
-                temp_filepath = Path(self.fs.root_path) / path / temp_filename
+            @app.route(f"/{self.api_name}/config/reload", methods=["POST"])
+            def config_reload_api():
+                success, data_or_error = self.reloader.reload()
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.audit is not None:
+
+            @app.route(f"/{self.api_name}/audit/status", methods=["GET"])
+            def audit_status_api():
+                success, data_or_error = self.audit.status()
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
 
-                # Ensure the directory exists
-                temp_filepath.parent.mkdir(parents=True, exist_ok=True)
-                success, msg = self.fs.create_folder(temp_filepath.parent)
+            @app.route(f"/{self.api_name}/audit/query", methods=["GET"])
+            def audit_query_api():
+                """Aggregates of the last `since` seconds, top `limit` files/clients."""
+                since = request.args.get("since", default=None, type=float)
+                success, data_or_error = self.audit.query(
+                    None if since is None else time.time() - since,
+                    request.args.get("limit", default=10, type=int),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
+
+        if self.api_support_sync:
+
+            @app.route(f"/{self.api_name}/sync/manifest", methods=["GET"])
+            def sync_manifest_api():
+                success, data_or_error = sync.build_manifest(
+                    self.fs, request.args.get("path", default=""), self.hash_cache
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
 
-                file.save(str(temp_filepath))
+            @app.route(f"/{self.api_name}/sync/signature", methods=["GET"])
+            def sync_signature_api():
+                path = request.args.get("path", default=None)
+                if path is None:
+                    raise Exception("Request parameter missing")
+                success, data_or_error = sync.file_signature(
+                    self.fs,
+                    path,
+                    request.args.get("block_size", default=None, type=int),
+                )
+                if success:
+                    return self._uni_response(True, "Success", data_or_error)
+                else:
+                    raise Exception(data_or_error)
 
-                # cover the file named filename
-                shutil.copy(temp_filepath, filepath)
-                success, msg = self.fs.delete_file(temp_filepath)
+            if self.api_support_upload_file:
+
+                @app.route(f"/{self.api_name}/sync/delta", methods=["PUT"])
+                def sync_delta_api():
+                    path = request.args.get("path", default=None)
+                    block_size = request.args.get("block_size", default=None, type=int)
+                    if path is None or block_size is None:
+                        raise Exception("Request parameter missing")
+                    success, data_or_error = sync.apply_delta(
+                        self.fs,
+                        path,
+                        request.stream,
+                        block_size,
+                        request.args.get("sha256", default=None),
+                        max_size=self._stream_max_size(),
+                    )
+                    if success:
+                        return self._uni_response(True, "Success", data_or_error)
+                    else:
+                        raise Exception(data_or_error)
+
+        if self.api_support_events:
+
+            @app.route(f"/{self.api_name}/events/stream", methods=["GET"])
+            def events_stream_api():
+                """Server-Sent Events, resumable with the Last-Event-ID header."""
+                last_id = self.events.parse_id(
+                    request.headers.get(
+                        "Last-Event-ID", request.args.get("last_event_id", None)
+                    )
+                )
+                return Response(
+                    self.events.stream(last_id, request.args.get("path", default="")),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
 
-                return self._uni_response(True, "Success")
+            @app.route(f"/{self.api_name}/events/poll", methods=["GET"])
+            def events_poll_api():
+                """Long poll for events after `since`, without it the current id."""
+                since = self.events.parse_id(request.args.get("since", None))
+                if since is None:
+                    events, reset, last_id = [], False, self.events.last_id
+                else:
+                    timeout = min(request.args.get("timeout", 30.0, type=float), 60.0)
+                    events, reset = self.events.wait(
+                        since, request.args.get("path", default=""), timeout
+                    )
+                    last_id = int(events[-1]["id"]) if events else since
+                return self._uni_response(
+                    True,
+                    "Success",
+                    {"events": events, "last_id": str(last_id), "reset": reset},
+                )
 
         if self.api_support_download_file:
 
@@ -249,17 +839,111 @@ class FileSystemAPID:
                 path = request.args.get("path", default=None)
                 if path is None:
                     raise Exception("Request parameter missing")
-                # Assuming 'uploads' is a subfolder where files are stored, adjust as needed.
-                file_path = Path(self.fs.root_path) / path
-                if not file_path.exists():
-                    raise Exception("File is not exist")
+                file_path = self._abs_path(path)
+                status, headers, body = ranges.prepare_download(
+                    str(file_path), request.headers, self.fs.read_max_bytes
+                )
+                if body == "file":
+                    # whole file, let the server use its file wrapper (sendfile)
+                    response = send_file(str(file_path), conditional=False, etag=False)
+                    response.headers.update(headers)
+                    return response
+                return Response(
+                    body, status=status, headers=headers, direct_passthrough=True
+                )
 
-                return send_from_directory(
-                    str(self.fs.root_path), path, as_attachment=True
+            @app.route(f"/{self.api_name}/download/archive", methods=["GET"])
+            def download_archive_api():
+                path = request.args.get("path", default="")
+                fmt = request.args.get("format", default="tar")
+                if fmt not in archive.ARCHIVE_FORMATS:
+                    raise Exception(
+                        "Unsupported archive format {}, supported: {}".format(
+                            fmt, list(archive.ARCHIVE_FORMATS)
+                        )
+                    )
+                dir_path = self._abs_path(path)
+                if not dir_path.is_dir():
+                    raise FileNotFoundError("Folder {} does not exist".format(path))
+                filename = "{}.{}".format(dir_path.name or self.name, fmt)
+                return Response(
+                    archive.iter_tar(str(dir_path), fmt, self.fs.read_max_bytes),
+                    mimetype=archive.ARCHIVE_FORMATS[fmt][0],
+                    headers={
+                        "Content-Disposition": ranges.content_disposition(filename)
+                    },
+                    direct_passthrough=True,
                 )
 
+    def _post_fork(self):
+        """Restart background threads, which do not survive fork(), in a worker."""
+        if self.watcher is not None:
+            listeners = self.watcher.listeners
+            self.watcher = None
+            watcher = self._get_watcher()
+            watcher.listeners.extend(listeners)
+        if self.fs.index is not None:
+            self.fs.index.build()
+
+    def _run_threaded(self):
+        """
+        Thread per connection WSGI server without extra dependencies.
+
+        Werkzeug closes the connection after each response and has no
+        sendfile path, use gunicorn for keep-alive and zero-copy downloads.
+        """
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class RequestHandler(WSGIRequestHandler):
+            timeout = self.api_timeout
+
+        server = make_server(
+            self.api_host,
+            int(self.api_port),
+            self.app,
+            threaded=True,
+            request_handler=RequestHandler,
+        )
+        server.serve_forever()
+
+    def _run_gunicorn(self):
+        """Pre-fork gunicorn server, downloads are sent with sendfile."""
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            raise Exception("gunicorn is required for api_server 'gunicorn'")
+        fsapid = self
+        workers = self.api_workers
+        if workers is None:
+            workers = 2 * (os.cpu_count() or 1) + 1
+        options = {
+            "bind": "{}:{}".format(self.api_host, self.api_port),
+            "workers": workers,
+            "threads": self.api_threads,
+            "worker_class": "gthread" if self.api_threads > 1 else "sync",
+            "timeout": self.api_timeout,
+            "keepalive": self.api_keepalive,
+            "sendfile": True,
+            "post_fork": lambda server, worker: fsapid._post_fork(),
+        }
+
+        class Application(BaseApplication):
+            def load_config(self):
+                for key, value in options.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return fsapid.app
+
+        Application().run()
+
     def run(self):
-        self.app.run(host=self.api_host, port=self.api_port, debug=self.debug)
+        if self.api_server == "gunicorn":
+            self._run_gunicorn()
+        elif self.api_server == "threaded":
+            self._run_threaded()
+        else:
+            self.app.run(host=self.api_host, port=self.api_port, debug=self.debug)
 
 
 if __name__ == "__main__":
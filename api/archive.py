@@ -0,0 +1,348 @@
+import os
+import bz2
+import lzma
+import stat
+import uuid
+import zlib
+import shutil
+import logging
+import tarfile
+from pathlib import Path
+from .watch import EVENT_CREATE, EVENT_MODIFY, EVENT_DELETE
+
+ARCHIVE_FORMATS = {
+    "tar": ("application/x-tar", None),
+    "tar.gz": ("application/gzip", lambda: zlib.compressobj(6, zlib.DEFLATED, 31)),
+    "tar.bz2": ("application/x-bzip2", bz2.BZ2Compressor),
+    "tar.xz": ("application/x-xz", lzma.LZMACompressor),
+}
+EXTRACT_MODES = ("merge", "replace")
+STAGING_PREFIX = ".extract-"
+
+logger = logging.getLogger(__name__)
+
+
+def _skip(name):
+    """Temp and staging entries of in-flight writes are not archived."""
+    return name.endswith(".filepart") or name.startswith((".batch-", STAGING_PREFIX))
+
+
+def _walk(abs_dir, arc_dir):
+    """Yield (abs_path, arcname, lstat) depth-first, parents before children."""
+    stack = [(abs_dir, arc_dir)]
+    while stack:
+        current, arc_current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(
+                    (entry for entry in it if not _skip(entry.name)),
+                    key=lambda entry: entry.name,
+                    reverse=True,
+                )
+        except OSError as e:
+            logger.warning("Skipping {}: {}".format(current, e))
+            continue
+        for entry in entries:
+            arcname = "{}/{}".format(arc_current, entry.name)
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            yield entry.path, arcname, st
+            if stat.S_ISDIR(st.st_mode):
+                stack.append((entry.path, arcname))
+
+
+def _tarinfo(abs_path, arcname, st):
+    info = tarfile.TarInfo(arcname)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = int(st.st_mtime)
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(abs_path)
+    elif stat.S_ISREG(st.st_mode):
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    else:
+        return None
+    return info
+
+
+def iter_tar(abs_dir, fmt="tar", chunk_size=1024 * 1024):
+    """
+    Stream a directory as a tar archive without temp files.
+
+    Headers and file data are produced block by block while walking the tree
+    with `os.scandir`, and compressed incrementally, so memory stays constant
+    whatever the size of the tree.
+    """
+    compressor = ARCHIVE_FORMATS[fmt][1]
+    compressor = None if compressor is None else compressor()
+    abs_dir = os.path.abspath(abs_dir)
+    arc_dir = os.path.basename(abs_dir) or "root"
+    written = 0
+
+    def out(data):
+        nonlocal written
+        written += len(data)
+        return data if compressor is None else compressor.compress(data)
+
+    root_st = os.stat(abs_dir)
+    chunk = out(_tarinfo(abs_dir, arc_dir, root_st).tobuf(tarfile.PAX_FORMAT))
+    if chunk:
+        yield chunk
+    for abs_path, arcname, st in _walk(abs_dir, arc_dir):
+        try:
+            info = _tarinfo(abs_path, arcname, st)
+        except OSError:
+            continue
+        if info is None:
+            continue
+        if not info.isreg():
+            chunk = out(info.tobuf(tarfile.PAX_FORMAT))
+            if chunk:
+                yield chunk
+            continue
+        try:
+            f = open(abs_path, "rb")
+        except OSError as e:
+            logger.warning("Skipping {}: {}".format(abs_path, e))
+            continue
+        with f:
+            chunk = out(info.tobuf(tarfile.PAX_FORMAT))
+            if chunk:
+                yield chunk
+            remaining = info.size
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    # the file shrank while being read, keep the header's size
+                    data = tarfile.NUL * min(chunk_size, remaining)
+                remaining -= len(data)
+                chunk = out(data)
+                if chunk:
+                    yield chunk
+            remainder = info.size % tarfile.BLOCKSIZE
+            if remainder:
+                chunk = out(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                if chunk:
+                    yield chunk
+    # end of archive: two empty blocks, padded to a full record
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    chunk = out(tarfile.NUL * end)
+    if chunk:
+        yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _member_path(member, strip):
+    """Validated relative path of a member, or None to skip it."""
+    name = member.name.replace("\\", "/")
+    if name.startswith("/"):
+        raise ValueError("Absolute path in archive: {}".format(member.name))
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError("Parent reference in archive: {}".format(member.name))
+    parts = parts[strip:]
+    return os.path.join(*parts) if parts else None
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def extract_tar(fs, stream, path="", mode="merge", strip=0, max_size=None):
+    """
+    Extract a streamed tar (any compression tarfile can detect) below `path`.
+
+    Members are read in a single pass into a staging folder under the root,
+    rejecting absolute paths, `..`, links pointing outside the archive,
+    hard links and device files. Only a fully extracted archive is moved in
+    place: `replace` swaps the whole folder with two renames, `merge` renames
+    each entry over the existing tree and rolls them back on failure, see
+    `_merge`.
+    """
+    if mode not in EXTRACT_MODES:
+        return False, "Unsupported extract mode {}, supported: {}".format(
+            mode, list(EXTRACT_MODES)
+        )
+    valid, abs_dest = fs._validate_and_get_abs_path(path)
+    if not valid:
+        return valid, abs_dest
+    if mode == "replace" and abs_dest == Path(fs.root_path):
+        return False, "Can not replace the root folder"
+    if abs_dest.exists() and not abs_dest.is_dir():
+        return False, "{} is not a folder".format(path)
+    fits, limit = fs.check_space(abs_dest, None, is_dir=True)
+    if not fits:
+        return fits, limit
+    if limit is not None and (max_size is None or limit < max_size):
+        max_size = limit
+    staging = os.path.join(
+        fs.root_path, "{}{}".format(STAGING_PREFIX, uuid.uuid4().hex)
+    )
+    stats = {"path": fs._rel_path(abs_dest), "files": 0, "dirs": 0, "size": 0}
+    try:
+        os.mkdir(staging)
+        real_staging = os.path.realpath(staging)
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            for member in tar:
+                rel_path = _member_path(member, strip)
+                if rel_path is None:
+                    continue
+                target = os.path.join(staging, rel_path)
+                parent = os.path.dirname(target)
+                if not _inside(os.path.realpath(parent), real_staging):
+                    raise ValueError("Path escapes the archive: {}".format(member.name))
+                os.makedirs(parent, exist_ok=True)
+                if member.isdir():
+                    if not os.path.isdir(target):
+                        os.mkdir(target)
+                    stats["dirs"] += 1
+                    continue
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    os.unlink(target)
+                if member.issym():
+                    link_target = os.path.realpath(
+                        os.path.join(parent, member.linkname)
+                    )
+                    if os.path.isabs(member.linkname) or not _inside(
+                        link_target, real_staging
+                    ):
+                        raise ValueError(
+                            "Link escapes the archive: {} -> {}".format(
+                                member.name, member.linkname
+                            )
+                        )
+                    os.symlink(member.linkname, target)
+                    stats["files"] += 1
+                    continue
+                if not member.isreg():
+                    raise ValueError(
+                        "Unsupported member type in archive: {}".format(member.name)
+                    )
+                stats["size"] += member.size
+                if max_size is not None and stats["size"] > max_size:
+                    raise ValueError(
+                        "Archive exceeds max extract size {}".format(max_size)
+                    )
+                source = tar.extractfile(member)
+                with open(target, "xb") as f:
+                    shutil.copyfileobj(source, f, fs.write_chunk_size)
+                os.chmod(target, member.mode & 0o755)
+                os.utime(target, (member.mtime, member.mtime))
+                stats["files"] += 1
+        if mode == "replace":
+            _swap(fs, staging, abs_dest)
+        else:
+            _merge(fs, staging, abs_dest)
+    except Exception as e:
+        return False, str(e)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    fs.logger.info(
+        "Archive extracted to {}: {} files, {} folders, {} bytes".format(
+            abs_dest, stats["files"], stats["dirs"], stats["size"]
+        )
+    )
+    return True, stats
+
+
+def _swap(fs, staging, abs_dest):
+    abs_dest.parent.mkdir(parents=True, exist_ok=True)
+    if not abs_dest.exists():
+        os.rename(staging, abs_dest)
+        fs.notify(EVENT_CREATE, abs_dest, True)
+        return
+    old = "{}-old".format(staging)
+    os.rename(abs_dest, old)
+    try:
+        os.rename(staging, abs_dest)
+    except Exception:
+        os.rename(old, abs_dest)
+        raise
+    shutil.rmtree(old, ignore_errors=True)
+    fs.notify(EVENT_DELETE, abs_dest, True)
+    fs.notify(EVENT_CREATE, abs_dest, True)
+
+
+def _merge(fs, staging, abs_dest):
+    """
+    Rename each staged entry over the existing tree.
+
+    Replaced files are hard linked aside first and put back, and new entries
+    removed, if any rename fails, so a failed merge leaves the tree as it
+    was. Unlike `_swap` the merge is not atomic for readers, who can see a
+    partly merged tree while it runs.
+    """
+    moves = []  # (source, target, is_dir), parents before children
+    for current, dirs, files in os.walk(staging):
+        rel_dir = os.path.relpath(current, staging)
+        dest_dir = abs_dest if rel_dir == "." else abs_dest / rel_dir
+        # symlinks to folders are listed as dirs but moved like files
+        links = [name for name in dirs if os.path.islink(os.path.join(current, name))]
+        dirs[:] = sorted(name for name in dirs if name not in links)
+        for name in dirs:
+            moves.append((os.path.join(current, name), dest_dir / name, True))
+        for name in sorted(files + links):
+            moves.append((os.path.join(current, name), dest_dir / name, False))
+    # check for file/folder conflicts before touching the tree
+    for _, target, is_dir in moves:
+        if os.path.lexists(target) and is_dir != (
+            target.is_dir() and not target.is_symlink()
+        ):
+            raise ValueError(
+                "{} already exists as a {}".format(
+                    os.path.relpath(target, fs.root_path),
+                    "file" if is_dir else "folder",
+                )
+            )
+    backup = "{}-old".format(staging)
+    done = []  # (target, backup path or None, is_dir) to undo, in order
+    events = []
+    try:
+        os.mkdir(backup)
+        for path in [*reversed(abs_dest.parents), abs_dest]:
+            if not path.is_dir():
+                path.mkdir()
+                done.append((path, None, True))
+        for source, target, is_dir in moves:
+            if is_dir:
+                if not target.is_dir():
+                    target.mkdir()
+                    done.append((target, None, True))
+                    events.append((EVENT_CREATE, target, True))
+                continue
+            saved = None
+            if os.path.lexists(target):
+                saved = os.path.join(backup, str(len(done)))
+                try:
+                    os.link(target, saved, follow_symlinks=False)
+                except OSError:
+                    # no hard links on this file system
+                    shutil.copy2(target, saved, follow_symlinks=False)
+            done.append((target, saved, False))
+            os.replace(source, target)
+            events.append(
+                (EVENT_CREATE if saved is None else EVENT_MODIFY, target, False)
+            )
+    except Exception:
+        for target, saved, is_dir in reversed(done):
+            try:
+                if is_dir:
+                    os.rmdir(target)
+                elif saved is not None:
+                    os.replace(saved, target)
+                elif os.path.lexists(target):
+                    os.unlink(target)
+            except OSError as e:
+                logger.warning("Failed to roll back {}: {}".format(target, e))
+        raise
+    finally:
+        shutil.rmtree(backup, ignore_errors=True)
+    for event, target, is_dir in events:
+        fs.notify(event, target, is_dir)
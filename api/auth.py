@@ -0,0 +1,48 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+def request_token(headers, args):
+    """Token from an `Authorization: Bearer` header or the `token` query arg.
+
+    The request body is never read, so auth does not force a multipart
+    upload to be parsed before the route runs.
+    """
+    authorization = headers.get("Authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token.strip():
+        return token.strip()
+    return args.get("token", None)
+
+
+class TokenCache:
+    """Bounded LRU cache of verified tokens, each dropped at its `exp`."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.tokens = OrderedDict()  # token -> (exp, claims)
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        """Claims of a cached, unexpired token, otherwise None."""
+        with self.lock:
+            item = self.tokens.get(token, None)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self.tokens[token]
+                return None
+            self.tokens.move_to_end(token)
+            return item[1]
+
+    def put(self, token, claims):
+        exp = claims.get("exp", None)
+        if self.maxsize <= 0 or exp is None:
+            # without an expiry the token has to be verified every time
+            return
+        with self.lock:
+            self.tokens[token] = (exp, claims)
+            self.tokens.move_to_end(token)
+            while len(self.tokens) > self.maxsize:
+                self.tokens.popitem(last=False)
@@ -0,0 +1,305 @@
+import os
+import io
+import uuid
+import base64
+import shutil
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from .watch import EVENT_CREATE, EVENT_MODIFY, EVENT_DELETE
+
+
+class BatchError(Exception):
+    pass
+
+
+class Batch:
+    """
+    One batch run: ordered operations, optional concurrency and, when
+    `atomic`, an undo log so a failure rolls back every completed operation.
+
+    In atomic mode deletes move the old entry into a `.batch-<id>` staging
+    folder under the root (a rename, so it is cheap and on the same
+    filesystem) and overwrites hard link the old file there before replacing
+    it; staged entries are dropped once the whole batch succeeded or moved
+    back on rollback.
+    """
+
+    def __init__(self, executor, operations, atomic=False, concurrency=1, files=None):
+        self.executor = executor
+        self.fs = executor.fs
+        self.operations = operations
+        self.atomic = atomic
+        self.concurrency = max(1, concurrency)
+        self.files = {} if files is None else files
+        self.id = uuid.uuid4().hex
+        self.staging = os.path.join(self.fs.root_path, ".batch-{}".format(self.id))
+        self.undo = []  # (index, callable), appended as operations complete
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+
+    def _stage(self, abs_path, index):
+        """Move an existing entry out of the way, returning where it went."""
+        os.makedirs(self.staging, exist_ok=True)
+        staged = os.path.join(self.staging, str(index))
+        os.rename(abs_path, staged)
+        return staged
+
+    def _preserve(self, abs_path, index):
+        """Keep the content of a file about to be replaced, returning where."""
+        os.makedirs(self.staging, exist_ok=True)
+        staged = os.path.join(self.staging, str(index))
+        try:
+            # a second name for the old inode, replacing the file leaves it intact
+            os.link(abs_path, staged)
+        except OSError:
+            shutil.copy2(abs_path, staged)
+        return staged
+
+    def _record_undo(self, index, undo):
+        with self.lock:
+            self.undo.append((index, undo))
+
+    def _path(self, args, key="path", default=None):
+        value = args.get(key, default)
+        if value is None:
+            raise BatchError("Request parameter missing: {}".format(key))
+        valid, abs_path = self.fs._validate_and_get_abs_path(value)
+        if not valid:
+            raise BatchError(abs_path)
+        if abs_path == Path(self.fs.root_path):
+            raise BatchError("Invalid path")
+        return abs_path
+
+    # operations, called as op(index, args) -> data, raising on failure
+
+    def _op_create_folder(self, index, args):
+        abs_path = self._path(args)
+        if not self.atomic:
+            return self.executor._check(self.fs.create_folder(abs_path))
+        # the topmost folder this operation creates is what undo removes
+        created = None
+        current = abs_path
+        while not current.exists():
+            created = current
+            current = current.parent
+        abs_path.mkdir(parents=True, exist_ok=True)
+        self.fs.notify(EVENT_CREATE, abs_path, True)
+        if created is not None:
+
+            def undo():
+                shutil.rmtree(created, ignore_errors=True)
+                self.fs.notify(EVENT_DELETE, created, True)
+
+            self._record_undo(index, undo)
+        return None
+
+    def _op_delete(self, index, args, is_dir):
+        abs_path = self._path(args)
+        if not self.atomic:
+            if is_dir:
+                return self.executor._check(self.fs.delete_folder(abs_path))
+            return self.executor._check(self.fs.delete_file(abs_path))
+        if is_dir != abs_path.is_dir() or not abs_path.exists():
+            raise FileNotFoundError(
+                "{} {} does not exist".format(
+                    "Folder" if is_dir else "File", args["path"]
+                )
+            )
+        staged = self._stage(abs_path, index)
+        self.fs.notify(EVENT_DELETE, abs_path, is_dir)
+
+        def undo():
+            os.rename(staged, abs_path)
+            self.fs.notify(EVENT_CREATE, abs_path, is_dir)
+
+        self._record_undo(index, undo)
+        return None
+
+    def _op_delete_file(self, index, args):
+        return self._op_delete(index, args, False)
+
+    def _op_delete_folder(self, index, args):
+        return self._op_delete(index, args, True)
+
+    def _op_upload_file(self, index, args):
+        """Write `content_base64`, or a multipart file field named by `file`."""
+        abs_path = self._path(args)
+        if "content_base64" in args:
+            stream = io.BytesIO(base64.b64decode(args["content_base64"]))
+        elif args.get("file", None) in self.files:
+            stream = self.files[args["file"]]
+        else:
+            raise BatchError("Request parameter missing: content_base64 or file")
+        success, writer = self.fs.open_writer(
+            abs_path,
+            max_size=self.executor.max_size,
+            expected_hash=args.get("sha256", None),
+        )
+        if not success:
+            raise BatchError(writer)
+        try:
+            while True:
+                chunk = stream.read(self.fs.write_chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+            # the target stays in place until commit replaces it, so a failed
+            # commit leaves it untouched
+            staged = None
+            if self.atomic and abs_path.exists():
+                staged = self._preserve(abs_path, index)
+            data = writer.commit()
+        except Exception:
+            writer.discard()
+            raise
+        if self.atomic:
+
+            def undo():
+                if staged is not None:
+                    os.replace(staged, abs_path)
+                    self.fs.notify(EVENT_MODIFY, abs_path)
+                else:
+                    abs_path.unlink(missing_ok=True)
+                    self.fs.notify(EVENT_DELETE, abs_path)
+
+            self._record_undo(index, undo)
+        return data
+
+    def _op_search(self, index, args):
+        key = args.get("key", None)
+        mode = args.get("mode", "glob")
+        if key is None or mode not in ("glob", "substring"):
+            raise BatchError("Request parameter missing: key")
+        return self.executor._check(
+            self.fs.search(key, args.get("path", ""), substring=mode == "substring")
+        )
+
+    def _op_list(self, index, args):
+        return self.executor._check(self.fs.list_path_contents(args.get("path", "")))
+
+    def _run_one(self, index, operation):
+        if self.atomic and self.failed.is_set():
+            return {"index": index, "flag": False, "message": "Skipped", "data": None}
+        op = operation.get("op", None) if isinstance(operation, dict) else None
+        try:
+            if op not in self.executor.ops:
+                raise BatchError(
+                    "Unsupported batch operation {}, supported: {}".format(
+                        op, sorted(self.executor.ops)
+                    )
+                )
+            args = operation.get("args", {}) or {}
+            data = getattr(self, "_op_{}".format(op))(index, args)
+            return {
+                "index": index,
+                "op": op,
+                "flag": True,
+                "message": "Success",
+                "data": data,
+            }
+        except Exception as e:
+            self.failed.set()
+            message = str(e).replace(f"{self.fs.root_path}/", "")
+            return {
+                "index": index,
+                "op": op,
+                "flag": False,
+                "message": message,
+                "data": None,
+            }
+
+    def run(self):
+        """Run all operations, returning (all_succeeded, results, rolled_back)."""
+        try:
+            if self.concurrency == 1:
+                results = []
+                for index, operation in enumerate(self.operations):
+                    results.append(self._run_one(index, operation))
+                    if self.atomic and not results[-1]["flag"]:
+                        break
+                results += [
+                    {"index": index, "flag": False, "message": "Skipped", "data": None}
+                    for index in range(len(results), len(self.operations))
+                ]
+            else:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                    futures = [
+                        pool.submit(self._run_one, index, operation)
+                        for index, operation in enumerate(self.operations)
+                    ]
+                    results = [future.result() for future in futures]
+            succeeded = all(result["flag"] for result in results)
+            rolled_back = False
+            if self.atomic and not succeeded:
+                self._rollback()
+                rolled_back = True
+            return succeeded, results, rolled_back
+        finally:
+            shutil.rmtree(self.staging, ignore_errors=True)
+
+    def _rollback(self):
+        for index, undo in reversed(self.undo):
+            try:
+                undo()
+            except Exception as e:
+                self.executor.logger.error(
+                    "Batch {} rollback of operation {} failed: {}".format(
+                        self.id, index, e
+                    )
+                )
+        self.executor.logger.info("Batch {} rolled back".format(self.id))
+
+
+class BatchExecutor:
+    """Run ordered lists of FileManagementSystem operations, see `Batch`."""
+
+    OPS = (
+        "create_folder",
+        "delete_file",
+        "delete_folder",
+        "upload_file",
+        "search",
+        "list",
+    )
+
+    def __init__(
+        self, fs, ops=OPS, max_operations=1000, max_concurrency=8, max_size=None
+    ):
+        self.fs = fs
+        self.ops = tuple(ops)
+        self.max_operations = max_operations
+        self.max_concurrency = max_concurrency
+        self.max_size = max_size
+        self.logger = logging.getLogger(__name__)
+
+    def _check(self, result):
+        success, data_or_error = result
+        if not success:
+            raise BatchError(data_or_error)
+        return data_or_error
+
+    def run(self, operations, atomic=False, concurrency=1, files=None):
+        if not isinstance(operations, list) or not operations:
+            return False, "Request parameter missing: operations"
+        if len(operations) > self.max_operations:
+            return False, "Too many operations, max {}".format(self.max_operations)
+        batch = Batch(
+            self,
+            operations,
+            atomic=atomic,
+            concurrency=min(int(concurrency), self.max_concurrency),
+            files=files,
+        )
+        succeeded, results, rolled_back = batch.run()
+        self.logger.info(
+            "Batch {}: {} operations, succeeded {}, rolled back {}".format(
+                batch.id, len(operations), succeeded, rolled_back
+            )
+        )
+        return True, {
+            "succeeded": succeeded,
+            "rolled_back": rolled_back,
+            "results": results,
+        }
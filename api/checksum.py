@@ -0,0 +1,198 @@
+import os
+import mmap
+import stat
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from .watch import EVENT_CREATE, EVENT_MODIFY, EVENT_DELETE
+
+HASH_ALGORITHMS = ("md5", "sha1", "sha256", "sha512", "blake2b")
+
+
+def hash_file(path, algo="sha256", chunk_size=8 * 1024 * 1024):
+    """Hash a file through a read-only mmap, feeding the hasher in chunks."""
+    hasher = hashlib.new(algo)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hasher.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+            try:
+                for offset in range(0, len(view), chunk_size):
+                    hasher.update(view[offset : offset + chunk_size])
+            finally:
+                view.release()
+    return hasher.hexdigest()
+
+
+class HashCache:
+    """
+    Persistent file hashes, keyed by (device, inode, size, mtime_ns).
+
+    A hash stays valid as long as the file it was computed for is unchanged,
+    so lookups only cost a stat and a SQLite read. Missing hashes are
+    computed on a thread pool (hashlib releases the GIL on large updates),
+    with concurrent requests for the same file sharing one computation.
+    Writers that already hashed the data record it with `record`.
+    """
+
+    def __init__(self, fs, db_path=None, workers=2, chunk_size=8 * 1024 * 1024):
+        self.fs = fs
+        self.db_path = (
+            os.path.join(tempfile.gettempdir(), "tftp-api-hashes.sqlite")
+            if db_path is None
+            else os.path.abspath(db_path)
+        )
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="api-hash"
+        )
+        self.pending = {}  # (dev, ino, size, mtime_ns, algo) -> Future
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "dev INTEGER, ino INTEGER, algo TEXT, size INTEGER, "
+                "mtime_ns INTEGER, digest TEXT, path TEXT, updated REAL, "
+                "PRIMARY KEY (dev, ino, algo))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS hashes_path ON hashes (path)")
+
+    @contextlib.contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _lookup(self, st, algo):
+        with self._db() as conn:
+            row = conn.execute(
+                "SELECT digest FROM hashes "
+                "WHERE dev=? AND ino=? AND algo=? AND size=? AND mtime_ns=?",
+                (st.st_dev, st.st_ino, algo, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _store(self, st, algo, digest, rel_path):
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO hashes "
+                "(dev, ino, algo, size, mtime_ns, digest, path, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    st.st_dev,
+                    st.st_ino,
+                    algo,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    digest,
+                    rel_path,
+                    time.time(),
+                ),
+            )
+
+    def record(self, abs_path, algo, digest):
+        """Remember a hash computed while writing `abs_path`."""
+        if algo not in HASH_ALGORITHMS or digest is None:
+            return
+        try:
+            st = os.stat(abs_path)
+            self._store(st, algo, digest, self.fs._rel_path(abs_path))
+        except Exception as e:
+            self.logger.warning("Hash cache record failed: {}".format(e))
+
+    def _compute(self, abs_path, st, algo):
+        started = time.monotonic()
+        digest = hash_file(abs_path, algo, self.chunk_size)
+        after = os.stat(abs_path)
+        if (after.st_ino, after.st_size, after.st_mtime_ns) == (
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            self._store(st, algo, digest, self.fs._rel_path(abs_path))
+        else:
+            # changed while hashing, the digest may mix old and new content
+            raise ValueError("File changed while hashing: {}".format(abs_path))
+        self.logger.debug(
+            "Hashed {} ({} bytes) in {:.3f}s".format(
+                abs_path, st.st_size, time.monotonic() - started
+            )
+        )
+        return digest
+
+    def submit(self, abs_path, algo="sha256"):
+        """Return (stat, cached digest or Future computing it)."""
+        st = os.stat(abs_path)
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError("{} is not a file".format(self.fs._rel_path(abs_path)))
+        digest = self._lookup(st, algo)
+        if digest is not None:
+            return st, digest
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algo)
+        with self.lock:
+            future = self.pending.get(key, None)
+            submitted = future is None
+            if submitted:
+                future = self.executor.submit(self._compute, abs_path, st, algo)
+                self.pending[key] = future
+        if submitted:
+            # runs right away when already done, so not under the lock
+            future.add_done_callback(lambda _: self._done(key))
+        return st, future
+
+    def _done(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def checksum(self, file_path, algo="sha256"):
+        if algo not in HASH_ALGORITHMS:
+            return False, "Unsupported algorithm {}, supported: {}".format(
+                algo, list(HASH_ALGORITHMS)
+            )
+        valid, abs_path = self.fs._validate_and_get_abs_path(file_path)
+        if not valid:
+            return valid, abs_path
+        try:
+            st, digest = self.submit(str(abs_path), algo)
+            cached = isinstance(digest, str)
+            if not cached:
+                digest = digest.result()
+        except FileNotFoundError:
+            return False, "File {} does not exist".format(file_path)
+        except Exception as e:
+            return False, str(e)
+        return True, {
+            "path": self.fs._rel_path(abs_path),
+            "size": st.st_size,
+            "algo": algo,
+            "digest": digest,
+            "cached": cached,
+        }
+
+    def apply(self, event, rel_path, is_dir=False):
+        """Change listener: hash new files ahead of time, forget deleted ones."""
+        if event == EVENT_DELETE:
+            with self._db() as conn:
+                conn.execute(
+                    "DELETE FROM hashes WHERE path=? OR path LIKE ?",
+                    (rel_path, os.path.join(rel_path, "%")),
+                )
+        elif event in (EVENT_CREATE, EVENT_MODIFY) and not is_dir and rel_path:
+            try:
+                self.submit(os.path.join(self.fs.root_path, rel_path))
+            except Exception:
+                pass
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from .archive import _skip
+
+
+class EventBus:
+    """
+    Ring buffer of change events with resumable ids.
+
+    Used as a change listener for both the API's own mutations and the file
+    watcher; an event identical to the previous one for the same path within
+    `dedupe_window` seconds is an echo of the other source and kept once.
+
+    Ids are nanosecond timestamps made strictly increasing, so a consumer can
+    resume with the last id it saw. Each worker process of a pre-fork server
+    has its own bus and ids, so ids are only valid against the worker that
+    issued them; an id newer than any this bus issued gets a reset, as does
+    one that fell out of the buffer, and the consumer should relist.
+    """
+
+    def __init__(self, maxlen=10000, dedupe_window=1.0):
+        self.events = deque(maxlen=maxlen)  # (id, event, rel_path, is_dir, time)
+        self.dedupe_window = dedupe_window
+        self.recent = {}  # rel_path -> last (event, is_dir, monotonic time)
+        self.last_id = time.time_ns()
+        self.first_id = self.last_id  # events after this id are all buffered
+        self.condition = threading.Condition()
+        self.async_waiters = set()  # (loop, asyncio.Event)
+        self.logger = logging.getLogger(__name__)
+
+    def publish(self, event, rel_path, is_dir=False):
+        """Change listener, see `FileManagementSystem.add_listener`."""
+        if any(_skip(part) for part in rel_path.split(os.sep)):
+            return
+        now = time.monotonic()
+        with self.condition:
+            last = self.recent.get(rel_path, None)
+            if (
+                last is not None
+                and last[:2] == (event, is_dir)
+                and now - last[2] < self.dedupe_window
+            ):
+                return
+            self.recent[rel_path] = (event, is_dir, now)
+            if len(self.recent) > self.events.maxlen:
+                self.recent = {
+                    k: last
+                    for k, last in self.recent.items()
+                    if now - last[2] < self.dedupe_window
+                }
+            event_id = max(self.last_id + 1, time.time_ns())
+            if len(self.events) == self.events.maxlen:
+                self.first_id = self.events[0][0]
+            self.events.append((event_id, event, rel_path, is_dir, time.time()))
+            self.last_id = event_id
+            self.condition.notify_all()
+            waiters = list(self.async_waiters)
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def _format(self, item):
+        event_id, event, rel_path, is_dir, timestamp = item
+        return {
+            "id": str(event_id),
+            "event": event,
+            "path": rel_path,
+            "is_dir": is_dir,
+            "time": timestamp,
+        }
+
+    def _since(self, last_id, path=""):
+        with self.condition:
+            reset = last_id < self.first_id or last_id > self.last_id
+            prefix = os.path.join(path, "") if path else ""
+            events = [
+                self._format(item)
+                for item in self.events
+                if item[0] > last_id
+                and (not prefix or item[2] == path or item[2].startswith(prefix))
+            ]
+            return events, reset, self.last_id
+
+    def since(self, last_id=None, path=""):
+        """Return (events after last_id under path, reset) without blocking."""
+        if last_id is None:
+            return [], False
+        events, reset, _ = self._since(last_id, path)
+        return events, reset
+
+    def wait(self, last_id, path="", timeout=30.0):
+        """Block until there are events after last_id under path, or timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            events, reset, seen = self._since(last_id, path)
+            remaining = deadline - time.monotonic()
+            if events or reset or remaining <= 0:
+                return events, reset
+            # events under other paths are skipped for good
+            last_id = seen
+            with self.condition:
+                if self.last_id <= last_id:
+                    self.condition.wait(remaining)
+
+    async def wait_async(self, last_id, path="", timeout=30.0):
+        """`wait` for asyncio servers, without holding a thread."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.async_waiters.add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                events, reset, seen = self._since(last_id, path)
+                remaining = deadline - time.monotonic()
+                if events or reset or remaining <= 0:
+                    return events, reset
+                last_id = seen
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+
+    def parse_id(self, value):
+        """Parse a client supplied id, None meaning from now on."""
+        if value is None or value == "":
+            return None
+        return int(value)
+
+    def sse(self, events, reset=False):
+        """Format events as a Server-Sent Events chunk."""
+        lines = []
+        if reset:
+            lines.append("event: reset\ndata: {}\n\n")
+        for event in events:
+            lines.append(
+                "id: {}\nevent: {}\ndata: {}\n\n".format(
+                    event["id"], event["event"], json.dumps(event)
+                )
+            )
+        return "".join(lines)
+
+    def stream(self, last_id, path="", keepalive=15.0):
+        """Yield SSE chunks forever, starting after last_id (None: from now)."""
+        if last_id is None:
+            last_id = self.last_id
+        yield "retry: 3000\n\n"
+        while True:
+            events, reset = self.wait(last_id, path, keepalive)
+            if events:
+                last_id = int(events[-1]["id"])
+            elif reset:
+                last_id = self.first_id
+            yield self.sse(events, reset) if events or reset else ": keepalive\n\n"
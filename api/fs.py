@@ -1,16 +1,35 @@
 import os
+import json
+import stat
+import uuid
+import heapq
+import base64
 import shutil
+import hashlib
 import logging
 from pathlib import Path
+from .watch import EVENT_CREATE, EVENT_MODIFY, EVENT_DELETE
+
+ENTRY_FIELDS = ("name", "is_dir", "path", "size", "mtime")
+DEFAULT_ENTRY_FIELDS = ("name", "is_dir", "path", "size")
+SORT_FIELDS = ("name", "size", "mtime")
+# types of the first item of the (value, name) sort key of each sort field
+SORT_KEY_TYPES = {"name": (str,), "size": (int,), "mtime": (int, float)}
 
 
 class FileManagementSystem:
     def __init__(
-        self, root_path, retry_count=1, read_max_bytes=1024 * 1024, debug=False
+        self,
+        root_path,
+        retry_count=1,
+        read_max_bytes=1024 * 1024,
+        write_chunk_size=1024 * 1024,
+        debug=False,
     ):
         self.root_path = os.path.abspath(root_path)
         self.retry_count = retry_count
         self.read_max_bytes = read_max_bytes
+        self.write_chunk_size = write_chunk_size
         if not os.path.isdir(self.root_path):
             raise FileNotFoundError("Specified root path does not exist.")
         logging.basicConfig(
@@ -20,11 +39,115 @@ class FileManagementSystem:
             handlers=[logging.StreamHandler()],
         )
         self.logger = logging.getLogger(__name__)
+        self.listeners = []
+        self.index = None
+        self.hash_cache = None
+        self.usage = None
+
+    def add_listener(self, listener):
+        """Register `listener(event, rel_path, is_dir)` called on every mutation."""
+        self.listeners.append(listener)
+
+    def set_index(self, index):
+        """Answer list and search from `index`, keeping it updated on mutations."""
+        self.index = index
+        self.add_listener(index.apply)
+
+    def set_hash_cache(self, hash_cache):
+        """Record hashes computed on write in `hash_cache`, see `record_hash`."""
+        self.hash_cache = hash_cache
+
+    def set_usage(self, usage):
+        """Check writes against `usage` quotas, keeping it updated on mutations."""
+        self.usage = usage
+        self.add_listener(usage.apply)
+
+    def check_space(self, abs_path, size=None, is_dir=False):
+        """
+        Check that `size` bytes (None when unknown) fit at abs_path before
+        writing them, see `UsageTracker.check`.
+
+        Returns (True, max size allowed or None) or (False, error).
+        """
+        if self.usage is None:
+            return True, None
+        return self.usage.check(self._rel_path(abs_path), size, is_dir)
+
+    def record_hash(self, abs_path, hash_name, digest):
+        if self.hash_cache is not None:
+            self.hash_cache.record(abs_path, hash_name, digest)
+
+    def notify(self, event, abs_path, is_dir=False):
+        rel_path = self._rel_path(abs_path)
+        for listener in self.listeners:
+            try:
+                listener(event, rel_path, is_dir)
+            except Exception as e:
+                self.logger.warning("Listener error: {}".format(e))
+
+    def _rel_path(self, abs_path):
+        rel_path = os.path.relpath(abs_path, self.root_path)
+        return "" if rel_path == "." else rel_path
+
+    def _path_info(self, path):
+        st = path.stat()
+        is_dir = stat.S_ISDIR(st.st_mode)
+        return {
+            "name": path.name,
+            "is_dir": is_dir,
+            "path": self._rel_path(path),
+            "size": None if is_dir else st.st_size,
+        }
+
+    def _entry_field(self, entry, field):
+        """Field of an os.DirEntry, which caches is_dir and stat results."""
+        if field == "name":
+            return entry.name
+        if field == "path":
+            return self._rel_path(entry.path)
+        is_dir = entry.is_dir()
+        if field == "is_dir":
+            return is_dir
+        if field == "size":
+            return None if is_dir else entry.stat().st_size
+        if field == "mtime":
+            return entry.stat().st_mtime
+        raise KeyError(field)
+
+    def _entry_info(self, entry, fields=DEFAULT_ENTRY_FIELDS):
+        return {field: self._entry_field(entry, field) for field in fields}
+
+    def _entry_sort_key(self, entry, sort_field):
+        value = self._entry_field(entry, sort_field)
+        return (-1 if value is None else value, entry.name)
+
+    def _scandir(self, path):
+        """Validate path and open it for a lazy os.scandir walk."""
+        valid, target_dir = (
+            (True, Path(self.root_path))
+            if path is None
+            else self._validate_and_get_abs_path(path)
+        )
+        if not valid:
+            return valid, target_dir
+        # opened here so a missing directory fails before iteration starts
+        it = os.scandir(target_dir)
+
+        def entries():
+            with it:
+                yield from it
+
+        return True, entries()
 
     def _validate_and_get_abs_path(self, path):
-        abs_path = Path(self.root_path) / path
+        # Normalise `..` away, then also check the resolved path so that a
+        # symlink cannot lead outside of the root. The unresolved path is
+        # returned so that operations on a link act on the link itself.
+        abs_path = Path(os.path.normpath(os.path.join(self.root_path, path)))
         if not abs_path.is_relative_to(self.root_path):
             return False, "Invalid path"
+        if not abs_path.resolve().is_relative_to(os.path.realpath(self.root_path)):
+            return False, "Invalid path"
         return True, abs_path
 
     def _safe_operation(self, func, *args, **kwargs):
@@ -48,6 +171,7 @@ class FileManagementSystem:
         if not op_valid:
             return op_valid, op_msg
         self.logger.info("File {} has been deleted.".format(abs_path))
+        self.notify(EVENT_DELETE, abs_path)
         return True, None
 
     def delete_folder(self, folder_path, recursive=True):
@@ -60,6 +184,7 @@ class FileManagementSystem:
         if not op_valid:
             return op_valid, op_msg
         self.logger.info("Folder deleted: {}".format(abs_path))
+        self.notify(EVENT_DELETE, abs_path, True)
         return True, None
 
     def create_folder(self, folder_path):
@@ -72,27 +197,81 @@ class FileManagementSystem:
         if not op_valid:
             return op_valid, op_msg
         self.logger.info("Folder created: {}".format(abs_path))
+        self.notify(EVENT_CREATE, abs_path, True)
         return True, None
 
-    def search(self, pattern, path=None):
-        """Search for files or folders by name pattern."""
-        search_dir = (
-            Path(self.root_path)
+    def search(self, pattern, path=None, substring=False):
+        """Search for files or folders by name pattern, or by name substring."""
+        valid, search_dir = (
+            (True, Path(self.root_path))
             if path is None
-            else self._validate_and_get_abs_path(path)[1]
+            else self._validate_and_get_abs_path(path)
         )
-        if not search_dir:
-            return False, "Invalid path"
-        results = [
-            {
-                "name": p.name,
-                "is_dir": p.is_dir(),
-                "path": str(p.relative_to(self.root_path)),
-                "size": p.stat().st_size if not p.is_dir() else None,
-            }
-            for p in search_dir.glob(pattern)
-        ]
-        return True, results
+        if not valid:
+            return valid, search_dir
+        if self.index is not None:
+            results = self.index.search(pattern, self._rel_path(search_dir), substring)
+            if results is not None:
+                return True, results
+        if substring:
+            key = pattern.lower()
+            paths = (p for p in search_dir.rglob("*") if key in p.name.lower())
+        else:
+            paths = search_dir.glob(pattern)
+        return True, [self._path_info(p) for p in paths]
+
+    def open_writer(
+        self,
+        file_path,
+        max_size=None,
+        hash_name="sha256",
+        expected_hash=None,
+        size=None,
+    ):
+        """Open a `FileWriter` for file_path, see `write_stream`."""
+        valid, abs_path = self._validate_and_get_abs_path(file_path)
+        if not valid:
+            return valid, abs_path
+        try:
+            fits, limit = self.check_space(abs_path, size)
+            if not fits:
+                return fits, limit
+            if limit is not None and (max_size is None or limit < max_size):
+                max_size = limit
+            return True, FileWriter(self, abs_path, max_size, hash_name, expected_hash)
+        except Exception as e:
+            return False, str(e)
+
+    def write_stream(
+        self,
+        file_path,
+        stream,
+        max_size=None,
+        hash_name="sha256",
+        expected_hash=None,
+        size=None,
+    ):
+        """Write a stream to file in chunks, hashing on the fly.
+
+        Data goes to a `.filepart` temp file next to the target which is then
+        atomically renamed over it, so readers never see a partial file.
+        A known `size` is checked against quotas before anything is written.
+        """
+        success, writer = self.open_writer(
+            file_path, max_size, hash_name, expected_hash, size
+        )
+        if not success:
+            return success, writer
+        try:
+            while True:
+                chunk = stream.read(self.write_chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+            return True, writer.commit()
+        except Exception as e:
+            writer.discard()
+            return False, str(e)
 
     def read_file_content(self, file_path):
         """Read file content safely, limiting size to prevent memory overflow."""
@@ -108,22 +287,154 @@ class FileManagementSystem:
 
     def list_path_contents(self, path=None):
         """List directory contents."""
-        target_dir = (
-            Path(self.root_path)
+        valid, target_dir = (
+            (True, Path(self.root_path))
             if path is None
-            else self._validate_and_get_abs_path(path)[1]
+            else self._validate_and_get_abs_path(path)
         )
-        if not target_dir:
-            return False, "Invalid path"
-        return True, [
-            {
-                "name": entry.name,
-                "is_dir": entry.is_dir(),
-                "path": str(entry.relative_to(self.root_path)),
-                "size": entry.stat().st_size if not entry.is_dir() else None,
-            }
-            for entry in target_dir.iterdir()
-        ]
+        if not valid:
+            return valid, target_dir
+        if self.index is not None:
+            results = self.index.list(self._rel_path(target_dir))
+            if results is not None:
+                return True, results
+        with os.scandir(target_dir) as it:
+            return True, [self._entry_info(entry) for entry in it]
+
+    def iter_path_contents(self, path=None, fields=None):
+        """Lazily list directory contents in directory order."""
+        fields = DEFAULT_ENTRY_FIELDS if fields is None else fields
+        if any(field not in ENTRY_FIELDS for field in fields):
+            return False, "Invalid fields, supported: {}".format(ENTRY_FIELDS)
+        success, entries_or_error = self._scandir(path)
+        if not success:
+            return success, entries_or_error
+        return True, (self._entry_info(entry, fields) for entry in entries_or_error)
+
+    def decode_cursor(self, cursor, sort="name"):
+        """Decode a `next_cursor` token into the sort key it continues after."""
+        sort_field = sort.lstrip("-")
+        if sort_field not in SORT_FIELDS:
+            return False, "Invalid sort, supported: {}".format(SORT_FIELDS)
+        try:
+            after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            return False, "Invalid cursor"
+        if (
+            not isinstance(after, list)
+            or len(after) != 2
+            or isinstance(after[0], bool)
+            or not isinstance(after[0], SORT_KEY_TYPES[sort_field])
+            or not isinstance(after[1], str)
+        ):
+            return False, "Invalid cursor"
+        return True, tuple(after)
+
+    def list_path_page(
+        self, path=None, limit=100, cursor=None, sort="name", fields=None
+    ):
+        """
+        List one page of directory contents ordered by `sort` ("name", "size"
+        or "mtime", prefixed with "-" for descending).
+
+        Only `limit` entries are held in memory. `next_cursor` in the result
+        is an opaque token to pass back as `cursor` for the following page.
+        """
+        fields = DEFAULT_ENTRY_FIELDS if fields is None else fields
+        if any(field not in ENTRY_FIELDS for field in fields):
+            return False, "Invalid fields, supported: {}".format(ENTRY_FIELDS)
+        reverse = sort.startswith("-")
+        sort_field = sort.lstrip("-")
+        if sort_field not in SORT_FIELDS:
+            return False, "Invalid sort, supported: {}".format(SORT_FIELDS)
+        if limit <= 0:
+            return False, "Invalid limit"
+        after = None
+        if cursor:
+            valid, after = self.decode_cursor(cursor, sort)
+            if not valid:
+                return valid, after
+        success, entries_or_error = self._scandir(path)
+        if not success:
+            return success, entries_or_error
+        keyed = (
+            (self._entry_sort_key(entry, sort_field), entry)
+            for entry in entries_or_error
+        )
+        if after is not None:
+            keyed = (
+                item
+                for item in keyed
+                if (item[0] < after if reverse else item[0] > after)
+            )
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        page = select(limit + 1, keyed, key=lambda item: item[0])
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = base64.urlsafe_b64encode(
+                json.dumps(page[-1][0]).encode()
+            ).decode()
+        return True, {
+            "items": [self._entry_info(entry, fields) for _, entry in page],
+            "next_cursor": next_cursor,
+        }
+
+
+class FileWriter:
+    """
+    Write a file through a `.filepart` temp file next to it, hashing the
+    data as it goes. `commit` renames the temp file over the target and
+    `discard` drops it. Callers feed chunks with `write`, which lets async
+    servers do each write on an executor.
+    """
+
+    def __init__(
+        self, fs, abs_path, max_size=None, hash_name="sha256", expected_hash=None
+    ):
+        self.fs = fs
+        self.abs_path = abs_path
+        self.max_size = max_size
+        self.hash_name = hash_name
+        self.expected_hash = expected_hash
+        self.temp_path = abs_path.parent / f"{abs_path.name}-{uuid.uuid4()}.filepart"
+        self.hasher = hashlib.new(hash_name)
+        self.size = 0
+        abs_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = self.temp_path.open("wb")
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError("File exceeds max upload size {}".format(self.max_size))
+        self.hasher.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        digest = self.hasher.hexdigest()
+        if self.expected_hash is not None and self.expected_hash.lower() != digest:
+            raise ValueError(
+                "Checksum mismatch: {} != {}".format(self.expected_hash, digest)
+            )
+        existed = self.abs_path.exists()
+        os.replace(self.temp_path, self.abs_path)
+        self.fs.record_hash(self.abs_path, self.hash_name, digest)
+        self.fs.logger.info(
+            "File written: {} ({} bytes)".format(self.abs_path, self.size)
+        )
+        self.fs.notify(EVENT_MODIFY if existed else EVENT_CREATE, self.abs_path)
+        return {
+            "path": self.fs._rel_path(self.abs_path),
+            "size": self.size,
+            self.hash_name: digest,
+        }
+
+    def discard(self):
+        self.file.close()
+        self.temp_path.unlink(missing_ok=True)
 
 
 # Usage example
@@ -0,0 +1,165 @@
+import os
+import stat
+import logging
+import threading
+from fnmatch import fnmatchcase
+from .watch import (
+    EVENT_CREATE,
+    EVENT_MODIFY,
+    EVENT_DELETE,
+    EVENT_RESCAN,
+    scan_tree,
+)
+
+
+class FileIndex:
+    """
+    In-memory index of the file tree under root_path.
+
+    Built once with `os.scandir` and kept current by feeding it change
+    events, see `apply`. Directory listings and searches are then answered
+    without touching the disk.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = os.path.abspath(root_path)
+        self.entries = {}  # rel_path -> (is_dir, size, mtime_ns)
+        self.children = {"": set()}  # rel dir path -> child names
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger(__name__)
+
+    def build(self):
+        entries = {}
+        children = {"": set()}
+        for rel_path, is_dir, size, mtime_ns in scan_tree(self.root_path):
+            parent, name = os.path.split(rel_path)
+            entries[rel_path] = (is_dir, size, mtime_ns)
+            children.setdefault(parent, set()).add(name)
+            if is_dir:
+                children.setdefault(rel_path, set())
+        with self.lock:
+            self.entries = entries
+            self.children = children
+        self.logger.info(
+            "Indexed {} entries under {}".format(len(entries), self.root_path)
+        )
+
+    def _add(self, rel_path):
+        try:
+            st = os.stat(os.path.join(self.root_path, rel_path))
+        except OSError:
+            self._remove(rel_path)
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        parent, name = os.path.split(rel_path)
+        if parent and parent not in self.entries:
+            self._add(parent)
+        self.entries[rel_path] = (
+            is_dir,
+            None if is_dir else st.st_size,
+            st.st_mtime_ns,
+        )
+        self.children.setdefault(parent, set()).add(name)
+        if is_dir and rel_path not in self.children:
+            self.children[rel_path] = set()
+            for sub_path, sub_is_dir, size, mtime_ns in scan_tree(
+                self.root_path, rel_path
+            ):
+                sub_parent, sub_name = os.path.split(sub_path)
+                self.entries[sub_path] = (sub_is_dir, size, mtime_ns)
+                self.children.setdefault(sub_parent, set()).add(sub_name)
+                if sub_is_dir:
+                    self.children.setdefault(sub_path, set())
+
+    def _remove(self, rel_path):
+        if rel_path not in self.entries:
+            return
+        for name in self.children.pop(rel_path, ()):
+            self._remove(os.path.join(rel_path, name))
+        self.entries.pop(rel_path, None)
+        parent, name = os.path.split(rel_path)
+        self.children.get(parent, set()).discard(name)
+
+    def apply(self, event, rel_path, is_dir=False):
+        """Update the index from a change event, see `watch.FileWatcher`."""
+        rel_path = os.path.normpath(rel_path) if rel_path else ""
+        if rel_path == ".":
+            rel_path = ""
+        if event == EVENT_RESCAN or (event == EVENT_CREATE and rel_path == ""):
+            self.build()
+            return
+        with self.lock:
+            if event == EVENT_DELETE:
+                self._remove(rel_path)
+            elif event in (EVENT_CREATE, EVENT_MODIFY) and rel_path:
+                self._add(rel_path)
+
+    def _info(self, rel_path, name=None):
+        is_dir, size, mtime_ns = self.entries[rel_path]
+        return {
+            "name": os.path.basename(rel_path) if name is None else name,
+            "is_dir": is_dir,
+            "path": rel_path,
+            "size": size,
+        }
+
+    def list(self, rel_dir):
+        """List a directory, or return None when it is not an indexed dir."""
+        with self.lock:
+            names = self.children.get(rel_dir, None)
+            if names is None:
+                return None
+            return [
+                self._info(os.path.join(rel_dir, name) if rel_dir else name, name)
+                for name in sorted(names)
+            ]
+
+    def _glob(self, rel_dir, parts):
+        if not parts:
+            yield rel_dir
+            return
+        part, rest = parts[0], parts[1:]
+        if part == "**":
+            # zero or more directories, like Path.glob
+            stack = [rel_dir]
+            while stack:
+                current = stack.pop()
+                yield from self._glob(current, rest)
+                for name in self.children.get(current, ()):
+                    sub_path = os.path.join(current, name) if current else name
+                    if sub_path in self.children:
+                        stack.append(sub_path)
+            return
+        names = self.children.get(rel_dir, None)
+        if names is None:
+            return
+        for name in names:
+            if fnmatchcase(name, part):
+                yield from self._glob(
+                    os.path.join(rel_dir, name) if rel_dir else name, rest
+                )
+
+    def search(self, pattern, rel_dir="", substring=False):
+        """Glob (Path.glob semantics) or case-insensitive substring search."""
+        with self.lock:
+            if rel_dir and rel_dir not in self.children:
+                return None
+            if substring:
+                key = pattern.lower()
+                prefix = os.path.join(rel_dir, "") if rel_dir else ""
+                matches = [
+                    rel_path
+                    for rel_path in self.entries
+                    if rel_path.startswith(prefix)
+                    and key in os.path.basename(rel_path).lower()
+                ]
+            else:
+                parts = [p for p in pattern.split("/") if p not in ("", ".")]
+                dirs_only = bool(parts) and parts[-1] == "**"
+                matches = {
+                    rel_path
+                    for rel_path in self._glob(rel_dir, parts)
+                    if rel_path in self.entries
+                    and (not dirs_only or self.entries[rel_path][0])
+                }
+            return [self._info(rel_path) for rel_path in sorted(matches)]
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from .watch import EVENT_CREATE, EVENT_DELETE, scan_tree
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_FINISHED = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+JOB_FIELDS = (
+    "id",
+    "op",
+    "args",
+    "status",
+    "progress",
+    "message",
+    "result",
+    "cancel_requested",
+    "created",
+    "started",
+    "finished",
+)
+
+
+def _process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # exists, owned by another user
+        return True
+    return True
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """Handle passed to a running operation to report progress and see cancels."""
+
+    def __init__(self, manager, job_id):
+        self.manager = manager
+        self.id = job_id
+        self.cancel_event = threading.Event()
+        self._last_update = 0.0
+
+    def progress(self, done, total, message=None):
+        """Record progress, throttled to one job log write per interval."""
+        now = time.monotonic()
+        if now - self._last_update < self.manager.update_interval and done < total:
+            return
+        self._last_update = now
+        progress = 1.0 if total <= 0 else min(1.0, done / total)
+        cancel_requested = self.manager._update(
+            self.id, progress=progress, message=message
+        )
+        if cancel_requested:
+            self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled("Job {} cancelled".format(self.id))
+
+
+class JobManager:
+    """
+    Run long file operations on a worker pool as background jobs.
+
+    `submit` returns a job id right away. Status, progress and results are
+    written to a SQLite job log, so they can be read from any worker process
+    and survive restarts; cancellation is requested through the log as well
+    and honoured by operations at their next progress check.
+    """
+
+    def __init__(self, fs, db_path=None, workers=2, update_interval=1.0, uploads=None):
+        self.fs = fs
+        self.uploads = uploads
+        if db_path is None:
+            # one log per served root, the worker processes of an instance share it
+            db_path = os.path.join(
+                tempfile.gettempdir(),
+                "tftp-api-jobs-{}.sqlite".format(
+                    hashlib.sha1(fs.root_path.encode()).hexdigest()[:12]
+                ),
+            )
+        self.db_path = os.path.abspath(db_path)
+        self.workers = workers
+        self.update_interval = update_interval
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="api-job"
+        )
+        self.running = {}  # job id -> Job, for jobs of this process
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.ops = {
+            "delete_file": self._op_delete_file,
+            "delete_folder": self._op_delete_folder,
+            "create_folder": self._op_create_folder,
+            "search": self._op_search,
+        }
+        if uploads is not None:
+            self.ops["upload_commit"] = self._op_upload_commit
+        self._init_db()
+
+    @contextlib.contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, op TEXT, args TEXT, status TEXT, "
+                "progress REAL, message TEXT, result TEXT, "
+                "cancel_requested INTEGER DEFAULT 0, "
+                "created REAL, started REAL, finished REAL, pid INTEGER)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "pid" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN pid INTEGER")
+            # jobs of a previous run can not be resumed, those of live processes
+            # sharing the log are left alone
+            now = time.time()
+            interrupted = [
+                (JOB_FAILED, "Interrupted by restart", now, job_id)
+                for job_id, pid in conn.execute(
+                    "SELECT id, pid FROM jobs WHERE status IN (?, ?)",
+                    (JOB_PENDING, JOB_RUNNING),
+                ).fetchall()
+                if not _process_alive(pid)
+            ]
+            conn.executemany(
+                "UPDATE jobs SET status=?, message=?, finished=? WHERE id=?",
+                interrupted,
+            )
+
+    def _update(self, job_id, **fields):
+        """Update job fields, returning whether a cancel was requested."""
+        for key in ("args", "result"):
+            if key in fields:
+                fields[key] = json.dumps(fields[key])
+        with self._db() as conn:
+            if fields:
+                conn.execute(
+                    "UPDATE jobs SET {} WHERE id=?".format(
+                        ", ".join("{}=?".format(key) for key in fields)
+                    ),
+                    tuple(fields.values()) + (job_id,),
+                )
+            row = conn.execute(
+                "SELECT cancel_requested FROM jobs WHERE id=?", (job_id,)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def _row_to_job(self, row):
+        job = dict(zip(JOB_FIELDS, row))
+        for key in ("args", "result"):
+            job[key] = None if job[key] is None else json.loads(job[key])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def submit(self, op, args=None):
+        """Queue `op` with keyword `args`, returning the new job."""
+        if op not in self.ops:
+            return False, "Unsupported job operation {}, supported: {}".format(
+                op, sorted(self.ops)
+            )
+        args = {} if args is None else dict(args)
+        job_id = uuid.uuid4().hex
+        with self._db() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, op, args, status, progress, created, pid) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    op,
+                    json.dumps(args),
+                    JOB_PENDING,
+                    0.0,
+                    time.time(),
+                    os.getpid(),
+                ),
+            )
+        job = Job(self, job_id)
+        with self.lock:
+            self.running[job_id] = job
+        self.executor.submit(self._run, job, op, args)
+        self.logger.info("Job {} queued: {} {}".format(job_id, op, args))
+        return self.status(job_id)
+
+    def _run(self, job, op, args):
+        try:
+            if self._update(job.id, status=JOB_RUNNING, started=time.time()):
+                raise JobCancelled("Job {} cancelled".format(job.id))
+            success, result = self.ops[op](job, **args)
+            if success:
+                self._update(
+                    job.id,
+                    status=JOB_DONE,
+                    progress=1.0,
+                    result=result,
+                    finished=time.time(),
+                )
+            else:
+                self._update(
+                    job.id, status=JOB_FAILED, message=result, finished=time.time()
+                )
+        except JobCancelled as e:
+            self._update(
+                job.id, status=JOB_CANCELLED, message=str(e), finished=time.time()
+            )
+        except Exception as e:
+            self._update(
+                job.id, status=JOB_FAILED, message=str(e), finished=time.time()
+            )
+        finally:
+            with self.lock:
+                self.running.pop(job.id, None)
+        self.logger.info("Job {} finished".format(job.id))
+
+    def status(self, job_id):
+        with self._db() as conn:
+            row = conn.execute(
+                "SELECT {} FROM jobs WHERE id=?".format(", ".join(JOB_FIELDS)),
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return False, "Job {} not found".format(job_id)
+        return True, self._row_to_job(row)
+
+    def list(self, status=None, limit=100):
+        query = "SELECT {} FROM jobs".format(", ".join(JOB_FIELDS))
+        params = ()
+        if status is not None:
+            query += " WHERE status=?"
+            params = (status,)
+        query += " ORDER BY created DESC LIMIT ?"
+        with self._db() as conn:
+            rows = conn.execute(query, params + (limit,)).fetchall()
+        return True, [self._row_to_job(row) for row in rows]
+
+    def cancel(self, job_id):
+        """Request cancellation; a running job stops at its next progress check."""
+        with self._db() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET cancel_requested=1 WHERE id=? AND status IN (?, ?)",
+                (job_id, JOB_PENDING, JOB_RUNNING),
+            ).rowcount
+        with self.lock:
+            job = self.running.get(job_id, None)
+        if job is not None:
+            job.cancel_event.set()
+        if not updated:
+            found, job_or_error = self.status(job_id)
+            if not found:
+                return found, job_or_error
+        return self.status(job_id)
+
+    # operations, called as op(job, **args) -> (success, result_or_error)
+
+    def _op_delete_file(self, job, path=None):
+        if path is None:
+            return False, "Request parameter missing"
+        return self.fs.delete_file(path)
+
+    def _op_create_folder(self, job, path=""):
+        return self.fs.create_folder(path)
+
+    def _op_delete_folder(self, job, path=""):
+        """Remove a tree bottom-up, reporting progress per entry."""
+        valid, abs_path = self.fs._validate_and_get_abs_path(path)
+        if not valid:
+            return valid, abs_path
+        if not abs_path.is_dir():
+            return False, "Folder {} does not exist".format(path)
+        rel_dir = self.fs._rel_path(abs_path)
+        entries = list(scan_tree(self.fs.root_path, rel_dir))
+        entries.sort(key=lambda entry: entry[0].count(os.sep), reverse=True)
+        total = len(entries) + 1
+        try:
+            for done, (rel_path, is_dir, _, _) in enumerate(entries):
+                job.check_cancelled()
+                entry_path = os.path.join(self.fs.root_path, rel_path)
+                if is_dir and not os.path.islink(entry_path):
+                    os.rmdir(entry_path)
+                else:
+                    os.unlink(entry_path)
+                job.progress(done + 1, total)
+            job.check_cancelled()
+            os.rmdir(abs_path)
+        except Exception:
+            # partially deleted, let listeners pick up what is left
+            self.fs.notify(EVENT_DELETE, abs_path, True)
+            if abs_path.exists():
+                self.fs.notify(EVENT_CREATE, abs_path, True)
+            raise
+        self.fs.logger.info("Folder deleted: {}".format(abs_path))
+        self.fs.notify(EVENT_DELETE, abs_path, True)
+        return True, {"path": rel_dir, "deleted": total}
+
+    def _op_search(self, job, key=None, path="", mode="glob"):
+        if key is None or mode not in ("glob", "substring"):
+            return False, "Request parameter missing"
+        return self.fs.search(key, path, substring=mode == "substring")
+
+    def _op_upload_commit(self, job, id=None):
+        return self.uploads.commit(id)
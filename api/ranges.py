@@ -0,0 +1,215 @@
+import os
+import stat
+import uuid
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+# Upper bound of ranges served in one multipart/byteranges response.
+MAX_RANGES = 64
+
+
+def make_etag(st):
+    """Strong ETag derived from inode, mtime and size."""
+    return '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def _parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etag_list(value):
+    return [tag.strip() for tag in value.split(",") if tag.strip()]
+
+
+def _weak_match(etag, value):
+    """Weak comparison used by If-None-Match."""
+    if value.strip() == "*":
+        return True
+
+    def opaque(tag):
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return any(opaque(tag) == opaque(etag) for tag in _etag_list(value))
+
+
+def is_not_modified(headers, etag, mtime):
+    """Evaluate If-None-Match, or If-Modified-Since when it is absent."""
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match:
+        return _weak_match(etag, if_none_match)
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since:
+        since = _parse_http_date(if_modified_since)
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def _if_range_matches(headers, etag, mtime):
+    if_range = headers.get("If-Range")
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # If-Range requires strong comparison
+        return if_range == etag
+    since = _parse_http_date(if_range)
+    return since is not None and int(mtime) == since
+
+
+def parse_range(value, size):
+    """
+    Parse a `bytes=` Range header against a file size.
+
+    Returns None when the header is absent or malformed (serve the whole
+    file), an empty list when no range is satisfiable, otherwise a sorted
+    list of coalesced (start, end) pairs with `end` exclusive. More than
+    MAX_RANGES ranges are not truncated: the header is ignored as a whole
+    and None is returned, which RFC 9110 allows.
+    """
+    if not value:
+        return None
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if first.strip() == "":
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                start, end = max(0, size - suffix), size
+            else:
+                start = int(first)
+                end = None if last.strip() == "" else int(last) + 1
+                if start < 0 or (end is not None and end <= start):
+                    return None
+                if end is None:
+                    end = size
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size)))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def content_disposition(filename):
+    ascii_name = filename.encode("ascii", "replace").decode("ascii").replace('"', "")
+    return "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(
+        ascii_name, quote(filename)
+    )
+
+
+def iter_file_range(path, start, end, chunk_size):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _multipart_parts(ranges, size, content_type, boundary):
+    for start, end in ranges:
+        head = (
+            "--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n".format(
+                boundary, content_type, start, end - 1, size
+            )
+        ).encode("ascii")
+        yield head, start, end
+
+
+def iter_multipart(path, ranges, size, content_type, boundary, chunk_size):
+    for head, start, end in _multipart_parts(ranges, size, content_type, boundary):
+        yield head
+        yield from iter_file_range(path, start, end, chunk_size)
+        yield b"\r\n"
+    yield "--{}--\r\n".format(boundary).encode("ascii")
+
+
+def prepare_download(path, headers, chunk_size=1024 * 1024):
+    """
+    Work out the reply to a GET of `path` given the request headers.
+
+    Returns (status, response_headers, body) where body is None for replies
+    without content, the string "file" when the whole file should be sent
+    (so the server can use its zero-copy file path), or an iterator of bytes.
+    """
+    st = os.stat(path)
+    if not stat.S_ISREG(st.st_mode):
+        raise FileNotFoundError("File is not exist")
+    etag = make_etag(st)
+    response_headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(st.st_mtime),
+        "Accept-Ranges": "bytes",
+    }
+    if is_not_modified(headers, etag, st.st_mtime):
+        return 304, response_headers, None
+
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    response_headers["Content-Disposition"] = content_disposition(
+        os.path.basename(path)
+    )
+    ranges = None
+    if _if_range_matches(headers, etag, st.st_mtime):
+        ranges = parse_range(headers.get("Range"), st.st_size)
+    if ranges is None:
+        response_headers["Content-Type"] = content_type
+        response_headers["Content-Length"] = str(st.st_size)
+        return 200, response_headers, "file"
+    if not ranges:
+        response_headers["Content-Range"] = "bytes */{}".format(st.st_size)
+        return 416, response_headers, None
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response_headers["Content-Type"] = content_type
+        response_headers["Content-Range"] = "bytes {}-{}/{}".format(
+            start, end - 1, st.st_size
+        )
+        response_headers["Content-Length"] = str(end - start)
+        return 206, response_headers, iter_file_range(path, start, end, chunk_size)
+    boundary = uuid.uuid4().hex
+    length = len("--{}--\r\n".format(boundary))
+    for head, start, end in _multipart_parts(
+        ranges, st.st_size, content_type, boundary
+    ):
+        length += len(head) + (end - start) + 2
+    response_headers["Content-Type"] = "multipart/byteranges; boundary={}".format(
+        boundary
+    )
+    response_headers["Content-Length"] = str(length)
+    return (
+        206,
+        response_headers,
+        iter_multipart(path, ranges, st.st_size, content_type, boundary, chunk_size),
+    )
@@ -5,15 +5,22 @@ import argparse
 import uuid
 
 try:
-    from . import api
+    from . import api, aio
 except:
-    from api import api
+    from api import api, aio
 
 SETTINGS = {
     "ROOT_PATH": "files",
     "API_NAME": "api",
     "API_HOST": "localhost",
     "API_PORT": 5000,
+    "API_SERVER": "flask",
+    "API_WORKERS": None,
+    "API_THREADS": 4,
+    "API_TIMEOUT": 60,
+    "API_KEEPALIVE": 5,
+    "API_IO_WORKERS": 8,
+    "API_BULK_WORKERS": 2,
     "API_SUPPORT_DELETE_FILE": True,
     "API_SUPPORT_DELETE_FOLDER": False,
     "API_SUPPORT_CREATE_FOLDER": True,
@@ -21,12 +28,35 @@ SETTINGS = {
     "API_SUPPORT_SEARCH_FILE": True,
     "API_SUPPORT_UPLOAD_FILE": True,
     "API_SUPPORT_DOWNLOAD_FILE": True,
+    "API_SUPPORT_JOBS": True,
     "API_FILE_UPLOAD_MAX_SIZE": 1024000,
+    "API_STREAM_UPLOAD_MAX_SIZE": 0,
+    "API_ARCHIVE_MAX_SIZE": 0,
+    "API_UPLOAD_SESSION_DIR": None,
+    "API_FS_INDEX": False,
+    "API_FS_WATCH": "auto",
+    "API_FS_POLL_INTERVAL": 5.0,
+    "API_JOBS_DB": None,
+    "API_JOBS_WORKERS": 2,
+    "API_SUPPORT_BATCH": True,
+    "API_BATCH_MAX_OPERATIONS": 1000,
+    "API_BATCH_MAX_CONCURRENCY": 8,
+    "API_SUPPORT_CHECKSUM": True,
+    "API_SUPPORT_SYNC": True,
+    "API_SUPPORT_EVENTS": False,
+    "API_EVENTS_BUFFER": 10000,
+    "API_SUPPORT_USAGE": False,
+    "API_QUOTAS": [],
+    "API_MIN_FREE_SPACE": 0,
+    "API_CHECKSUM_DB": None,
+    "API_CHECKSUM_WORKERS": 2,
+    "API_CHECKSUM_PREFILL": True,
     "API_AUTH": False,
     "API_AUTH_SECRET_KEY": "tftpapifdskfjdfjklsdjflkdsjfdkfjklsj",
     "API_AUTH_TOKEN_EXPIRES": 60 * 60 * 24,
     "API_AUTH_USERNAME": "admin",
     "API_AUTH_PASSWORD": "admin",
+    "API_AUTH_TOKEN_CACHE_SIZE": 1024,
     "DEBUG": False,
 }
 
@@ -66,6 +96,64 @@ def parse_cli_arguments():
         help="api port for binding",
         default=SETTINGS["API_PORT"],
     )
+    parser.add_argument(
+        "--api-server",
+        action="store",
+        dest="API_SERVER",
+        choices=["flask", "threaded", "gunicorn", "asgi"],
+        help="serving mode: flask development server, threaded WSGI server, "
+        "gunicorn pre-fork workers (production, uses sendfile) or asgi "
+        "(starlette on uvicorn, non-blocking file I/O)",
+        default=SETTINGS["API_SERVER"],
+    )
+    parser.add_argument(
+        "--api-workers",
+        action="store",
+        dest="API_WORKERS",
+        type=int,
+        help="gunicorn worker processes (default: 2 * cores + 1)",
+        default=SETTINGS["API_WORKERS"],
+    )
+    parser.add_argument(
+        "--api-threads",
+        action="store",
+        dest="API_THREADS",
+        type=int,
+        help="gunicorn threads per worker",
+        default=SETTINGS["API_THREADS"],
+    )
+    parser.add_argument(
+        "--api-timeout",
+        action="store",
+        dest="API_TIMEOUT",
+        type=int,
+        help="request timeout (seconds)",
+        default=SETTINGS["API_TIMEOUT"],
+    )
+    parser.add_argument(
+        "--api-keepalive",
+        action="store",
+        dest="API_KEEPALIVE",
+        type=int,
+        help="keep-alive timeout (seconds)",
+        default=SETTINGS["API_KEEPALIVE"],
+    )
+    parser.add_argument(
+        "--api-io-workers",
+        action="store",
+        dest="API_IO_WORKERS",
+        type=int,
+        help="asgi threads for short file operations",
+        default=SETTINGS["API_IO_WORKERS"],
+    )
+    parser.add_argument(
+        "--api-bulk-workers",
+        action="store",
+        dest="API_BULK_WORKERS",
+        type=int,
+        help="asgi threads for long file operations (rmtree, search, hashing)",
+        default=SETTINGS["API_BULK_WORKERS"],
+    )
     parser.add_argument(
         "--disable-api-support-delete-file",
         action="store_false",
@@ -115,13 +203,179 @@ def parse_cli_arguments():
         help="disable api supporting download file",
         default=SETTINGS["API_SUPPORT_DOWNLOAD_FILE"],
     )
+    parser.add_argument(
+        "--disable-api-support-jobs",
+        action="store_false",
+        dest="API_SUPPORT_JOBS",
+        help="disable api supporting background jobs",
+        default=SETTINGS["API_SUPPORT_JOBS"],
+    )
+    parser.add_argument(
+        "--api-jobs-db",
+        action="store",
+        dest="API_JOBS_DB",
+        help="sqlite job log path (default: per root path in system temp)",
+        default=SETTINGS["API_JOBS_DB"],
+    )
+    parser.add_argument(
+        "--api-jobs-workers",
+        action="store",
+        dest="API_JOBS_WORKERS",
+        type=int,
+        help="background job worker threads",
+        default=SETTINGS["API_JOBS_WORKERS"],
+    )
+    parser.add_argument(
+        "--disable-api-support-batch",
+        action="store_false",
+        dest="API_SUPPORT_BATCH",
+        help="disable api supporting batch operations",
+        default=SETTINGS["API_SUPPORT_BATCH"],
+    )
+    parser.add_argument(
+        "--api-batch-max-operations",
+        action="store",
+        dest="API_BATCH_MAX_OPERATIONS",
+        type=int,
+        help="max operations per batch request",
+        default=SETTINGS["API_BATCH_MAX_OPERATIONS"],
+    )
+    parser.add_argument(
+        "--api-batch-max-concurrency",
+        action="store",
+        dest="API_BATCH_MAX_CONCURRENCY",
+        type=int,
+        help="max threads running the operations of one batch",
+        default=SETTINGS["API_BATCH_MAX_CONCURRENCY"],
+    )
+    parser.add_argument(
+        "--disable-api-support-checksum",
+        action="store_false",
+        dest="API_SUPPORT_CHECKSUM",
+        help="disable api supporting file checksums",
+        default=SETTINGS["API_SUPPORT_CHECKSUM"],
+    )
+    parser.add_argument(
+        "--disable-api-support-sync",
+        action="store_false",
+        dest="API_SUPPORT_SYNC",
+        help="disable api supporting delta sync from peers",
+        default=SETTINGS["API_SUPPORT_SYNC"],
+    )
+    parser.add_argument(
+        "--api-support-events",
+        action="store_true",
+        dest="API_SUPPORT_EVENTS",
+        help="enable api change event stream (starts a file watcher)",
+        default=SETTINGS["API_SUPPORT_EVENTS"],
+    )
+    parser.add_argument(
+        "--api-events-buffer",
+        action="store",
+        dest="API_EVENTS_BUFFER",
+        type=int,
+        help="change events kept for consumers resuming a stream",
+        default=SETTINGS["API_EVENTS_BUFFER"],
+    )
+    parser.add_argument(
+        "--api-support-usage",
+        action="store_true",
+        dest="API_SUPPORT_USAGE",
+        help="enable api disk usage totals (starts a file watcher)",
+        default=SETTINGS["API_SUPPORT_USAGE"],
+    )
+    parser.add_argument(
+        "--api-quota",
+        action="append",
+        dest="API_QUOTAS",
+        metavar="PATH=BYTES",
+        help="limit the size of a folder, repeatable (enables usage)",
+        default=SETTINGS["API_QUOTAS"],
+    )
+    parser.add_argument(
+        "--api-min-free-space",
+        action="store",
+        dest="API_MIN_FREE_SPACE",
+        type=int,
+        help="disk space in bytes writes must leave free (enables usage)",
+        default=SETTINGS["API_MIN_FREE_SPACE"],
+    )
+    parser.add_argument(
+        "--api-checksum-db",
+        action="store",
+        dest="API_CHECKSUM_DB",
+        help="sqlite hash cache path (default: system temp)",
+        default=SETTINGS["API_CHECKSUM_DB"],
+    )
+    parser.add_argument(
+        "--api-checksum-workers",
+        action="store",
+        dest="API_CHECKSUM_WORKERS",
+        type=int,
+        help="threads computing file hashes",
+        default=SETTINGS["API_CHECKSUM_WORKERS"],
+    )
+    parser.add_argument(
+        "--disable-api-checksum-prefill",
+        action="store_false",
+        dest="API_CHECKSUM_PREFILL",
+        help="do not hash new files in the background",
+        default=SETTINGS["API_CHECKSUM_PREFILL"],
+    )
     parser.add_argument(
         "--api-file-upload-max-size",
         action="store",
         dest="API_FILE_UPLOAD_MAX_SIZE",
-        help="api file upload max size",
+        type=int,
+        help="api multipart file upload max size (bytes, 0 for unlimited)",
         default=SETTINGS["API_FILE_UPLOAD_MAX_SIZE"],
     )
+    parser.add_argument(
+        "--api-stream-upload-max-size",
+        action="store",
+        dest="API_STREAM_UPLOAD_MAX_SIZE",
+        type=int,
+        help="api streamed, session and sync upload max size (bytes, 0 for unlimited)",
+        default=SETTINGS["API_STREAM_UPLOAD_MAX_SIZE"],
+    )
+    parser.add_argument(
+        "--api-archive-max-size",
+        action="store",
+        dest="API_ARCHIVE_MAX_SIZE",
+        type=int,
+        help="api archive upload max extracted size (bytes, 0 for unlimited)",
+        default=SETTINGS["API_ARCHIVE_MAX_SIZE"],
+    )
+    parser.add_argument(
+        "--api-upload-session-dir",
+        action="store",
+        dest="API_UPLOAD_SESSION_DIR",
+        help="directory keeping resumable upload session state (default: system temp)",
+        default=SETTINGS["API_UPLOAD_SESSION_DIR"],
+    )
+    parser.add_argument(
+        "--enable-api-fs-index",
+        action="store_true",
+        dest="API_FS_INDEX",
+        help="enable in-memory file index for list and search",
+        default=SETTINGS["API_FS_INDEX"],
+    )
+    parser.add_argument(
+        "--api-fs-watch",
+        action="store",
+        dest="API_FS_WATCH",
+        choices=["auto", "inotify", "poll"],
+        help="how the file index follows out-of-band changes",
+        default=SETTINGS["API_FS_WATCH"],
+    )
+    parser.add_argument(
+        "--api-fs-poll-interval",
+        action="store",
+        dest="API_FS_POLL_INTERVAL",
+        type=float,
+        help="file index polling interval (seconds) when inotify is unavailable",
+        default=SETTINGS["API_FS_POLL_INTERVAL"],
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -164,6 +418,14 @@ def parse_cli_arguments():
         help="api auth login password",
         default=SETTINGS["API_AUTH_PASSWORD"],
     )
+    parser.add_argument(
+        "--api-auth-token-cache-size",
+        action="store",
+        dest="API_AUTH_TOKEN_CACHE_SIZE",
+        type=int,
+        help="verified tokens kept in memory (0 to verify every request)",
+        default=SETTINGS["API_AUTH_TOKEN_CACHE_SIZE"],
+    )
 
     return parser.parse_args()
 
@@ -175,15 +437,23 @@ def main():
 
     # warn the user that they are starting PyPXE as non-root user
     if os.getuid() != 0:
-        print(sys.stderr, "\nWARNING: Not root. Servers will probably fail to bind.\n")
+        print(
+            "\nWARNING: Not root. Servers will probably fail to bind.\n",
+            file=sys.stderr,
+        )
 
-    # setup TFTP
-    fsapid = api.FileSystemAPID(
+    # setup API
+    settings = dict(
         name=f"{args.API_NAME}-{uuid.uuid4()}",
         root_path=args.ROOT_PATH,
         api_name=args.API_NAME,
         api_host=args.API_HOST,
         api_port=args.API_PORT,
+        api_server=args.API_SERVER,
+        api_workers=args.API_WORKERS,
+        api_threads=args.API_THREADS,
+        api_timeout=args.API_TIMEOUT,
+        api_keepalive=args.API_KEEPALIVE,
         api_support_delete_file=args.API_SUPPORT_DELETE_FILE,
         api_support_delete_folder=args.API_SUPPORT_DELETE_FOLDER,
         api_support_create_folder=args.API_SUPPORT_CREATE_FOLDER,
@@ -191,14 +461,45 @@ def main():
         api_support_search_file=args.API_SUPPORT_SEARCH_FILE,
         api_support_upload_file=args.API_SUPPORT_UPLOAD_FILE,
         api_support_download_file=args.API_SUPPORT_DOWNLOAD_FILE,
+        api_support_jobs=args.API_SUPPORT_JOBS,
+        api_jobs_db=args.API_JOBS_DB,
+        api_jobs_workers=args.API_JOBS_WORKERS,
+        api_support_batch=args.API_SUPPORT_BATCH,
+        api_batch_max_operations=args.API_BATCH_MAX_OPERATIONS,
+        api_batch_max_concurrency=args.API_BATCH_MAX_CONCURRENCY,
+        api_support_checksum=args.API_SUPPORT_CHECKSUM,
+        api_support_sync=args.API_SUPPORT_SYNC,
+        api_support_events=args.API_SUPPORT_EVENTS,
+        api_events_buffer=args.API_EVENTS_BUFFER,
+        api_support_usage=args.API_SUPPORT_USAGE,
+        api_quotas=dict(quota.rsplit("=", 1) for quota in args.API_QUOTAS),
+        api_min_free_space=args.API_MIN_FREE_SPACE,
+        api_checksum_db=args.API_CHECKSUM_DB,
+        api_checksum_workers=args.API_CHECKSUM_WORKERS,
+        api_checksum_prefill=args.API_CHECKSUM_PREFILL,
         api_file_upload_max_size=args.API_FILE_UPLOAD_MAX_SIZE,
+        api_stream_upload_max_size=args.API_STREAM_UPLOAD_MAX_SIZE,
+        api_archive_max_size=args.API_ARCHIVE_MAX_SIZE,
+        api_upload_session_dir=args.API_UPLOAD_SESSION_DIR,
+        api_fs_index=args.API_FS_INDEX,
+        api_fs_watch=args.API_FS_WATCH,
+        api_fs_poll_interval=args.API_FS_POLL_INTERVAL,
         api_auth=args.API_AUTH,
         api_auth_secret_key=args.API_AUTH_SECRET_KEY,
         api_auth_token_expires=args.API_AUTH_TOKEN_EXPIRES,
         api_auth_username=args.API_AUTH_USERNAME,
         api_auth_password=args.API_AUTH_PASSWORD,
+        api_auth_token_cache_size=args.API_AUTH_TOKEN_CACHE_SIZE,
         debug=args.DEBUG,
     )
+    if args.API_SERVER == "asgi":
+        fsapid = aio.AsyncFileSystemAPID(
+            api_io_workers=args.API_IO_WORKERS,
+            api_bulk_workers=args.API_BULK_WORKERS,
+            **settings,
+        )
+    else:
+        fsapid = api.FileSystemAPID(**settings)
     fsapid.run()
 
 
@@ -0,0 +1,531 @@
+import os
+import sys
+import json
+import mmap
+import math
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+import itertools
+import urllib.error
+import urllib.parse
+import urllib.request
+from .watch import scan_tree
+from .checksum import hash_file
+from .archive import _skip
+
+BLOCK_SIZE_MIN = 2048
+BLOCK_SIZE_MAX = 128 * 1024
+LITERAL_MAX = 1024 * 1024
+# unmatched bytes in a row after which a delta is given up for a full upload,
+# the rolling checksum costs about a second per MB of unmatched data
+LITERAL_RUN_MAX = 4 * 1024 * 1024
+
+# delta records: copy `count` basis blocks from `first`, or literal bytes
+COPY = struct.Struct(">cQI")
+LITERAL = struct.Struct(">cI")
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaAbandoned(Exception):
+    """The file differs too much from the basis for a delta to pay off."""
+
+
+def block_size_for(size):
+    """About sqrt(size), like rsync, so signature and delta stay small."""
+    block_size = math.isqrt(size) & ~7
+    return max(BLOCK_SIZE_MIN, min(BLOCK_SIZE_MAX, block_size))
+
+
+def weak_checksum(block):
+    """rsync's rolling checksum, as (a, b) halves, see `iter_delta`."""
+    a = sum(block) & 0xFFFF
+    b = sum(itertools.accumulate(block)) & 0xFFFF
+    return a, b
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def build_manifest(fs, path="", hash_cache=None):
+    """List every file and folder under `path` with its size and sha256."""
+    valid, abs_path = fs._validate_and_get_abs_path(path)
+    if not valid:
+        return valid, abs_path
+    if not abs_path.is_dir():
+        return False, "Folder {} does not exist".format(path)
+    rel_dir = fs._rel_path(abs_path)
+    entries = []
+    for rel_path, is_dir, size, mtime_ns in scan_tree(fs.root_path, rel_dir):
+        if any(_skip(part) for part in rel_path.split(os.sep)):
+            continue
+        entry = {
+            "path": os.path.relpath(rel_path, rel_dir) if rel_dir else rel_path,
+            "is_dir": is_dir,
+            "size": size,
+            "mtime": mtime_ns // 1000000000,
+            "sha256": None,
+        }
+        if not is_dir:
+            try:
+                if hash_cache is not None:
+                    success, data_or_error = hash_cache.checksum(rel_path)
+                    if not success:
+                        continue
+                    entry["sha256"] = data_or_error["digest"]
+                else:
+                    entry["sha256"] = hash_file(os.path.join(fs.root_path, rel_path))
+            except OSError:
+                continue
+        entries.append(entry)
+    entries.sort(key=lambda entry: entry["path"])
+    return True, {"path": rel_dir, "entries": entries}
+
+
+def file_signature(fs, path, block_size=None):
+    """Weak and strong checksum of each block of a file, see `iter_delta`."""
+    valid, abs_path = fs._validate_and_get_abs_path(path)
+    if not valid:
+        return valid, abs_path
+    if not abs_path.is_file():
+        return False, "File {} does not exist".format(path)
+    size = abs_path.stat().st_size
+    block_size = block_size_for(size) if block_size is None else int(block_size)
+    if block_size <= 0:
+        return False, "Invalid block size"
+    blocks = []
+    with abs_path.open("rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            a, b = weak_checksum(block)
+            blocks.append([a | (b << 16), strong_checksum(block)])
+    return True, {
+        "path": fs._rel_path(abs_path),
+        "size": size,
+        "block_size": block_size,
+        "blocks": blocks,
+    }
+
+
+def _literal_records(data):
+    for offset in range(0, len(data), LITERAL_MAX):
+        chunk = data[offset : offset + LITERAL_MAX]
+        yield LITERAL.pack(b"L", len(chunk)) + chunk
+
+
+def iter_delta(path, signature, max_literal_run=None):
+    """
+    Yield delta records turning the signed basis file into the file at `path`.
+
+    The rolling checksum slides over the new file one byte at a time; a
+    window whose weak checksum is in the signature and whose strong checksum
+    matches becomes a copy record, everything between matches is sent as
+    literal data. Consecutive copied blocks are merged into one record.
+    Raises `DeltaAbandoned` once `max_literal_run` bytes in a row found no
+    match, sending the file whole is then cheaper than scanning on.
+    """
+    n = signature["block_size"]
+    table = {}
+    for index, (weak, strong) in enumerate(signature["blocks"]):
+        table.setdefault(weak, []).append((index, strong))
+    # the basis' last block may be short, it can only match the tail
+    tail_length = signature["size"] % n
+    run = None  # pending copy run [first, count]
+
+    def match(block, weak):
+        candidates = table.get(weak, None)
+        if candidates is None:
+            return None
+        digest = strong_checksum(block)
+        for index, strong in candidates:
+            if digest == strong:
+                return index
+        return None
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = literal_start = 0
+            a = b = None
+            while pos + n <= size:
+                if a is None:
+                    a, b = weak_checksum(m[pos : pos + n])
+                index = match(m[pos : pos + n], a | (b << 16))
+                if index is not None:
+                    if literal_start < pos:
+                        if run is not None:
+                            yield COPY.pack(b"C", *run)
+                            run = None
+                        yield from _literal_records(m[literal_start:pos])
+                    if run is not None and run[0] + run[1] == index:
+                        run[1] += 1
+                    else:
+                        if run is not None:
+                            yield COPY.pack(b"C", *run)
+                        run = [index, 1]
+                    pos += n
+                    literal_start = pos
+                    a = None
+                    continue
+                if (
+                    max_literal_run is not None
+                    and pos - literal_start >= max_literal_run
+                ):
+                    raise DeltaAbandoned(
+                        "No match in {} bytes of {}".format(max_literal_run, path)
+                    )
+                if pos + n < size:
+                    out, new = m[pos], m[pos + n]
+                    a = (a - out + new) & 0xFFFF
+                    b = (b - n * out + a) & 0xFFFF
+                pos += 1
+            end = size
+            if tail_length and size - literal_start >= tail_length:
+                tail = m[size - tail_length : size]
+                ta, tb = weak_checksum(tail)
+                index = match(tail, ta | (tb << 16))
+                if index == len(signature["blocks"]) - 1:
+                    end = size - tail_length
+            if literal_start < end:
+                if run is not None:
+                    yield COPY.pack(b"C", *run)
+                    run = None
+                yield from _literal_records(m[literal_start:end])
+            if end < size:
+                if run is not None and run[0] + run[1] == index:
+                    run[1] += 1
+                else:
+                    if run is not None:
+                        yield COPY.pack(b"C", *run)
+                    run = [index, 1]
+            if run is not None:
+                yield COPY.pack(b"C", *run)
+
+
+def _read_exact(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("Truncated delta")
+        data += chunk
+    return data
+
+
+def apply_delta(fs, path, stream, block_size, expected_hash, max_size=None):
+    """
+    Rebuild a file from its current content and a delta, see `iter_delta`.
+
+    The result is written through a `FileWriter`, so it only replaces the
+    file once complete and matching `expected_hash`. A delta of literals
+    only creates the file from scratch.
+    """
+    if expected_hash is None:
+        return False, "Request parameter missing: sha256"
+    valid, abs_path = fs._validate_and_get_abs_path(path)
+    if not valid:
+        return valid, abs_path
+    basis = None
+    if abs_path.is_file():
+        basis = os.open(abs_path, os.O_RDONLY)
+    basis_size = 0 if basis is None else os.fstat(basis).st_size
+    success, writer = fs.open_writer(abs_path, max_size, expected_hash=expected_hash)
+    if not success:
+        if basis is not None:
+            os.close(basis)
+        return success, writer
+    try:
+        while True:
+            tag = stream.read(1)
+            if not tag:
+                break
+            if tag == b"C":
+                first, count = COPY.unpack(tag + _read_exact(stream, COPY.size - 1))[1:]
+                offset = first * block_size
+                end = min(basis_size, (first + count) * block_size)
+                if basis is None or offset >= end:
+                    raise ValueError("Delta copies beyond the current file")
+                while offset < end:
+                    data = os.pread(
+                        basis, min(fs.write_chunk_size, end - offset), offset
+                    )
+                    if not data:
+                        raise ValueError("File changed while applying delta")
+                    writer.write(data)
+                    offset += len(data)
+            elif tag == b"L":
+                length = LITERAL.unpack(tag + _read_exact(stream, LITERAL.size - 1))[1]
+                writer.write(_read_exact(stream, length))
+            else:
+                raise ValueError("Invalid delta record {!r}".format(tag))
+        return True, writer.commit()
+    except Exception as e:
+        writer.discard()
+        return False, str(e)
+    finally:
+        if basis is not None:
+            os.close(basis)
+
+
+class SyncClient:
+    """Minimal client of a peer's file API, used by `sync_tree`."""
+
+    def __init__(self, url, api_name="api", token=None, timeout=60):
+        self.url = url.rstrip("/")
+        self.api_name = api_name
+        self.token = token
+        self.timeout = timeout
+
+    def _request(self, method, endpoint, params=None, data=None, headers=None):
+        url = "{}/{}/{}".format(self.url, self.api_name, endpoint)
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        headers = {} if headers is None else dict(headers)
+        if self.token is not None:
+            headers["Authorization"] = "Bearer {}".format(self.token)
+        request = urllib.request.Request(url, data, headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                result = json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                result = json.load(e)
+            except ValueError:
+                raise Exception("{} {}: {}".format(method, endpoint, e))
+        if not result["flag"]:
+            raise Exception(result["message"])
+        return result["data"]
+
+    def _form(self, fields):
+        return urllib.parse.urlencode(fields).encode()
+
+    def login(self, username, password):
+        self.token = self._request(
+            "POST",
+            "login",
+            data=self._form({"username": username, "password": password}),
+        )
+        return self.token
+
+    def manifest(self, path=""):
+        return self._request("GET", "sync/manifest", {"path": path})
+
+    def signature(self, path, block_size=None):
+        params = {"path": path}
+        if block_size is not None:
+            params["block_size"] = block_size
+        return self._request("GET", "sync/signature", params)
+
+    def delta(self, path, body, length, block_size, sha256):
+        return self._request(
+            "PUT",
+            "sync/delta",
+            {"path": path, "block_size": block_size, "sha256": sha256},
+            data=body,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(length),
+            },
+        )
+
+    def create_folder(self, path):
+        return self._request("POST", "add/folder", data=self._form({"path": path}))
+
+    def delete_file(self, path):
+        return self._request("POST", "delete/file", data=self._form({"path": path}))
+
+    def delete_folder(self, path):
+        return self._request("POST", "delete/folder", data=self._form({"path": path}))
+
+
+def _iter_literals(abs_path):
+    with open(abs_path, "rb") as f:
+        while True:
+            chunk = f.read(LITERAL_MAX)
+            if not chunk:
+                break
+            yield LITERAL.pack(b"L", len(chunk)) + chunk
+
+
+def sync_tree(
+    fs,
+    client,
+    path="",
+    dest=None,
+    delete=False,
+    delta_min_size=1024 * 1024,
+    dry_run=False,
+    hash_cache=None,
+    max_literal_run=LITERAL_RUN_MAX,
+):
+    """
+    Make the peer's `dest` folder match the local `path` folder.
+
+    Manifests are compared by sha256: missing files are sent whole, changed
+    files of at least `delta_min_size` bytes as a delta against the peer's
+    copy (whole again when `iter_delta` gives up after `max_literal_run`
+    unmatched bytes), and with `delete` files and folders the local tree
+    lacks are removed.
+    """
+    dest = path if dest is None else dest
+    success, local = build_manifest(fs, path, hash_cache)
+    if not success:
+        raise Exception(local)
+    remote = {entry["path"]: entry for entry in client.manifest(dest)["entries"]}
+    stats = {
+        "folders": 0,
+        "full": 0,
+        "delta": 0,
+        "unchanged": 0,
+        "abandoned": 0,  # deltas sent whole instead
+        "deleted": 0,
+        "bytes_sent": 0,
+        "bytes_total": 0,
+    }
+    for entry in local["entries"]:
+        remote_path = os.path.join(dest, entry["path"]) if dest else entry["path"]
+        remote_entry = remote.pop(entry["path"], None)
+        if entry["is_dir"]:
+            if remote_entry is None:
+                logger.info("Create folder {}".format(remote_path))
+                if not dry_run:
+                    client.create_folder(remote_path)
+                stats["folders"] += 1
+            continue
+        stats["bytes_total"] += entry["size"]
+        if remote_entry is not None and remote_entry["sha256"] == entry["sha256"]:
+            stats["unchanged"] += 1
+            continue
+        abs_path = os.path.join(fs.root_path, local["path"], entry["path"])
+        if (
+            remote_entry is not None
+            and not remote_entry["is_dir"]
+            and entry["size"] >= delta_min_size
+        ):
+            kind = "delta"
+            signature = {} if dry_run else client.signature(remote_path)
+        else:
+            kind = "full"
+            signature = None
+        logger.info("Send {} {} ({} bytes)".format(kind, remote_path, entry["size"]))
+        if dry_run:
+            stats[kind] += 1
+            continue
+        length = None
+        if signature is not None:
+            with tempfile.SpooledTemporaryFile(8 * 1024 * 1024) as body:
+                try:
+                    for record in iter_delta(abs_path, signature, max_literal_run):
+                        body.write(record)
+                except DeltaAbandoned as e:
+                    logger.info("Send full {}: {}".format(remote_path, e))
+                    kind = "full"
+                    stats["abandoned"] += 1
+                else:
+                    length = body.tell()
+                    body.seek(0)
+                    client.delta(
+                        remote_path,
+                        body,
+                        length,
+                        signature["block_size"],
+                        entry["sha256"],
+                    )
+        if length is None:
+            chunks = -(-entry["size"] // LITERAL_MAX)
+            length = entry["size"] + chunks * LITERAL.size
+            client.delta(
+                remote_path,
+                _iter_literals(abs_path),
+                length,
+                BLOCK_SIZE_MIN,
+                entry["sha256"],
+            )
+        stats[kind] += 1
+        stats["bytes_sent"] += length
+    if delete:
+        deleted = []  # folders, whose content goes with them
+        for rel_path, remote_entry in sorted(remote.items()):
+            if any(rel_path.startswith(folder + os.sep) for folder in deleted):
+                continue
+            remote_path = os.path.join(dest, rel_path) if dest else rel_path
+            logger.info("Delete {}".format(remote_path))
+            if remote_entry["is_dir"]:
+                deleted.append(rel_path)
+                if not dry_run:
+                    client.delete_folder(remote_path)
+            elif not dry_run:
+                client.delete_file(remote_path)
+            stats["deleted"] += 1
+    return stats
+
+
+def main(argv=None):
+    from .fs import FileManagementSystem
+    from .checksum import HashCache
+
+    parser = argparse.ArgumentParser(
+        description="Push a local file tree to a peer's file API, sending only changes."
+    )
+    parser.add_argument("url", help="peer base url, e.g. http://boot2:5000")
+    parser.add_argument("--root-path", default="files", help="local root path")
+    parser.add_argument("--path", default="", help="local folder to sync")
+    parser.add_argument("--dest", default=None, help="peer folder (default: --path)")
+    parser.add_argument("--api-name", default="api", help="peer api name")
+    parser.add_argument("--token", default=None, help="peer auth token")
+    parser.add_argument("--username", default=None, help="peer auth username")
+    parser.add_argument("--password", default=None, help="peer auth password")
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="delete peer files and folders missing locally, folders need "
+        "the peer's delete/folder support",
+    )
+    parser.add_argument(
+        "--delta-min-size",
+        type=int,
+        default=1024 * 1024,
+        help="send changed files of at least this size as deltas (bytes)",
+    )
+    parser.add_argument(
+        "--delta-max-literal-run",
+        type=int,
+        default=LITERAL_RUN_MAX,
+        help="send a changed file whole after this many unmatched bytes (bytes)",
+    )
+    parser.add_argument(
+        "--hash-db", default=None, help="sqlite hash cache path (default: system temp)"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="only show changes")
+    parser.add_argument("--timeout", type=int, default=60, help="request timeout")
+    args = parser.parse_args(argv)
+
+    fs = FileManagementSystem(args.root_path)
+    client = SyncClient(args.url, args.api_name, args.token, args.timeout)
+    if args.username is not None:
+        client.login(args.username, args.password)
+    stats = sync_tree(
+        fs,
+        client,
+        args.path,
+        args.dest,
+        delete=args.delete,
+        delta_min_size=args.delta_min_size,
+        dry_run=args.dry_run,
+        hash_cache=HashCache(fs, args.hash_db),
+        max_literal_run=args.delta_max_literal_run,
+    )
+    json.dump(stats, sys.stdout)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
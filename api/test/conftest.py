@@ -0,0 +1,94 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from api.api import FileSystemAPID  # noqa: E402
+
+API_NAME = "fsapi"
+
+
+class Client:
+    """Flask or Starlette test client, returning (status code, JSON body)."""
+
+    def __init__(self, client, asgi):
+        self.client = client
+        self.asgi = asgi
+
+    def request(self, method, route, params=None, body=None, headers=None):
+        """Raw request, returning (status code, headers, body bytes)."""
+        if self.asgi:
+            response = self.client.request(
+                method,
+                f"/{API_NAME}/{route}",
+                params=params,
+                content=body,
+                headers=headers,
+            )
+            return response.status_code, response.headers, response.content
+        response = self.client.open(
+            f"/{API_NAME}/{route}",
+            method=method,
+            query_string=params,
+            data=body,
+            headers=headers,
+        )
+        return response.status_code, response.headers, response.get_data()
+
+    def get(self, route, **params):
+        if self.asgi:
+            response = self.client.get(f"/{API_NAME}/{route}", params=params)
+            return response.status_code, response.json()
+        response = self.client.get(f"/{API_NAME}/{route}", query_string=params)
+        return response.status_code, response.get_json()
+
+    def post(self, route, json=None, files=None, **form):
+        if self.asgi:
+            response = self.client.post(
+                f"/{API_NAME}/{route}", json=json, data=form or None, files=files
+            )
+            return response.status_code, response.json()
+        if files:
+            # werkzeug takes (file, filename), httpx (filename, file)
+            form.update({key: (f, filename) for key, (filename, f) in files.items()})
+        response = self.client.post(
+            f"/{API_NAME}/{route}", json=json, data=form or None
+        )
+        return response.status_code, response.get_json()
+
+
+@pytest.fixture
+def make_api(tmp_path):
+    """Return (apid, client) serving tmp_path/<name>, the ASGI variant if asked."""
+    apids = []
+
+    def factory(name="files", asgi=False, **settings):
+        root_path = tmp_path / name
+        root_path.mkdir(exist_ok=True)
+        for setting, suffix in (
+            ("api_jobs_db", "-jobs.sqlite"),
+            ("api_checksum_db", "-hashes.sqlite"),
+            ("api_upload_session_dir", "-sessions"),
+        ):
+            settings.setdefault(setting, str(tmp_path / (name + suffix)))
+        if asgi:
+            pytest.importorskip("starlette")
+            pytest.importorskip("httpx")
+            from starlette.testclient import TestClient
+            from api.aio import AsyncFileSystemAPID
+
+            apid = AsyncFileSystemAPID(API_NAME, str(root_path), **settings)
+            client = Client(TestClient(apid.app), True)
+        else:
+            apid = FileSystemAPID(API_NAME, str(root_path), **settings)
+            client = Client(apid.app.test_client(), False)
+        apids.append(apid)
+        return apid, client
+
+    yield factory
+    for apid in apids:
+        if apid.jobs is not None:
+            apid.jobs.executor.shutdown(wait=True)
+        if apid.watcher is not None:
+            apid.watcher.stop()
@@ -26,26 +26,56 @@ AUTH_RESULT=$(curl -X POST http://localhost:$API_PORT/$API_NAME/login -d usernam
 AUTH_TOKEN=$(echo $AUTH_RESULT | grep -o '"data":"[^"]*"' | cut -d':' -f2- | tr -d '"')
 echo $AUTH_TOKEN
 
+echo change events, needs --api-support-events
+EVENTS_SINCE=$(curl -s http://127.0.0.1:$API_PORT/$API_NAME/events/poll?token=$AUTH_TOKEN | grep -o '"last_id":"[^"]*"' | cut -d':' -f2- | tr -d '"')
+
 echo create folder
-curl http://127.0.0.1:$API_PORT/$API_NAME/add/folder -X POST -d "path=$createfolderpath" -d "token=$AUTH_TOKEN"
+curl http://127.0.0.1:$API_PORT/$API_NAME/add/folder -X POST -d "path=$createfolderpath" -H "Authorization: Bearer $AUTH_TOKEN"
 
 echo upload file
-curl http://127.0.0.1:$API_PORT/$API_NAME/upload/file -X POST -F "file=@$uploadfile" -F "path=$uploadpath" -F "token=$AUTH_TOKEN"
+curl http://127.0.0.1:$API_PORT/$API_NAME/upload/file -X POST -F "file=@$uploadfile" -F "path=$uploadpath" -H "Authorization: Bearer $AUTH_TOKEN"
+
+echo upload file stream
+curl http://127.0.0.1:$API_PORT/$API_NAME/upload/stream?path=$uploadpath\&filename=$uploadfile\&token=$AUTH_TOKEN -X PUT --data-binary "@$uploadfile" -H "Content-Type: application/octet-stream"
 
 echo download file
 curl http://127.0.0.1:$API_PORT/$API_NAME/download/file?path=$downloadpath\&token=$AUTH_TOKEN
 
+echo download file range
+curl http://127.0.0.1:$API_PORT/$API_NAME/download/file?path=$downloadpath\&token=$AUTH_TOKEN -H "Range: bytes=0-15,-16"
+
+echo checksum
+curl http://127.0.0.1:$API_PORT/$API_NAME/checksum?path=$downloadpath\&algo=sha256\&token=$AUTH_TOKEN
+
+echo sync manifest
+curl http://127.0.0.1:$API_PORT/$API_NAME/sync/manifest?path=$uploadpath\&token=$AUTH_TOKEN
+
+echo download folder archive
+curl http://127.0.0.1:$API_PORT/$API_NAME/download/archive?path=$uploadpath\&format=tar.gz\&token=$AUTH_TOKEN -o /tmp/$createfolderpath.tar.gz
+
+echo upload folder archive
+curl http://127.0.0.1:$API_PORT/$API_NAME/upload/archive?path=$uploadpath/extracted\&strip=1 -X PUT --data-binary @/tmp/$createfolderpath.tar.gz -H "Authorization: Bearer $AUTH_TOKEN"
+
 echo search
 curl http://127.0.0.1:$API_PORT/$API_NAME/search/file?path=$searchpath\&key=$searchkey\&token=$AUTH_TOKEN
 
 echo list path contents
 curl http://127.0.0.1:$API_PORT/$API_NAME/get/list?path=$listcontentpath\&token=$AUTH_TOKEN
 
+echo batch
+curl http://127.0.0.1:$API_PORT/$API_NAME/batch -X POST -H "Authorization: Bearer $AUTH_TOKEN" -H "Content-Type: application/json" -d '{"atomic": true, "operations": [{"op": "create_folder", "args": {"path": "'$createfolderpath'/batch"}}, {"op": "list", "args": {"path": "'$createfolderpath'"}}, {"op": "delete_folder", "args": {"path": "'$createfolderpath'/batch"}}]}'
+
+echo disk usage
+curl http://127.0.0.1:$API_PORT/$API_NAME/usage?path=$listcontentpath\&depth=1\&token=$AUTH_TOKEN
+
+echo poll change events
+curl http://127.0.0.1:$API_PORT/$API_NAME/events/poll?since=$EVENTS_SINCE\&timeout=1\&token=$AUTH_TOKEN
+
 echo delete file
-curl http://127.0.0.1:$API_PORT/$API_NAME/delete/file -X POST -d "path=$deletefilepath" -d "token=$AUTH_TOKEN"
+curl http://127.0.0.1:$API_PORT/$API_NAME/delete/file -X POST -d "path=$deletefilepath" -H "Authorization: Bearer $AUTH_TOKEN"
 
 echo delete folder
-curl http://127.0.0.1:$API_PORT/$API_NAME/delete/folder -X POST -d "path=$deletefolderpath" -d "token=$AUTH_TOKEN"
+curl http://127.0.0.1:$API_PORT/$API_NAME/delete/folder -X POST -d "path=$deletefolderpath" -H "Authorization: Bearer $AUTH_TOKEN"
 
 
 
@@ -0,0 +1,695 @@
+import io
+import os
+import json
+import time
+import base64
+import random
+import shutil
+import tarfile
+import hashlib
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor, wait
+from werkzeug.serving import make_server
+
+from api import sync
+from api.auth import TokenCache
+from api.events import EventBus
+from api.watch import EVENT_CREATE, EVENT_MODIFY, EVENT_DELETE
+from api.jobs import JobManager, JOB_PENDING, JOB_RUNNING, JOB_FAILED
+
+
+def wait_job(client, job_id, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        _, body = client.get("jobs/status", id=job_id)
+        job = body["data"]
+        if job["status"] not in (JOB_PENDING, JOB_RUNNING):
+            return job
+        assert time.monotonic() < deadline, job
+        time.sleep(0.02)
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_jobs(make_api, asgi):
+    apid, client = make_api(asgi=asgi, api_support_delete_folder=True)
+    os.makedirs(os.path.join(apid.root_path, "tree", "sub"))
+    open(os.path.join(apid.root_path, "tree", "sub", "a.bin"), "wb").close()
+
+    _, body = client.post("delete/folder", path="tree", **{"async": "1"})
+    job = wait_job(client, body["data"]["id"])
+    assert job["op"] == "delete_folder" and job["status"] == "done", job
+    assert not os.path.exists(os.path.join(apid.root_path, "tree"))
+
+    _, body = client.get("search/file", key="*.bin", **{"async": "1"})
+    assert wait_job(client, body["data"]["id"])["op"] == "search"
+
+    _, body = client.post("jobs/submit", op="create_folder", path="made")
+    assert wait_job(client, body["data"]["id"])["status"] == "done"
+    assert os.path.isdir(os.path.join(apid.root_path, "made"))
+
+    _, body = client.get("jobs/list", limit=10)
+    assert len(body["data"]) == 3
+    _, body = client.post("jobs/cancel", id=body["data"][0]["id"])
+    assert body["flag"] and not body["data"]["cancel_requested"]
+    status, body = client.post("jobs/submit", op="rm_rf")
+    assert status == 500 and not body["flag"]
+
+
+def test_jobs_db_per_instance(tmp_path, make_api):
+    first, _ = make_api("first", api_jobs_db=None)
+    second, _ = make_api("second", api_jobs_db=None)
+    assert first.jobs.db_path != second.jobs.db_path
+    for apid in (first, second):
+        os.unlink(apid.jobs.db_path)
+
+    # a job still running in a live process sharing the log is left alone,
+    # one of a process that is gone is failed
+    db_path = str(tmp_path / "shared.sqlite")
+    jobs = JobManager(first.fs, db_path)
+    with jobs._db() as conn:
+        conn.executemany(
+            "INSERT INTO jobs (id, op, status, created, pid) VALUES (?, ?, ?, ?, ?)",
+            [
+                ("live", "search", JOB_RUNNING, time.time(), os.getpid()),
+                ("gone", "search", JOB_RUNNING, time.time(), 2**22 + 1),
+            ],
+        )
+    JobManager(first.fs, db_path)
+    assert jobs.status("live")[1]["status"] == JOB_RUNNING
+    assert jobs.status("gone")[1]["status"] == JOB_FAILED
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_batch_atomic_upload_rollback(make_api, asgi):
+    apid, client = make_api(asgi=asgi)
+    keep = os.path.join(apid.root_path, "keep.bin")
+    with open(keep, "wb") as f:
+        f.write(b"original")
+    new = base64.b64encode(b"replaced").decode()
+
+    # a failed commit must leave the target in place
+    status, body = client.post(
+        "batch",
+        json={
+            "atomic": True,
+            "operations": [
+                {
+                    "op": "upload_file",
+                    "args": {"path": "keep.bin", "content_base64": new, "sha256": "0"},
+                }
+            ],
+        },
+    )
+    assert status == 409 and body["data"]["rolled_back"]
+    with open(keep, "rb") as f:
+        assert f.read() == b"original"
+
+    # a committed overwrite is undone when a later operation fails
+    status, body = client.post(
+        "batch",
+        json={
+            "atomic": True,
+            "operations": [
+                {
+                    "op": "upload_file",
+                    "args": {"path": "keep.bin", "content_base64": new},
+                },
+                {"op": "delete_file", "args": {"path": "missing.bin"}},
+            ],
+        },
+    )
+    assert status == 409 and body["data"]["results"][0]["flag"]
+    with open(keep, "rb") as f:
+        assert f.read() == b"original"
+    assert os.listdir(apid.root_path) == ["keep.bin"]
+
+
+class FinishedExecutor(ThreadPoolExecutor):
+    """Hands out futures that are already done."""
+
+    def submit(self, *args, **kwargs):
+        future = super().submit(*args, **kwargs)
+        wait([future])
+        return future
+
+
+def test_checksum_of_finished_hash(make_api):
+    apid, client = make_api()
+    with open(os.path.join(apid.root_path, "a.bin"), "wb") as f:
+        f.write(b"a" * 1000)
+    apid.hash_cache.executor = FinishedExecutor(max_workers=1)
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(client.get("checksum", path="a.bin")),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(5)
+    assert result, "checksum deadlocked"
+    status, body = result[0]
+    assert body["data"]["digest"] == hashlib.sha256(b"a" * 1000).hexdigest()
+    assert not apid.hash_cache.pending
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_checksum_outside_root(make_api, asgi, tmp_path):
+    apid, client = make_api(asgi=asgi)
+    (tmp_path / "secret.txt").write_bytes(b"top secret content")
+    os.symlink(tmp_path / "secret.txt", os.path.join(apid.root_path, "link.txt"))
+    secret = hashlib.sha256(b"top secret content").hexdigest()
+    for path in ["../secret.txt", "link.txt"]:
+        status, body = client.get("checksum", path=path)
+        assert status == 403 and secret not in json.dumps(body), path
+
+
+@pytest.fixture
+def serve():
+    """Serve a Flask app on an ephemeral loopback port, returning its url."""
+    servers = []
+
+    def factory(app):
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return "http://127.0.0.1:{}".format(server.server_port)
+
+    yield factory
+    for server in servers:
+        server.shutdown()
+
+
+def tree(root_path):
+    result = {}
+    for folder, dirs, files in os.walk(root_path):
+        for name in dirs:
+            result[os.path.relpath(os.path.join(folder, name), root_path)] = None
+        for name in files:
+            with open(os.path.join(folder, name), "rb") as f:
+                result[os.path.relpath(os.path.join(folder, name), root_path)] = (
+                    f.read()
+                )
+    return result
+
+
+def test_sync_between_instances(make_api, serve):
+    local, _ = make_api("local")
+    peer, _ = make_api("peer", api_support_delete_folder=True)
+    client = sync.SyncClient(serve(peer.app), peer.api_name)
+    os.makedirs(os.path.join(local.root_path, "boot", "old"))
+    image = bytearray(random.Random(1).randbytes(512 * 1024))
+    for rel_path, data in (
+        ("boot/image.bin", image),
+        ("boot/old/stale.cfg", b"stale"),
+        ("small.cfg", b"x"),
+    ):
+        with open(os.path.join(local.root_path, rel_path), "wb") as f:
+            f.write(data)
+
+    def run(**kwargs):
+        return sync.sync_tree(
+            local.fs,
+            client,
+            delta_min_size=64 * 1024,
+            hash_cache=local.hash_cache,
+            **kwargs
+        )
+
+    stats = run()
+    assert stats["full"] == 3 and tree(peer.root_path) == tree(local.root_path)
+
+    # a small change is sent as a delta
+    image[1000:1010] = b"0123456789"
+    with open(os.path.join(local.root_path, "boot/image.bin"), "wb") as f:
+        f.write(image)
+    stats = run()
+    assert stats["delta"] == 1 and stats["unchanged"] == 2
+    assert stats["bytes_sent"] < 64 * 1024
+    assert tree(peer.root_path) == tree(local.root_path)
+
+    # a rewritten file is sent whole once the delta finds no matches
+    with open(os.path.join(local.root_path, "boot/image.bin"), "wb") as f:
+        f.write(random.Random(2).randbytes(512 * 1024))
+    stats = run(max_literal_run=64 * 1024)
+    assert stats["abandoned"] == 1 and stats["full"] == 1 and stats["delta"] == 0
+    assert tree(peer.root_path) == tree(local.root_path)
+
+    # folders missing locally are deleted with their content
+    shutil.rmtree(os.path.join(local.root_path, "boot", "old"))
+    stats = run(delete=True)
+    assert stats["deleted"] == 1
+    assert tree(peer.root_path) == tree(local.root_path)
+
+
+def test_events_keep_state_changes():
+    bus = EventBus()
+    for event in (EVENT_CREATE, EVENT_CREATE, EVENT_DELETE, EVENT_CREATE):
+        bus.publish(event, "a")
+    # an echo of the same change is dropped, a change back is not
+    bus.publish(EVENT_MODIFY, "b")
+    bus.publish(EVENT_MODIFY, "b")
+    events, reset = bus.since(bus.first_id)
+    assert not reset
+    assert [(e["event"], e["path"]) for e in events] == [
+        (EVENT_CREATE, "a"),
+        (EVENT_DELETE, "a"),
+        (EVENT_CREATE, "a"),
+        (EVENT_MODIFY, "b"),
+    ]
+    assert bus.since(bus.last_id) == ([], False)
+    # an id issued by another worker's bus is not resumed from
+    assert bus.since(bus.last_id + 1) == ([], True)
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_upload_stream_above_multipart_limit(make_api, asgi):
+    apid, client = make_api(asgi=asgi)
+    data = random.Random(26).randbytes(3 * 1024 * 1024 + 5)
+    status, _, body = client.request(
+        "PUT",
+        "upload/stream",
+        {"path": "images", "filename": "big.img"},
+        data,
+        {"X-Content-SHA256": hashlib.sha256(data).hexdigest()},
+    )
+    assert status == 200, body
+    assert json.loads(body)["data"]["size"] == len(data)
+    with open(os.path.join(apid.root_path, "images", "big.img"), "rb") as f:
+        assert f.read() == data
+    # a wrong checksum keeps the previous file
+    status, _, _ = client.request(
+        "PUT",
+        "upload/stream",
+        {"path": "images", "filename": "big.img"},
+        b"x",
+        {"X-Content-SHA256": hashlib.sha256(b"y").hexdigest()},
+    )
+    assert status == 500
+    assert os.path.getsize(os.path.join(apid.root_path, "images", "big.img")) == len(
+        data
+    )
+    # the multipart upload keeps its own limit
+    status, body = client.post(
+        "upload/file", path="", files={"file": ("big.img", io.BytesIO(data))}
+    )
+    assert status == 413 and not body["flag"]
+    status, body = client.post(
+        "upload/file", path="", files={"file": ("small.img", io.BytesIO(b"small"))}
+    )
+    assert status == 200 and body["data"]["size"] == 5
+
+
+def test_upload_stream_limit(make_api):
+    apid, client = make_api(api_stream_upload_max_size=1000)
+    status, _, body = client.request(
+        "PUT", "upload/stream", {"filename": "a.bin"}, bytes(1001)
+    )
+    assert status == 500 and b"max upload size" in body
+    assert not os.path.exists(os.path.join(apid.root_path, "a.bin"))
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_upload_session(make_api, asgi):
+    apid, client = make_api(asgi=asgi)
+    data = random.Random(27).randbytes(2500)
+    _, body = client.post(
+        "upload/session/init",
+        path="images",
+        filename="boot.img",
+        size=len(data),
+        part_size=1000,
+        sha256=hashlib.sha256(data).hexdigest(),
+    )
+    session = body["data"]
+    assert session["part_count"] == 3
+
+    def put_part(part, content):
+        return client.request(
+            "PUT",
+            "upload/session/part",
+            {"id": session["id"], "part": part},
+            content,
+            {"X-Content-SHA256": hashlib.sha256(content).hexdigest()},
+        )[0]
+
+    # out of order, a part whose hash does not match is not recorded
+    assert put_part(2, data[2000:]) == 200
+    assert put_part(0, data[:1000]) == 200
+    status, _, _ = client.request(
+        "PUT",
+        "upload/session/part",
+        {"id": session["id"], "part": 1, "sha256": "0" * 64},
+        data[1000:2000],
+    )
+    assert status == 500
+    _, body = client.get("upload/session/status", id=session["id"])
+    assert body["data"]["missing_parts"] == [1]
+    status, body = client.post("upload/session/commit", id=session["id"])
+    assert status == 500 and not body["flag"]
+    assert put_part(1, data[1000:2000]) == 200
+    status, body = client.post("upload/session/commit", id=session["id"])
+    assert status == 200, body
+    with open(os.path.join(apid.root_path, "images", "boot.img"), "rb") as f:
+        assert f.read() == data
+
+    _, body = client.post(
+        "upload/session/init", path="images", filename="other.img", size=10, part_size=5
+    )
+    other = body["data"]["id"]
+    assert client.post("upload/session/abort", id=other)[0] == 200
+    status, _ = client.get("upload/session/status", id=other)
+    assert status == 500
+    assert sorted(os.listdir(os.path.join(apid.root_path, "images"))) == ["boot.img"]
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_download_ranges(make_api, asgi):
+    apid, client = make_api(asgi=asgi)
+    data = bytes(range(256)) * 4
+    with open(os.path.join(apid.root_path, "boot.img"), "wb") as f:
+        f.write(data)
+
+    def download(**headers):
+        return client.request(
+            "GET", "download/file", {"path": "boot.img"}, None, headers
+        )
+
+    status, headers, body = download()
+    assert status == 200 and body == data
+    etag = headers["ETag"]
+    status, headers, body = download(Range="bytes=10-19")
+    assert status == 206 and body == data[10:20]
+    assert headers["Content-Range"] == "bytes 10-19/1024"
+    status, _, body = download(Range="bytes=-24")
+    assert status == 206 and body == data[-24:]
+    status, headers, body = download(Range="bytes=0-1,100-101")
+    assert status == 206
+    assert headers["Content-Type"].startswith("multipart/byteranges")
+    assert data[0:2] in body and data[100:102] in body
+    assert b"Content-Range: bytes 100-101/1024" in body
+    status, _, _ = download(Range="bytes=2000-")
+    assert status == 416
+    # too many ranges are not truncated, the whole file is sent instead
+    many = ",".join("{}-{}".format(i, i) for i in range(0, 200, 2))
+    status, _, body = download(Range="bytes=" + many)
+    assert status == 200 and body == data
+    status, _, body = download(Range="bytes=10-19", **{"If-Range": etag})
+    assert status == 206 and body == data[10:20]
+    status, _, body = download(Range="bytes=10-19", **{"If-Range": '"stale"'})
+    assert status == 200 and body == data
+    status, _, body = download(**{"If-None-Match": etag})
+    assert status == 304 and body == b""
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_download_outside_root(make_api, asgi, tmp_path):
+    apid, client = make_api(asgi=asgi)
+    (tmp_path / "secret.txt").write_bytes(b"top secret content")
+    os.symlink(tmp_path / "secret.txt", os.path.join(apid.root_path, "link.txt"))
+    os.mkdir(os.path.join(apid.root_path, "sub"))
+    for path in ["../secret.txt", "sub/../../secret.txt", "link.txt", "/etc/passwd"]:
+        status, _, body = client.request("GET", "download/file", {"path": path})
+        assert 400 <= status < 500, path
+        assert b"top secret content" not in body
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_index_search(make_api, asgi):
+    apid, client = make_api(
+        asgi=asgi, api_fs_index=True, api_support_delete_folder=True
+    )
+    assert apid.fs.index is not None
+    os.makedirs(os.path.join(apid.root_path, "pxe", "grub"))
+    for name in ["pxe/grub/grub.cfg", "pxe/vmlinuz", "pxe/initrd.IMG"]:
+        with open(os.path.join(apid.root_path, name), "wb") as f:
+            f.write(b"x")
+    apid.fs.index.build()
+
+    def search(key, mode="glob", path=""):
+        status, body = client.get("search/file", key=key, mode=mode, path=path)
+        assert status == 200, body
+        return sorted(entry["path"] for entry in body["data"])
+
+    assert search("**/*.cfg") == ["pxe/grub/grub.cfg"]
+    assert search("*", path="pxe") == ["pxe/grub", "pxe/initrd.IMG", "pxe/vmlinuz"]
+    assert search("img", mode="substring") == ["pxe/initrd.IMG"]
+
+    status, _ = client.post(
+        "upload/file", path="pxe", files={"file": ("boot.img", io.BytesIO(b"img"))}
+    )
+    assert status == 200
+    assert search("*.img", path="pxe") == ["pxe/boot.img"]
+    # answered by the index, not by a fallback walk of the disk
+    assert [e["path"] for e in apid.fs.index.search("*.img", "pxe")] == ["pxe/boot.img"]
+    assert search("img", mode="substring") == ["pxe/boot.img", "pxe/initrd.IMG"]
+
+    assert client.post("delete/file", path="pxe/initrd.IMG")[0] == 200
+    assert search("img", mode="substring") == ["pxe/boot.img"]
+    assert client.post("delete/folder", path="pxe/grub")[0] == 200
+    assert search("**/*.cfg") == []
+    assert search("*", path="pxe") == ["pxe/boot.img", "pxe/vmlinuz"]
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_list_paging(make_api, asgi):
+    apid, client = make_api(asgi=asgi)
+    for i in range(7):
+        with open(os.path.join(apid.root_path, "f{}".format(i)), "wb") as f:
+            f.write(bytes(i * 10))
+    os.mkdir(os.path.join(apid.root_path, "dir"))
+
+    def pages(sort):
+        names, cursor = [], None
+        while True:
+            params = {"limit": 3, "sort": sort}
+            if cursor is not None:
+                params["cursor"] = cursor
+            status, body = client.get("get/list", **params)
+            assert status == 200, body
+            assert len(body["data"]["items"]) <= 3
+            names += [entry["name"] for entry in body["data"]["items"]]
+            cursor = body["data"]["next_cursor"]
+            if cursor is None:
+                return names
+
+    files = ["f{}".format(i) for i in range(7)]
+    assert pages("name") == ["dir"] + files
+    assert pages("-size") == files[::-1] + ["dir"]
+
+    # a cursor from a size sort does not fit a name sort
+    _, body = client.get("get/list", limit=3, sort="size")
+    size_cursor = body["data"]["next_cursor"]
+    for cursor in ["!!!", base64.urlsafe_b64encode(b"[1]").decode(), size_cursor]:
+        status, body = client.get("get/list", limit=3, sort="name", cursor=cursor)
+        assert status == 400 and not body["flag"], cursor
+
+
+def test_upload_part_fd_closed_once(make_api, tmp_path):
+    apid, _ = make_api()
+    _, session = apid.uploads.init("a.bin", 10, 5)
+    for content in [b"abc", b"abcde"]:
+        _, writer = apid.uploads.open_part(session["id"], 0, expected_hash="0" * 64)
+        writer.write(content)
+        fd = writer.fd
+        with pytest.raises(ValueError):
+            writer.commit()
+        # the closed fd number is free to be handed out again meanwhile
+        with open(tmp_path / "other", "wb") as other:
+            assert other.fileno() == fd
+            writer.discard()
+            os.fstat(other.fileno())
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_token_cache(make_api, asgi):
+    apid, client = make_api(
+        asgi=asgi,
+        api_auth=True,
+        api_auth_username="admin",
+        api_auth_password="admin",
+        api_auth_secret_key="secret-key-of-at-least-32-bytes!",
+    )
+    verified = []
+    put = apid.token_cache.put
+    apid.token_cache.put = lambda token, claims: (
+        verified.append(token),
+        put(token, claims),
+    )
+    assert client.get("get/list")[0] == 500
+    status, body = client.post("login", username="admin", password="admin")
+    assert status == 200
+    token = body["data"]
+
+    for _ in range(3):
+        assert client.get("get/list", token=token)[0] == 200
+    assert verified == [token]
+    status, _, _ = client.request(
+        "GET", "get/list", headers={"Authorization": "Bearer " + token}
+    )
+    assert status == 200 and verified == [token]
+
+    # an expired entry is dropped and the token is verified again
+    exp, claims = apid.token_cache.tokens[token]
+    apid.token_cache.tokens[token] = (time.time() - 1, claims)
+    assert client.get("get/list", token=token)[0] == 200
+    assert verified == [token, token]
+    assert apid.token_cache.tokens[token][0] == exp
+    assert client.get("get/list", token=token + "x")[0] != 200
+
+
+def test_token_cache_bounds():
+    cache = TokenCache(maxsize=2)
+    cache.put("a", {"exp": time.time() + 60})
+    cache.put("b", {"exp": time.time() + 60})
+    assert cache.get("a") is not None
+    cache.put("c", {"exp": time.time() + 60})
+    assert list(cache.tokens) == ["a", "c"]
+    cache.put("d", {})
+    assert cache.get("d") is None
+    cache.put("e", {"exp": time.time() - 1})
+    assert cache.get("e") is None and "e" not in cache.tokens
+
+
+def make_tar(*members):
+    """Tar of (name, data) files, or (name, None, linkname) symlinks."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, data, *link in members:
+            info = tarfile.TarInfo(name)
+            if link:
+                info.type = tarfile.SYMTYPE
+                info.linkname = link[0]
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_archive_round_trip(make_api, asgi, tmp_path):
+    apid, client = make_api(asgi=asgi)
+    src = os.path.join(apid.root_path, "pxe")
+    os.makedirs(os.path.join(src, "grub", "empty"))
+    for name, data in [("grub/grub.cfg", b"menu"), ("vmlinuz", bytes(100000))]:
+        with open(os.path.join(src, name), "wb") as f:
+            f.write(data)
+    os.symlink("grub/grub.cfg", os.path.join(src, "default.cfg"))
+
+    for fmt in ["tar", "tar.gz"]:
+        status, _, body = client.request(
+            "GET", "download/archive", {"path": "pxe", "format": fmt}
+        )
+        assert status == 200
+        status, _, _ = client.request(
+            "PUT", "upload/archive", {"path": "copy-" + fmt, "strip": 1}, body
+        )
+        assert status == 200
+        copy = os.path.join(apid.root_path, "copy-" + fmt)
+        assert tree(copy) == tree(src)
+        assert os.readlink(os.path.join(copy, "default.cfg")) == "grub/grub.cfg"
+
+    (tmp_path / "secret.txt").write_bytes(b"top secret content")
+    for path in ["..", "pxe/../.."]:
+        status, _, body = client.request("GET", "download/archive", {"path": path})
+        assert 400 <= status < 500 and b"top secret content" not in body
+        status, _, _ = client.request(
+            "PUT", "upload/archive", {"path": path}, make_tar(("x", b"x"))
+        )
+        assert 400 <= status < 500
+    assert not (tmp_path / "x").exists()
+
+
+@pytest.mark.parametrize(
+    "member",
+    [
+        ("../escape", b"x"),
+        ("a/../../escape", b"x"),
+        ("/tmp/escape", b"x"),
+        ("link", None, "../escape"),
+        ("link", None, "/etc/passwd"),
+        ("a/link", None, "../../escape"),
+    ],
+)
+def test_archive_rejects_escapes(make_api, member):
+    apid, client = make_api()
+    status, _, _ = client.request(
+        "PUT", "upload/archive", {"path": "dest"}, make_tar(("ok", b"ok"), member)
+    )
+    assert status == 500
+    assert os.listdir(apid.root_path) == []
+    assert not os.path.exists(os.path.join(os.path.dirname(apid.root_path), "escape"))
+
+
+def test_archive_merge_rolls_back(make_api, monkeypatch):
+    apid, client = make_api()
+    dest = os.path.join(apid.root_path, "dest")
+    os.mkdir(dest)
+    for name in ["a", "b"]:
+        with open(os.path.join(dest, name), "wb") as f:
+            f.write(b"old " + name.encode())
+    before = tree(apid.root_path)
+    replace = os.replace
+
+    def failing_replace(source, target):
+        if str(target).endswith(os.path.join("new", "c")):
+            raise OSError("disk on fire")
+        return replace(source, target)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    body = make_tar(("a", b"new a"), ("b", b"new b"), ("new/c", b"c"), ("z", b"z"))
+    status, _, _ = client.request("PUT", "upload/archive", {"path": "dest"}, body)
+    assert status == 500
+    assert tree(apid.root_path) == before
+    monkeypatch.setattr(os, "replace", replace)
+    status, _, _ = client.request("PUT", "upload/archive", {"path": "dest"}, body)
+    assert status == 200
+    assert tree(dest) == {
+        "a": b"new a",
+        "b": b"new b",
+        "new": None,
+        "new/c": b"c",
+        "z": b"z",
+    }
+
+
+@pytest.mark.parametrize("asgi", [False, True])
+def test_quota_and_usage(make_api, asgi):
+    apid, client = make_api(asgi=asgi, api_quotas={"images": 1000})
+
+    def upload(filename, size):
+        return client.request(
+            "PUT",
+            "upload/stream",
+            {"path": "images", "filename": filename},
+            bytes(size),
+            {"Content-Length": str(size)},
+        )
+
+    def usage():
+        status, body = client.get("usage", path="images")
+        assert status == 200, body
+        return body["data"]["bytes"], body["data"]["files"], body["data"]["quota"]
+
+    os.mkdir(os.path.join(apid.root_path, "images"))
+    assert upload("a.img", 600)[0] == 200
+    assert usage() == (600, 1, 1000)
+    status, _, body = upload("b.img", 600)
+    assert status == 500 and b"Quota of images exceeded" in body
+    assert not os.path.exists(os.path.join(apid.root_path, "images", "b.img"))
+    assert usage() == (600, 1, 1000)
+    # replacing a file only counts the difference
+    assert upload("a.img", 900)[0] == 200
+    assert usage() == (900, 1, 1000)
+    status, body = client.post(
+        "upload/session/init", path="images", filename="c.img", size=200, part_size=100
+    )
+    assert status == 500 and "Quota" in body["message"]
+    assert client.post("delete/file", path="images/a.img")[0] == 200
+    assert usage() == (0, 0, 1000)
+    assert upload("b.img", 1000)[0] == 200
+    _, body = client.get("usage", depth=1)
+    assert body["data"]["bytes"] == 1000
+    assert [(c["path"], c["bytes"]) for c in body["data"]["children"]] == [
+        ("images", 1000)
+    ]
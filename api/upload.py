@@ -0,0 +1,323 @@
+import os
+import re
+import json
+import uuid
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+import contextlib
+from pathlib import Path
+from .watch import EVENT_CREATE, EVENT_MODIFY
+
+
+class UploadSessionManager:
+    """
+    Resumable multi-part uploads.
+
+    A session preallocates a `.filepart` file next to the target, parts are
+    written into it with `os.pwrite` at `part * part_size` so they can arrive
+    in any order and in parallel, and commit renames it over the target.
+    Session state is kept as JSON in `session_dir`, guarded by a lock file,
+    so an interrupted upload can be resumed after a restart and parts can be
+    handled by any worker process of a pre-fork server.
+    """
+
+    SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, fs, session_dir=None, max_size=None, hash_name="sha256"):
+        self.fs = fs
+        self.session_dir = (
+            os.path.join(tempfile.gettempdir(), "tftp-api-upload-sessions")
+            if session_dir is None
+            else os.path.abspath(session_dir)
+        )
+        self.max_size = max_size
+        self.hash_name = hash_name
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(self.session_dir, exist_ok=True)
+
+    def _session_file(self, session_id):
+        return os.path.join(self.session_dir, "{}.json".format(session_id))
+
+    def _save(self, session):
+        session_file = self._session_file(session["id"])
+        temp_file = "{}.tmp".format(session_file)
+        with open(temp_file, "w") as f:
+            json.dump(session, f)
+        os.replace(temp_file, session_file)
+
+    def _valid_id(self, session_id):
+        return session_id is not None and self.SESSION_ID_RE.match(session_id)
+
+    @contextlib.contextmanager
+    def _locked(self, session_id):
+        """Serialize session state updates across threads and processes."""
+        fd = os.open(
+            "{}.lock".format(self._session_file(session_id)),
+            os.O_RDWR | os.O_CREAT,
+            0o644,
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _load(self, session_id):
+        try:
+            with open(self._session_file(session_id), "r") as f:
+                return True, json.load(f)
+        except FileNotFoundError:
+            return False, "Upload session {} not found".format(session_id)
+
+    def _remove(self, session_id):
+        Path(self._session_file(session_id)).unlink(missing_ok=True)
+        Path("{}.lock".format(self._session_file(session_id))).unlink(missing_ok=True)
+
+    def _part_range(self, session, part_number):
+        offset = part_number * session["part_size"]
+        return offset, min(session["part_size"], session["size"] - offset)
+
+    def _status(self, session):
+        received = sorted(int(n) for n in session["parts"])
+        return {
+            "id": session["id"],
+            "path": session["path"],
+            "size": session["size"],
+            "part_size": session["part_size"],
+            "part_count": session["part_count"],
+            "received_parts": received,
+            "missing_parts": [
+                n
+                for n in range(session["part_count"])
+                if str(n) not in session["parts"]
+            ],
+            "received_size": sum(p["size"] for p in session["parts"].values()),
+        }
+
+    def init(self, file_path, size, part_size, expected_hash=None):
+        """Create an upload session and preallocate its temp file."""
+        if size < 0 or part_size <= 0:
+            return False, "Invalid size or part size"
+        if self.max_size is not None and size > self.max_size:
+            return False, "File exceeds max upload size {}".format(self.max_size)
+        valid, abs_path = self.fs._validate_and_get_abs_path(file_path)
+        if not valid:
+            return valid, abs_path
+        fits, error = self.fs.check_space(abs_path, size)
+        if not fits:
+            return fits, error
+        session_id = uuid.uuid4().hex
+        temp_path = abs_path.parent / "{}-{}.filepart".format(abs_path.name, session_id)
+        try:
+            abs_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                if size > 0 and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+        except Exception as e:
+            temp_path.unlink(missing_ok=True)
+            return False, str(e)
+        session = {
+            "id": session_id,
+            "path": str(abs_path.relative_to(self.fs.root_path)),
+            "temp_path": str(temp_path.relative_to(self.fs.root_path)),
+            "size": size,
+            "part_size": part_size,
+            "part_count": max(1, -(-size // part_size)),
+            "hash": expected_hash.lower() if expected_hash else None,
+            "parts": {},
+            "created": time.time(),
+        }
+        with self._locked(session_id):
+            self._save(session)
+        self.logger.info("Upload session {} created: {}".format(session_id, abs_path))
+        return True, self._status(session)
+
+    def open_part(self, session_id, part_number, offset=None, expected_hash=None):
+        """Open a `PartWriter` for one part, see `write_part`."""
+        if not self._valid_id(session_id):
+            return False, "Invalid session id"
+        with self._locked(session_id):
+            found, session = self._load(session_id)
+            if found and session["parts"].pop(str(part_number), None) is not None:
+                # a part being rewritten is not received until verified again
+                self._save(session)
+        if not found:
+            return found, session
+        if part_number < 0 or part_number >= session["part_count"]:
+            return False, "Invalid part number {}".format(part_number)
+        part_offset, part_size = self._part_range(session, part_number)
+        if offset is not None and offset != part_offset:
+            return False, "Part {} must start at offset {}".format(
+                part_number, part_offset
+            )
+        try:
+            return True, PartWriter(
+                self, session, part_number, part_offset, part_size, expected_hash
+            )
+        except Exception as e:
+            return False, str(e)
+
+    def write_part(
+        self, session_id, part_number, stream, offset=None, expected_hash=None
+    ):
+        """Write one part at its offset, verifying its checksum."""
+        success, writer = self.open_part(session_id, part_number, offset, expected_hash)
+        if not success:
+            return success, writer
+        try:
+            while True:
+                chunk = stream.read(self.fs.write_chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+            return True, writer.commit()
+        except Exception as e:
+            writer.discard()
+            return False, str(e)
+
+    def _record_part(self, session_id, part_number, size, digest):
+        with self._locked(session_id):
+            found, session = self._load(session_id)
+            if not found:
+                raise ValueError(session)
+            session["parts"][str(part_number)] = {"size": size, "hash": digest}
+            self._save(session)
+
+    def status(self, session_id):
+        if not self._valid_id(session_id):
+            return False, "Invalid session id"
+        with self._locked(session_id):
+            found, session = self._load(session_id)
+            if not found:
+                return found, session
+            return True, self._status(session)
+
+    def commit(self, session_id):
+        """Check all parts are present, verify the file hash and move it in place."""
+        if not self._valid_id(session_id):
+            return False, "Invalid session id"
+        with self._locked(session_id):
+            found, session = self._load(session_id)
+            if not found:
+                return found, session
+            status = self._status(session)
+        if status["missing_parts"]:
+            return False, "Missing parts: {}".format(status["missing_parts"])
+        temp_path = Path(self.fs.root_path) / session["temp_path"]
+        abs_path = Path(self.fs.root_path) / session["path"]
+        digest = None
+        if session["hash"] is not None:
+            hasher = hashlib.new(self.hash_name)
+            with temp_path.open("rb") as f:
+                while True:
+                    chunk = f.read(self.fs.write_chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+            if digest != session["hash"]:
+                return False, "Checksum mismatch: {} != {}".format(
+                    session["hash"], digest
+                )
+        try:
+            with temp_path.open("rb+") as f:
+                os.fsync(f.fileno())
+            existed = abs_path.exists()
+            os.replace(temp_path, abs_path)
+        except Exception as e:
+            return False, str(e)
+        self.fs.record_hash(abs_path, self.hash_name, digest)
+        with self._locked(session_id):
+            self._remove(session_id)
+        self.logger.info("Upload session {} committed: {}".format(session_id, abs_path))
+        self.fs.notify(EVENT_MODIFY if existed else EVENT_CREATE, abs_path)
+        return True, {
+            "path": session["path"],
+            "size": session["size"],
+            self.hash_name: digest,
+        }
+
+    def abort(self, session_id):
+        if not self._valid_id(session_id):
+            return False, "Invalid session id"
+        with self._locked(session_id):
+            found, session = self._load(session_id)
+            if not found:
+                return found, session
+            self._remove(session_id)
+        (Path(self.fs.root_path) / session["temp_path"]).unlink(missing_ok=True)
+        self.logger.info("Upload session {} aborted".format(session_id))
+        return True, None
+
+
+class PartWriter:
+    """Write one part of an upload session with os.pwrite, see `FileWriter`."""
+
+    def __init__(self, manager, session, part_number, offset, size, expected_hash):
+        self.manager = manager
+        self.session_id = session["id"]
+        self.part_number = part_number
+        self.offset = offset
+        self.size = size
+        self.expected_hash = expected_hash
+        self.hasher = hashlib.new(manager.hash_name)
+        self.written = 0
+        self.fd = os.open(
+            Path(manager.fs.root_path) / session["temp_path"], os.O_WRONLY
+        )
+
+    def write(self, chunk):
+        if self.written + len(chunk) > self.size:
+            raise ValueError(
+                "Part {} exceeds its size {}".format(self.part_number, self.size)
+            )
+        self.hasher.update(chunk)
+        while chunk:
+            n = os.pwrite(self.fd, chunk, self.offset + self.written)
+            self.written += n
+            chunk = chunk[n:]
+
+    def _close(self):
+        # forget the fd once closed, its number may be reused by another file
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def commit(self):
+        self._close()
+        if self.written != self.size:
+            raise ValueError(
+                "Part {} is incomplete: {}/{} bytes".format(
+                    self.part_number, self.written, self.size
+                )
+            )
+        digest = self.hasher.hexdigest()
+        if self.expected_hash is not None and self.expected_hash.lower() != digest:
+            raise ValueError(
+                "Checksum mismatch for part {}: {} != {}".format(
+                    self.part_number, self.expected_hash, digest
+                )
+            )
+        self.manager._record_part(
+            self.session_id, self.part_number, self.written, digest
+        )
+        return {
+            "part": self.part_number,
+            "offset": self.offset,
+            "size": self.written,
+            self.manager.hash_name: digest,
+        }
+
+    def discard(self):
+        try:
+            self._close()
+        except OSError:
+            pass
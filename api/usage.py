@@ -0,0 +1,199 @@
+import os
+import shutil
+import logging
+import threading
+from .watch import (
+    EVENT_CREATE,
+    EVENT_MODIFY,
+    EVENT_DELETE,
+    EVENT_RESCAN,
+    scan_tree,
+)
+
+
+def _ancestors(rel_path):
+    """Parent folders of rel_path, nearest first, ending with the root ""."""
+    parent = os.path.dirname(rel_path)
+    while True:
+        yield parent
+        if not parent:
+            return
+        parent = os.path.dirname(parent)
+
+
+class UsageTracker:
+    """
+    Per-folder disk usage under root_path, kept current from change events.
+
+    Built once with `os.scandir`, then every create, modify or delete only
+    updates the totals of the changed entry's ancestors, see `apply`.
+    Optional quotas (folder -> max bytes) and a minimum of free disk space
+    are enforced by `check` before anything is written.
+    """
+
+    def __init__(self, root_path, quotas=None, min_free=0):
+        self.root_path = os.path.abspath(root_path)
+        self.quotas = {}
+        for path, limit in (quotas or {}).items():
+            path = os.path.normpath(path.strip("/"))
+            self.quotas["" if path == "." else path] = int(limit)
+        self.min_free = min_free
+        self.files = {}  # rel_path -> size
+        self.dirs = {"": [0, 0, 0]}  # rel dir -> [bytes, files, dirs] of subtree
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger(__name__)
+
+    def build(self):
+        files = {}
+        dirs = {"": [0, 0, 0]}
+        for rel_path, is_dir, size, _ in scan_tree(self.root_path):
+            if is_dir:
+                dirs.setdefault(rel_path, [0, 0, 0])
+            else:
+                files[rel_path] = size
+            for parent in _ancestors(rel_path):
+                totals = dirs.setdefault(parent, [0, 0, 0])
+                if is_dir:
+                    totals[2] += 1
+                else:
+                    totals[0] += size
+                    totals[1] += 1
+        with self.lock:
+            self.files = files
+            self.dirs = dirs
+        self.logger.info(
+            "Usage of {}: {} bytes in {} files".format(
+                self.root_path, dirs[""][0], dirs[""][1]
+            )
+        )
+
+    def _add(self, rel_path, delta_bytes, delta_files, delta_dirs):
+        for parent in _ancestors(rel_path):
+            if parent not in self.dirs:
+                # parent reported after its content, count it now
+                self._add_dir(parent)
+            totals = self.dirs[parent]
+            totals[0] += delta_bytes
+            totals[1] += delta_files
+            totals[2] += delta_dirs
+
+    def _add_dir(self, rel_path):
+        self.dirs[rel_path] = [0, 0, 0]
+        self._add(rel_path, 0, 0, 1)
+
+    def _set_file(self, rel_path):
+        try:
+            size = os.stat(os.path.join(self.root_path, rel_path)).st_size
+        except OSError:
+            self._remove(rel_path)
+            return
+        if rel_path in self.dirs:
+            self._remove(rel_path)  # was a folder
+        old = self.files.get(rel_path, None)
+        self.files[rel_path] = size
+        self._add(rel_path, size - (old or 0), 0 if old is not None else 1, 0)
+
+    def _remove(self, rel_path):
+        if rel_path in self.files:
+            self._add(rel_path, -self.files.pop(rel_path), -1, 0)
+        elif rel_path in self.dirs and rel_path:
+            size, files, dirs = self.dirs[rel_path]
+            self._add(rel_path, -size, -files, -dirs - 1)
+            prefix = os.path.join(rel_path, "")
+            for key in [k for k in self.files if k.startswith(prefix)]:
+                del self.files[key]
+            for key in [k for k in self.dirs if k == rel_path or k.startswith(prefix)]:
+                del self.dirs[key]
+
+    def apply(self, event, rel_path, is_dir=False):
+        """Update totals from a change event, see `watch.FileWatcher`."""
+        if event == EVENT_RESCAN or not rel_path:
+            if event in (EVENT_RESCAN, EVENT_CREATE):
+                self.build()
+            return
+        with self.lock:
+            if event == EVENT_DELETE:
+                self._remove(rel_path)
+            elif event in (EVENT_CREATE, EVENT_MODIFY):
+                if not is_dir:
+                    self._set_file(rel_path)
+                elif rel_path not in self.dirs:
+                    self._remove(rel_path)  # was a file
+                    self._add_dir(rel_path)
+                    for sub_path, sub_is_dir, _, _ in scan_tree(
+                        self.root_path, rel_path
+                    ):
+                        if sub_is_dir:
+                            if sub_path not in self.dirs:
+                                self._add_dir(sub_path)
+                        else:
+                            self._set_file(sub_path)
+
+    def check(self, rel_path, size=None, is_dir=False):
+        """
+        Check a write of `size` bytes (None when unknown) to the file at
+        rel_path, replacing its current content, or into the folder at
+        rel_path when is_dir.
+
+        Returns (True, max size the file may be written with or None when
+        unlimited), or (False, reason) when it does not fit.
+        """
+        limits = []
+        parents = list(_ancestors(rel_path))
+        if is_dir and rel_path:
+            parents.insert(0, rel_path)
+        with self.lock:
+            current = 0 if is_dir else self.files.get(rel_path, 0)
+            for parent in parents:
+                quota = self.quotas.get(parent, None)
+                if quota is None:
+                    continue
+                used = self.dirs.get(parent, [0])[0]
+                limit = quota - used + current
+                if limit <= 0 or (size is not None and size > limit):
+                    return False, "Quota of {} exceeded: {} of {} bytes used{}".format(
+                        parent or "/",
+                        used,
+                        quota,
+                        "" if size is None else ", {} requested".format(size),
+                    )
+                limits.append(limit)
+        if self.min_free > 0 or size is not None:
+            free = shutil.disk_usage(self.root_path).free
+            # the new content is complete before the old one is removed
+            limit = free - self.min_free
+            if limit <= 0 or (size is not None and size > limit):
+                return False, "Not enough free disk space: {} bytes free".format(free)
+            if self.min_free > 0:
+                limits.append(limit)
+        return True, min(limits) if limits else None
+
+    def usage(self, rel_dir="", depth=1):
+        """Totals of rel_dir and of its sub folders down to `depth` levels."""
+        rel_dir = os.path.normpath(rel_dir.strip("/"))
+        rel_dir = "" if rel_dir == "." else rel_dir
+        with self.lock:
+            if rel_dir not in self.dirs:
+                return False, "Folder {} does not exist".format(rel_dir)
+            result = self._usage(rel_dir, depth)
+        disk = shutil.disk_usage(self.root_path)
+        result["disk"] = {"total": disk.total, "used": disk.used, "free": disk.free}
+        return True, result
+
+    def _usage(self, rel_dir, depth):
+        size, files, dirs = self.dirs[rel_dir]
+        result = {
+            "path": rel_dir,
+            "bytes": size,
+            "files": files,
+            "dirs": dirs,
+            "quota": self.quotas.get(rel_dir, None),
+        }
+        if depth > 0:
+            prefix = os.path.join(rel_dir, "") if rel_dir else ""
+            result["children"] = [
+                self._usage(path, depth - 1)
+                for path in sorted(self.dirs)
+                if path and path.startswith(prefix) and os.path.dirname(path) == rel_dir
+            ]
+        return result
@@ -0,0 +1,226 @@
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Event types passed to listeners as (event, rel_path, is_dir)
+EVENT_CREATE = "create"
+EVENT_MODIFY = "modify"
+EVENT_DELETE = "delete"
+EVENT_RESCAN = "rescan"  # events were lost, listeners should resync
+
+
+def scan_tree(root_path, rel_dir=""):
+    """Yield (rel_path, is_dir, size, mtime_ns) for everything under rel_dir."""
+    stack = [rel_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root_path, current))
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                rel_path = os.path.join(current, entry.name) if current else entry.name
+                try:
+                    is_dir = entry.is_dir()
+                    st = entry.stat()
+                except OSError:
+                    continue
+                yield rel_path, is_dir, None if is_dir else st.st_size, st.st_mtime_ns
+                if is_dir and not entry.is_symlink():
+                    stack.append(rel_path)
+
+
+class FileWatcher(threading.Thread):
+    """
+    Watch a directory tree and report changes to listeners.
+
+    Uses inotify when available, otherwise (or when `mode` is "poll")
+    rescans the tree every `poll_interval` seconds and diffs the snapshots.
+    """
+
+    def __init__(self, root_path, mode="auto", poll_interval=5.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.root_path = os.path.abspath(root_path)
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self.logger = logging.getLogger(__name__)
+        self._stop_event = threading.Event()
+        self._inotify_fd = None
+        self._libc = None
+        self._wds = {}  # watch descriptor -> rel dir path
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _emit(self, event, rel_path, is_dir):
+        for listener in self.listeners:
+            try:
+                listener(event, rel_path, is_dir)
+            except Exception as e:
+                self.logger.warning("Watch listener error: {}".format(e))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        if self.mode != "poll" and self._init_inotify():
+            self.logger.info("Watching {} with inotify".format(self.root_path))
+            self._run_inotify()
+        else:
+            self.logger.info(
+                "Watching {} by polling every {}s".format(
+                    self.root_path, self.poll_interval
+                )
+            )
+            self._run_poll()
+
+    # polling
+
+    def _snapshot(self):
+        return {
+            rel_path: (is_dir, size, mtime_ns)
+            for rel_path, is_dir, size, mtime_ns in scan_tree(self.root_path)
+        }
+
+    def _run_poll(self):
+        previous = self._snapshot()
+        while not self._stop_event.wait(self.poll_interval):
+            current = self._snapshot()
+            for rel_path in previous.keys() - current.keys():
+                self._emit(EVENT_DELETE, rel_path, previous[rel_path][0])
+            for rel_path, state in current.items():
+                old = previous.get(rel_path, None)
+                if old is None:
+                    self._emit(EVENT_CREATE, rel_path, state[0])
+                elif old != state and not state[0]:
+                    self._emit(EVENT_MODIFY, rel_path, state[0])
+            previous = current
+
+    # inotify
+
+    def _init_inotify(self):
+        try:
+            self._libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+            )
+            fd = self._libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            self.logger.info("inotify unavailable: {}".format(e))
+            return False
+        if fd < 0:
+            self.logger.info(
+                "inotify unavailable: {}".format(os.strerror(ctypes.get_errno()))
+            )
+            return False
+        self._inotify_fd = fd
+        if not self._add_watch_tree(""):
+            os.close(fd)
+            self._inotify_fd = None
+            self._wds.clear()
+            return False
+        return True
+
+    def _add_watch(self, rel_dir):
+        path = os.path.join(self.root_path, rel_dir).encode()
+        wd = self._libc.inotify_add_watch(self._inotify_fd, path, WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            self.logger.warning(
+                "inotify watch {} failed: {}".format(path, os.strerror(errno))
+            )
+            return False
+        self._wds[wd] = rel_dir
+        return True
+
+    def _add_watch_tree(self, rel_dir, emit=False):
+        if not self._add_watch(rel_dir):
+            return False
+        for rel_path, is_dir, _, _ in scan_tree(self.root_path, rel_dir):
+            if emit:
+                # entries created before the new watch was in place
+                self._emit(EVENT_CREATE, rel_path, is_dir)
+            if is_dir and not os.path.islink(os.path.join(self.root_path, rel_path)):
+                if not self._add_watch(rel_path):
+                    return False
+        return True
+
+    def _remove_watch_tree(self, rel_dir):
+        prefix = os.path.join(rel_dir, "")
+        for wd, path in list(self._wds.items()):
+            if path == rel_dir or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._inotify_fd, wd)
+                self._wds.pop(wd, None)
+
+    def _run_inotify(self):
+        try:
+            while not self._stop_event.is_set():
+                rlist, _, _ = select.select([self._inotify_fd], [], [], 1)
+                if not rlist:
+                    continue
+                buf = os.read(self._inotify_fd, 64 * 1024)
+                offset = 0
+                while offset < len(buf):
+                    wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                    offset += EVENT_HEADER.size
+                    name = buf[offset : offset + length].rstrip(b"\0")
+                    offset += length
+                    self._handle_inotify_event(wd, mask, os.fsdecode(name))
+        finally:
+            os.close(self._inotify_fd)
+
+    def _handle_inotify_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._emit(EVENT_RESCAN, "", True)
+            return
+        if mask & IN_IGNORED:
+            self._wds.pop(wd, None)
+            return
+        rel_dir = self._wds.get(wd, None)
+        if rel_dir is None or not name:
+            return
+        rel_path = os.path.join(rel_dir, name) if rel_dir else name
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self._emit(EVENT_CREATE, rel_path, is_dir)
+            if is_dir:
+                self._add_watch_tree(rel_path, emit=True)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if is_dir:
+                self._remove_watch_tree(rel_path)
+            self._emit(EVENT_DELETE, rel_path, is_dir)
+        elif mask & (IN_CLOSE_WRITE | IN_ATTRIB):
+            self._emit(EVENT_MODIFY, rel_path, is_dir)
@@ -0,0 +1,262 @@
+#!/bin/python3
+import os
+import sys
+import copy
+import json
+import uuid
+import signal
+import argparse
+import threading
+from tftp import tftp, cache, profiling, audit
+from api import api, aio
+
+SETTINGS = {
+    "root_path": "files",
+    "debug": False,
+    # TFTPD server settings
+    "tftp": {
+        "ip": "0.0.0.0",
+        "port": 69,
+        "wrq_enable": False,
+        "retries": 3,
+        "timeout": 5,
+        "min_free_space": 0,
+        "mode_verbose": True,
+        "profile_slow": None,  # seconds, log time per phase of slower transfers
+        "profile_dump": None,
+        "profile_dir": None,  # sampling profiles, toggled by SIGUSR1 or the api
+        "readahead": 128 * 1024,  # bytes read ahead of downloads, 0 disables
+        "readahead_workers": 4,
+        "readahead_dontneed": True,  # drop files read once from the page cache
+        "thread_stack_size": 0,  # bytes per transfer thread, 0: platform default
+        "audit": None,  # transfer audit log, sqlite (.db, .sqlite) or json lines
+    },
+    # FileSystemAPID arguments, plus api_io_workers/api_bulk_workers for asgi
+    "api": {
+        "api_name": "api",
+        "api_host": "localhost",
+        "api_port": 5000,
+        "api_server": "threaded",
+    },
+    # file content cache shared by both servers
+    "cache": {
+        "enable": True,
+        "max_bytes": 256 * 1024 * 1024,
+        "max_file_size": 64 * 1024 * 1024,
+        "warm_on_write": True,
+        "preload": [],  # paths loaded before serving
+    },
+}
+
+
+def parse_cli_arguments():
+    parser = argparse.ArgumentParser(
+        description="TFTP Server and File API in one process",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--config",
+        action="store",
+        dest="CONFIG",
+        help="json config file with tftp, api and cache sections",
+        default=None,
+    )
+    parser.add_argument(
+        "--root-path",
+        action="store",
+        dest="ROOT_PATH",
+        help="root path served by both servers, overrides the config file",
+        default=None,
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        dest="DEBUG",
+        help="debug mode enable",
+        default=None,
+    )
+    return parser.parse_args()
+
+
+def load_config(path=None):
+    """Default settings updated section by section from a json file."""
+    settings = copy.deepcopy(SETTINGS)
+    if path is not None:
+        with open(path, "r") as f:
+            config = json.load(f)
+        for key, value in config.items():
+            if isinstance(value, dict) and isinstance(settings.get(key, None), dict):
+                settings[key].update(value)
+            else:
+                settings[key] = value
+    return settings
+
+
+class ConfigReloader:
+    """
+    Re-read the config file and apply it without dropping transfers.
+
+    The tftp section goes to `TFTPD.reload`, so running transfers finish
+    under their old settings, and the cache limits are changed keeping the
+    entries that still fit. The root path, debug and api sections need a
+    restart, they are reported in `restart_required`.
+    """
+
+    def __init__(self, path, overrides=None):
+        self.path = path
+        self.overrides = overrides or {}  # command line settings
+        self.settings = None
+        self.tftpd = None
+        self.file_cache = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        settings = load_config(self.path)
+        settings.update(self.overrides)
+        return settings
+
+    def attach(self, settings, tftpd, file_cache):
+        self.settings = settings
+        self.tftpd = tftpd
+        self.file_cache = file_cache
+
+    def reload(self):
+        with self.lock:
+            try:
+                settings = self.load()
+            except (OSError, ValueError) as e:
+                return False, "Cannot read config {}: {}".format(self.path, e)
+            tftp_settings = dict(settings["tftp"])
+            # the audit sink is shared with the api
+            tftp_settings.pop("audit", None)
+            success, data_or_error = self.tftpd.reload(**tftp_settings)
+            if not success:
+                return False, data_or_error
+            cache_settings = dict(settings["cache"])
+            if self.file_cache is not None and cache_settings.pop("enable", True):
+                cache_settings.pop("preload", None)
+                self.file_cache.configure(**cache_settings)
+            data_or_error["restart_required"] = (
+                [
+                    key
+                    for key in ("root_path", "debug", "api")
+                    if settings[key] != self.settings[key]
+                ]
+                + (
+                    ["cache"]
+                    if settings["cache"]["enable"] != self.settings["cache"]["enable"]
+                    else []
+                )
+                + (
+                    ["tftp.audit"]
+                    if settings["tftp"]["audit"] != self.settings["tftp"]["audit"]
+                    else []
+                )
+            )
+            self.settings["tftp"] = settings["tftp"]
+            self.settings["cache"] = settings["cache"]
+            return True, data_or_error
+
+
+def create_servers(settings, reloader=None):
+    """Create the TFTP and API servers sharing root path, cache and usage."""
+    root_path = os.path.abspath(settings["root_path"])
+    debug = settings["debug"]
+    api_settings = dict(settings["api"])
+    api_server = api_settings.get("api_server", "threaded")
+    if api_server == "gunicorn":
+        # workers are forked processes, they would not share the cache
+        raise Exception("api_server gunicorn is not supported in a single process")
+    if api_server == "flask" and debug:
+        # the flask reloader would start a second tftp server
+        api_settings["api_server"] = "threaded"
+
+    cache_settings = dict(settings["cache"])
+    file_cache = None
+    if cache_settings.pop("enable", True):
+        preload = cache_settings.pop("preload", [])
+        file_cache = cache.FileCache(root_path, **cache_settings)
+        for path in preload:
+            success, data_or_error = file_cache.preload(path)
+            if not success:
+                raise Exception("Preload of {} failed: {}".format(path, data_or_error))
+
+    tftp_settings = dict(settings["tftp"])
+    profiler = profiling.SamplingProfiler(tftp_settings.get("profile_dir", None))
+    # shared with the api for queries, created here so a reload keeps it
+    audit_sink = None
+    if tftp_settings.pop("audit", None):
+        audit_sink = audit.AuditSink(settings["tftp"]["audit"])
+
+    api_name = api_settings.pop("api_name", "api")
+    api_class = aio.AsyncFileSystemAPID if api_server == "asgi" else api.FileSystemAPID
+    fsapid = api_class(
+        name=f"{api_name}-{uuid.uuid4()}",
+        root_path=root_path,
+        api_name=api_name,
+        cache=file_cache,
+        profiler=profiler,
+        reloader=reloader,
+        audit=audit_sink,
+        debug=debug,
+        **api_settings,
+    )
+    tftpd = tftp.TFTPD(
+        file_dir=root_path,
+        mode_debug=debug,
+        usage=fsapid.usage,
+        cache=file_cache,
+        profiler=profiler,
+        audit=audit_sink,
+        **tftp_settings,
+    )
+    if reloader is not None:
+        reloader.attach(settings, tftpd, file_cache)
+    return tftpd, fsapid
+
+
+def main():
+    args = parse_cli_arguments()
+    overrides = {}
+    if args.ROOT_PATH is not None:
+        overrides["root_path"] = args.ROOT_PATH
+    if args.DEBUG is not None:
+        overrides["debug"] = args.DEBUG
+    reloader = ConfigReloader(args.CONFIG, overrides)
+    settings = reloader.load()
+
+    # warn the user that they are starting PyPXE as non-root user
+    if os.getuid() != 0:
+        print(
+            "\nWARNING: Not root. Servers will probably fail to bind.\n",
+            file=sys.stderr,
+        )
+
+    tftpd, fsapid = create_servers(settings, reloader)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: tftpd.profiler.toggle())
+
+    def reload():
+        success, data_or_error = reloader.reload()
+        if not success:
+            tftpd.logger.warning("Reload failed: {}".format(data_or_error))
+        elif data_or_error["restart_required"]:
+            tftpd.logger.warning(
+                "Restart to apply: {}".format(
+                    ", ".join(data_or_error["restart_required"])
+                )
+            )
+
+    # kill -HUP re-reads the config file, off the interrupted thread which
+    # may hold a lock the reload takes
+    signal.signal(
+        signal.SIGHUP,
+        lambda signum, frame: threading.Thread(
+            target=reload, name="reload", daemon=True
+        ).start(),
+    )
+    threading.Thread(target=tftpd.run, name="tftpd", daemon=True).start()
+    fsapid.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+import os
+import sys
+import json
+import glob
+import time
+import queue
+import sqlite3
+import logging
+import argparse
+import threading
+import contextlib
+from collections import defaultdict
+
+AUDIT_FIELDS = (
+    "time",
+    "client",
+    "port",
+    "op",
+    "filename",
+    "bytes",
+    "blocks",
+    "duration",
+    "retransmits",
+    "timeouts",
+    "duplicates",
+    "outcome",
+    "error",
+)
+OPS = {1: "rrq", 2: "wrq"}
+# transfer outcomes
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"  # an error was sent to the client
+OUTCOME_ABORTED = "aborted"  # by the client
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class AuditSink:
+    """
+    Record of every finished transfer for capacity planning.
+
+    `write` is a TFTPD finish listener that only puts a record on a bounded
+    queue, a full queue drops the record and counts it, so the transfer
+    threads never wait on the disk. A background thread writes the queue in
+    batches of up to `batch_size` records, at least every `flush_interval`
+    seconds, to a SQLite database (.db, .sqlite, .sqlite3) or to JSON lines
+    files rotated at `max_bytes` with `backups` older files kept.
+    """
+
+    def __init__(
+        self,
+        path,
+        batch_size=256,
+        flush_interval=1.0,
+        queue_size=10000,
+        max_bytes=64 * 1024 * 1024,
+        backups=5,
+    ):
+        self.path = os.path.abspath(path)
+        self.sqlite = os.path.splitext(path)[1] in (".db", ".sqlite", ".sqlite3")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.batch_done = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+        if self.sqlite:
+            self._init_db()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="tftp-audit", daemon=True)
+        self.thread.start()
+
+    @contextlib.contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS transfers ("
+                "time REAL, client TEXT, port INTEGER, op TEXT, filename TEXT, "
+                "bytes INTEGER, blocks INTEGER, duration REAL, "
+                "retransmits INTEGER, timeouts INTEGER, duplicates INTEGER, "
+                "outcome TEXT, error INTEGER)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS transfers_time ON transfers (time)"
+            )
+
+    def write(self, handler):
+        """Finish listener, see `TFTPD.finish_listeners`."""
+        from tftp.tftp import STATE_DONE
+
+        if handler.error_code is not None:
+            outcome = OUTCOME_ERROR
+        elif handler.state == STATE_DONE:
+            outcome = OUTCOME_OK
+        else:
+            outcome = OUTCOME_ABORTED
+        record = (
+            handler.time_ns / 1e9,
+            handler.address[0],
+            handler.address[1],
+            OPS.get(handler.opcode, str(handler.opcode)),
+            handler.filename,
+            handler.bytes,
+            handler.blocks,
+            handler.elapsed,
+            handler.retransmits,
+            handler.timeouts,
+            handler.duplicates,
+            outcome,
+            handler.error_code,
+        )
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _run(self):
+        while not self.stop_event.is_set() or not self.queue.empty():
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if self.stop_event.is_set() and self.queue.empty():
+                    break
+            if not batch:
+                continue
+            try:
+                if self.sqlite:
+                    self._write_db(batch)
+                else:
+                    self._write_jsonl(batch)
+                with self.lock:
+                    self.written += len(batch)
+                    self.batches += 1
+            except Exception as e:
+                # the batch is lost, the thread keeps writing the next ones
+                with self.lock:
+                    self.errors += len(batch)
+                self.logger.warning("Audit write of {} failed: {}".format(self.path, e))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+                with self.batch_done:
+                    self.batch_done.notify_all()
+
+    def _write_db(self, batch):
+        with self._db() as conn:
+            conn.executemany(
+                "INSERT INTO transfers VALUES ({})".format(
+                    ", ".join("?" * len(AUDIT_FIELDS))
+                ),
+                batch,
+            )
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            older = "{}.{}".format(self.path, index)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.path, index + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+
+    def _write_jsonl(self, batch):
+        lines = "".join(
+            json.dumps(dict(zip(AUDIT_FIELDS, record))) + "\n" for record in batch
+        )
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size > 0 and size + len(lines) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+    def flush(self, timeout=5.0):
+        """Wait until queued records are written, False on timeout."""
+        if not self.thread.is_alive():
+            return not self.queue.unfinished_tasks
+        with self.batch_done:
+            return self.batch_done.wait_for(
+                lambda: not self.queue.unfinished_tasks, timeout
+            )
+
+    def _records(self, since):
+        """Records of the JSON lines files, oldest file first."""
+        paths = sorted(
+            (
+                path
+                for path in glob.glob(glob.escape(self.path) + ".*")
+                if path.rsplit(".", 1)[1].isdigit()
+            ),
+            key=lambda path: -int(path.rsplit(".", 1)[1]),
+        ) + [self.path]
+        for path in paths:
+            try:
+                with open(path, "r") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # torn tail of a crash
+                            continue
+                        if since is None or record["time"] >= since:
+                            yield record
+            except FileNotFoundError:
+                continue
+
+    def _query_db(self, since, limit):
+        where, params = "", ()
+        if since is not None:
+            where, params = " WHERE time >= ?", (since,)
+        with self._db() as conn:
+            totals = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), "
+                "COALESCE(SUM(retransmits), 0) FROM transfers" + where,
+                params,
+            ).fetchone()
+            outcomes = dict(
+                conn.execute(
+                    "SELECT outcome, COUNT(*) FROM transfers{} GROUP BY outcome".format(
+                        where
+                    ),
+                    params,
+                ).fetchall()
+            )
+            durations = {}
+            for fraction in (0.5, 0.95):
+                row = conn.execute(
+                    "SELECT duration FROM transfers{} ORDER BY duration "
+                    "LIMIT 1 OFFSET ?".format(where),
+                    params + (max(0, min(totals[0] - 1, int(totals[0] * fraction))),),
+                ).fetchone()
+                durations[fraction] = row[0] if row else 0.0
+            top_files = conn.execute(
+                "SELECT filename, COUNT(*) AS n, SUM(bytes) FROM transfers{} "
+                "GROUP BY filename ORDER BY n DESC, filename LIMIT ?".format(where),
+                params + (limit,),
+            ).fetchall()
+            clients = conn.execute(
+                "SELECT client, COUNT(*), SUM(bytes) AS b FROM transfers{} "
+                "GROUP BY client ORDER BY b DESC, client LIMIT ?".format(where),
+                params + (limit,),
+            ).fetchall()
+        return totals, outcomes, durations, top_files, clients
+
+    def _query_jsonl(self, since, limit):
+        count = total_bytes = retransmits = 0
+        outcomes = defaultdict(int)
+        durations = []
+        files = defaultdict(lambda: [0, 0])
+        clients = defaultdict(lambda: [0, 0])
+        for record in self._records(since):
+            count += 1
+            total_bytes += record["bytes"]
+            retransmits += record["retransmits"]
+            outcomes[record["outcome"]] += 1
+            durations.append(record["duration"])
+            for stats in (files[record["filename"]], clients[record["client"]]):
+                stats[0] += 1
+                stats[1] += record["bytes"]
+        top_files = sorted(files.items(), key=lambda item: (-item[1][0], item[0]))
+        top_clients = sorted(clients.items(), key=lambda item: (-item[1][1], item[0]))
+        return (
+            (count, total_bytes, retransmits),
+            dict(outcomes),
+            {fraction: _percentile(durations, fraction) for fraction in (0.5, 0.95)},
+            [(name, n, size) for name, (n, size) in top_files[:limit]],
+            [(name, n, size) for name, (n, size) in top_clients[:limit]],
+        )
+
+    def query(self, since=None, limit=10):
+        """
+        Aggregates of the transfers since an epoch time (all when None):
+        totals, outcomes, median and p95 duration, the most requested files
+        and the clients by volume.
+        """
+        self.flush(1.0)
+        try:
+            if self.sqlite:
+                result = self._query_db(since, limit)
+            else:
+                result = self._query_jsonl(since, limit)
+        except (OSError, sqlite3.Error) as e:
+            return False, "Audit query failed: {}".format(e)
+        totals, outcomes, durations, top_files, clients = result
+        return True, {
+            "since": since,
+            "transfers": totals[0],
+            "bytes": totals[1],
+            "retransmits": totals[2],
+            "outcomes": outcomes,
+            "duration_p50": durations[0.5],
+            "duration_p95": durations[0.95],
+            "top_files": [
+                {"filename": name, "transfers": n, "bytes": size}
+                for name, n, size in top_files
+            ],
+            "clients": [
+                {"client": name, "transfers": n, "bytes": size}
+                for name, n, size in clients
+            ],
+        }
+
+    def status(self):
+        with self.lock:
+            return True, {
+                "path": self.path,
+                "format": "sqlite" if self.sqlite else "jsonl",
+                "queued": self.queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "errors": self.errors,
+            }
+
+    def close(self, timeout=5.0):
+        """Write what is queued and stop the writer thread."""
+        self.stop_event.set()
+        self.thread.join(timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query a TFTP transfer audit log",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("path", help="audit database or json lines file")
+    parser.add_argument(
+        "--since", type=float, default=None, help="only the last SECONDS"
+    )
+    parser.add_argument("--limit", type=int, default=10, help="top files/clients")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print("{} does not exist".format(args.path), file=sys.stderr)
+        sys.exit(1)
+    sink = AuditSink(args.path)
+    since = None if args.since is None else time.time() - args.since
+    success, data_or_error = sink.query(since, args.limit)
+    sink.close()
+    if not success:
+        print(data_or_error, file=sys.stderr)
+        sys.exit(1)
+    json.dump(data_or_error, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import struct
+import argparse
+import tempfile
+import threading
+
+try:
+    from . import tftp
+except ImportError:
+    from tftp import tftp
+
+
+def rss_bytes():
+    """Resident memory of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # peak, in KiB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def raise_fd_limit(needed):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def idle_sessions(sessions=1000, thread_stack_size=0, settle=30.0, readahead=None):
+    """
+    Measure the memory of idle downloads: `sessions` clients each request a
+    file and never ACK its first block, so every transfer sits waiting with
+    its state, socket and thread alive. Client sockets are opened before the
+    baseline is taken, socket buffers live in the kernel and are not counted.
+    `readahead` is the server's read ahead window, None for its default; the
+    file is larger than two windows, so each download has its next window
+    read ahead as a real one does.
+    """
+    raise_fd_limit(2 * sessions + 64)
+    file_dir = tempfile.mkdtemp(prefix="tftp-bench-")
+    try:
+        return _idle_sessions(file_dir, sessions, thread_stack_size, settle, readahead)
+    finally:
+        shutil.rmtree(file_dir, ignore_errors=True)
+
+
+def _idle_sessions(file_dir, sessions, thread_stack_size, settle, readahead):
+    settings = {} if readahead is None else {"readahead": readahead}
+    tftpd = tftp.TFTPD(
+        ip="127.0.0.1",
+        port=0,
+        file_dir=file_dir,
+        timeout=3600,
+        retries=0,
+        thread_stack_size=thread_stack_size,
+        mode_verbose=False,
+        **settings,
+    )
+    window = 0 if tftpd.readahead is None else tftpd.readahead.window
+    with open(os.path.join(file_dir, "idle.bin"), "wb") as f:
+        f.write(bytes(max(4 * tftp.TFTPDClientHandler.blksize, 4 * window)))
+    server = threading.Thread(target=tftpd.run, daemon=True)
+    server.start()
+    address = tftpd.sock.getsockname()
+    request = struct.pack("!H", tftp.OP_CODE_RRQ) + b"idle.bin\x00octet\x00"
+    clients = [
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(sessions)
+    ]
+    time.sleep(0.1)
+    baseline = rss_bytes()
+    started = time.monotonic()
+    for sent, client in enumerate(clients):
+        client.sendto(request, address)
+        # keep within the listening socket's receive buffer
+        while len(tftpd.sessions) < sent - 32:
+            time.sleep(0.001)
+    deadline = time.monotonic() + settle
+    while time.monotonic() < deadline:
+        states = tftpd.status()[1]["states"]
+        # and the next windows are read ahead
+        prefetching = any(
+            getattr(handler.file, "next", None) is not None
+            and not handler.file.next.done()
+            for handler in list(tftpd.sessions)
+        )
+        if states["sending"] >= sessions and not prefetching:
+            break
+        time.sleep(0.05)
+    ramp = time.monotonic() - started
+    time.sleep(0.2)
+    used = rss_bytes() - baseline
+    handler = next(iter(tftpd.sessions), None)
+    states = tftpd.status()[1]["states"]
+
+    # abort every transfer from the port its first block came from, then stop
+    abort = struct.pack("!HH", tftp.OP_CODE_ERROR, tftp.ERROR_CODE_UNDEF) + b"\x00"
+    for client in clients:
+        client.setblocking(False)
+        try:
+            _, server_address = client.recvfrom(1024)
+            client.sendto(abort, server_address)
+        except OSError:
+            pass
+        client.close()
+    tftpd.stop()
+    server.join(2)
+
+    idle = states["sending"]
+    per_session = used / max(idle, 1)
+    return {
+        "sessions": sessions,
+        "idle": idle,
+        "states": states,
+        "ramp_seconds": round(ramp, 3),
+        "thread_stack_size": thread_stack_size,  # 0: platform default
+        "readahead": window,  # 0: disabled
+        "rss_bytes": used,
+        "bytes_per_session": int(per_session),
+        "state_bytes": sys.getsizeof(handler) if handler is not None else None,
+        "sessions_per_gb": int(2**30 / per_session) if per_session > 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Memory per idle TFTP transfer",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument(
+        "--stack-size", type=int, default=0, help="thread stack bytes, 0: default"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=30.0, help="seconds to wait for sessions"
+    )
+    parser.add_argument(
+        "--readahead",
+        type=int,
+        default=None,
+        help="read ahead window bytes, 0: disabled (default: server default)",
+    )
+    args = parser.parse_args()
+    json.dump(
+        idle_sessions(args.sessions, args.stack_size, args.settle, args.readahead),
+        sys.stdout,
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main()
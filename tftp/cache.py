@@ -0,0 +1,198 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+
+class FileCache:
+    """
+    LRU cache of whole file contents for serving read requests.
+
+    Entries are validated against (device, inode, size, mtime_ns) on every
+    lookup, so a file replaced on disk is never served stale even when no
+    change event was seen. Concurrent misses on the same file share a single
+    read, a boot wave of clients asking for the same image reads it once.
+    `apply` is a change listener that evicts deleted files and, with
+    `warm_on_write`, loads new and modified ones ahead of the first request.
+    """
+
+    def __init__(
+        self,
+        root_path,
+        max_bytes=256 * 1024 * 1024,
+        max_file_size=64 * 1024 * 1024,
+        warm_on_write=True,
+    ):
+        self.root_path = os.path.abspath(root_path)
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.warm_on_write = warm_on_write
+        self.entries = OrderedDict()  # abs_path -> [key, data, hits]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.loading = {}  # abs_path -> threading.Event
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def configure(self, max_bytes=None, max_file_size=None, warm_on_write=None):
+        """Change the limits, keeping the entries that still fit."""
+        with self.lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if max_file_size is not None:
+                self.max_file_size = max_file_size
+            if warm_on_write is not None:
+                self.warm_on_write = warm_on_write
+            for path in [
+                path
+                for path, (_, data, _) in self.entries.items()
+                if len(data) > self.max_file_size
+            ]:
+                self._drop(path)
+            while self.size > self.max_bytes and self.entries:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return True, {"entries": len(self.entries), "size": self.size}
+
+    def _key(self, st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _abs_path(self, rel_path):
+        abs_path = os.path.normpath(os.path.join(self.root_path, rel_path))
+        if abs_path != self.root_path and not abs_path.startswith(
+            os.path.join(self.root_path, "")
+        ):
+            raise ValueError("Path {} is outside the root path".format(rel_path))
+        return abs_path
+
+    def _drop(self, abs_path):
+        entry = self.entries.pop(abs_path, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def _load(self, abs_path, st):
+        with open(abs_path, "rb") as f:
+            data = f.read()
+            after = os.fstat(f.fileno())
+        if self._key(after) != self._key(st) or len(data) != st.st_size:
+            # changed while reading
+            return None
+        with self.lock:
+            self._drop(abs_path)
+            self.entries[abs_path] = [self._key(st), data, 0]
+            self.size += len(data)
+            while self.size > self.max_bytes and self.entries:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+    def get(self, abs_path, load=True):
+        """Return the content of abs_path, or None when it is not cacheable."""
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            return None
+        key = self._key(st)
+        while True:
+            with self.lock:
+                entry = self.entries.get(abs_path, None)
+                if entry is not None and entry[0] == key:
+                    self.entries.move_to_end(abs_path)
+                    entry[2] += 1
+                    self.hits += 1
+                    return entry[1]
+                if not load or st.st_size > min(self.max_file_size, self.max_bytes):
+                    self.misses += 1
+                    return None
+                waiter = self.loading.get(abs_path, None)
+                if waiter is None:
+                    self.misses += 1
+                    waiter = self.loading[abs_path] = threading.Event()
+                    break
+            # another thread is reading it, then look again
+            waiter.wait()
+        try:
+            return self._load(abs_path, st)
+        except OSError as e:
+            self.logger.warning("Cache load of {} failed: {}".format(abs_path, e))
+            return None
+        finally:
+            with self.lock:
+                self.loading.pop(abs_path, None)
+            waiter.set()
+
+    def preload(self, rel_path):
+        """Load a file, or every file of a folder, into the cache."""
+        try:
+            abs_path = self._abs_path(rel_path)
+        except ValueError as e:
+            return False, str(e)
+        if os.path.isdir(abs_path):
+            paths = [
+                os.path.join(current, name)
+                for current, _, names in os.walk(abs_path)
+                for name in sorted(names)
+            ]
+        elif os.path.isfile(abs_path):
+            paths = [abs_path]
+        else:
+            return False, "Path {} does not exist".format(rel_path)
+        loaded = []
+        skipped = []
+        for path in paths:
+            rel = os.path.relpath(path, self.root_path)
+            (loaded if self.get(path) is not None else skipped).append(rel)
+        return True, {"loaded": loaded, "skipped": skipped}
+
+    def evict(self, rel_path=""):
+        """Drop a file, or everything below a folder, from the cache."""
+        try:
+            abs_path = self._abs_path(rel_path)
+        except ValueError as e:
+            return False, str(e)
+        prefix = os.path.join(abs_path, "")
+        with self.lock:
+            paths = [
+                path
+                for path in self.entries
+                if path == abs_path or path.startswith(prefix)
+            ]
+            for path in paths:
+                self._drop(path)
+        return True, {
+            "evicted": [os.path.relpath(path, self.root_path) for path in paths]
+        }
+
+    def status(self):
+        with self.lock:
+            return True, {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_bytes": self.max_bytes,
+                "max_file_size": self.max_file_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": [
+                    {
+                        "path": os.path.relpath(path, self.root_path),
+                        "size": len(data),
+                        "hits": hits,
+                    }
+                    for path, (_, data, hits) in reversed(self.entries.items())
+                ],
+            }
+
+    def apply(self, event, rel_path, is_dir=False):
+        """Change listener: evict deleted files, warm written ones."""
+        if not rel_path:
+            return
+        if event == "delete" or is_dir:
+            self.evict(rel_path)
+        elif event in ("create", "modify"):
+            abs_path = os.path.join(self.root_path, rel_path)
+            if self.warm_on_write and not abs_path.endswith(".filepart"):
+                # off the writer's thread, the upload is already complete
+                threading.Thread(target=self.get, args=(abs_path,), daemon=True).start()
+            else:
+                self.evict(rel_path)
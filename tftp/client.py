@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+
+try:
+    from . import tftp
+except ImportError:
+    from tftp import tftp
+
+
+class TFTPError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, "TFTP error {}: {}".format(code, message))
+        self.code = code
+
+
+class TFTPClient:
+    """
+    Octet mode TFTP client (RFC1350) for tests, benchmarks and scripts.
+
+    `get` and `put` run one lock-step transfer and return its stats: bytes,
+    blocks, retransmits, timeouts, duplicates (packets received again),
+    elapsed seconds and throughput in bytes per second.
+    """
+
+    def __init__(self, host, port=69, timeout=1.0, retries=5, blksize=512):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.retries = retries
+        self.blksize = blksize
+
+    def _request(self, opcode, filename, options=None):
+        packet = struct.pack("!H", opcode) + filename.encode("ascii") + b"\x00"
+        packet += tftp.MODE_OCTET.encode("ascii") + b"\x00"
+        for name, value in (options or {}).items():
+            packet += "{}\x00{}\x00".format(name, value).encode("ascii")
+        return packet
+
+    def _stats(self):
+        return {
+            "bytes": 0,
+            "blocks": 0,
+            "retransmits": 0,
+            "timeouts": 0,
+            "duplicates": 0,
+            "started": time.monotonic(),
+        }
+
+    def _finish(self, stats):
+        stats["elapsed"] = time.monotonic() - stats.pop("started")
+        stats["throughput"] = stats["bytes"] / max(stats["elapsed"], 1e-9)
+        return stats
+
+    def _recv(self, sock, server, stats):
+        """Return (opcode, number, payload, address), None on timeout."""
+        while True:
+            try:
+                packet, address = sock.recvfrom(self.blksize + 4)
+            except socket.timeout:
+                stats["timeouts"] += 1
+                return None
+            if server is not None and address != server:
+                # another transfer ID, tell it and go on
+                sock.sendto(
+                    struct.pack("!HH", tftp.OP_CODE_ERROR, tftp.ERROR_CODE_BADOPID)
+                    + b"Unknown transfer ID\x00",
+                    address,
+                )
+                continue
+            if len(packet) < 4:
+                continue
+            opcode, number = struct.unpack("!HH", packet[:4])
+            if opcode == tftp.OP_CODE_ERROR:
+                raise TFTPError(number, packet[4:].rstrip(b"\x00").decode("ascii"))
+            return opcode, number, packet[4:], address
+
+    def get(self, filename, output):
+        """Download filename into the writable binary stream output."""
+        stats = self._stats()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        try:
+            server = None
+            last = (self._request(tftp.OP_CODE_RRQ, filename), (self.host, self.port))
+            sock.sendto(*last)
+            retries = self.retries
+            expected = 1
+            while True:
+                packet = self._recv(sock, server, stats)
+                if packet is None:
+                    if retries <= 0:
+                        raise TimeoutError(
+                            "Timed out waiting for block {}".format(expected)
+                        )
+                    retries -= 1
+                    stats["retransmits"] += 1
+                    sock.sendto(*last)
+                    continue
+                opcode, number, payload, address = packet
+                if opcode != tftp.OP_CODE_DATA:
+                    continue
+                if number != expected & 0xFFFF:
+                    # the previous block again, our ACK was lost
+                    stats["duplicates"] += 1
+                    if server is not None:
+                        sock.sendto(*last)
+                    continue
+                server = address
+                retries = self.retries
+                output.write(payload)
+                stats["bytes"] += len(payload)
+                stats["blocks"] += 1
+                last = (struct.pack("!HH", tftp.OP_CODE_ACK, number), server)
+                sock.sendto(*last)
+                if len(payload) < self.blksize:
+                    break
+                expected += 1
+            self._finish(stats)
+            # dally: ACK the last block again if the server did not get it
+            while True:
+                packet = self._recv(sock, server, stats)
+                if packet is None:
+                    stats["timeouts"] -= 1
+                    break
+                stats["duplicates"] += 1
+                sock.sendto(*last)
+        finally:
+            sock.close()
+        return stats
+
+    def put(self, filename, stream, tsize=None):
+        """Upload the readable binary stream as filename."""
+        stats = self._stats()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        try:
+            server = None
+            options = None if tsize is None else {"tsize": tsize}
+            last = (
+                self._request(tftp.OP_CODE_WRQ, filename, options),
+                (self.host, self.port),
+            )
+            sock.sendto(*last)
+            retries = self.retries
+            block_number = 0
+            data = None
+            while True:
+                packet = self._recv(sock, server, stats)
+                if packet is None:
+                    if retries <= 0:
+                        raise TimeoutError(
+                            "Timed out waiting for ACK {}".format(block_number)
+                        )
+                    retries -= 1
+                    stats["retransmits"] += 1
+                    sock.sendto(*last)
+                    continue
+                opcode, number, _, address = packet
+                if opcode not in (tftp.OP_CODE_ACK, tftp.OP_CODE_OACK):
+                    continue
+                if opcode == tftp.OP_CODE_OACK:
+                    number = 0
+                if number != block_number & 0xFFFF:
+                    # a delayed or duplicated ACK, resending on it would
+                    # double every later block
+                    stats["duplicates"] += 1
+                    continue
+                server = address
+                retries = self.retries
+                if data is not None:
+                    stats["bytes"] += len(data)
+                    stats["blocks"] += 1
+                    if len(data) < self.blksize:
+                        break
+                block_number += 1
+                data = stream.read(self.blksize)
+                last = (
+                    struct.pack("!HH", tftp.OP_CODE_DATA, block_number & 0xFFFF) + data,
+                    server,
+                )
+                sock.sendto(*last)
+        finally:
+            sock.close()
+        return self._finish(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="TFTP Client",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("host", help="TFTP server host")
+    parser.add_argument("action", choices=("get", "put"))
+    parser.add_argument("filename", help="remote file name")
+    parser.add_argument("local", nargs="?", help="local file, default: filename")
+    parser.add_argument("--port", type=int, default=69, help="TFTP server port")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds")
+    parser.add_argument("--retries", type=int, default=5)
+    args = parser.parse_args()
+
+    client = TFTPClient(args.host, args.port, args.timeout, args.retries)
+    local = args.local or os.path.basename(args.filename)
+    try:
+        if args.action == "get":
+            with open(local, "wb") as f:
+                stats = client.get(args.filename, f)
+        else:
+            with open(local, "rb") as f:
+                stats = client.put(args.filename, f, tsize=os.fstat(f.fileno()).st_size)
+    except (TFTPError, TimeoutError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import sys
+import time
+import heapq
+import random
+import select
+import socket
+import logging
+import argparse
+import threading
+
+
+class ImpairmentProxy(threading.Thread):
+    """
+    Loopback UDP proxy injecting loss, delay, jitter, duplication and
+    reordering between TFTP clients and a server.
+
+    Clients send to `address`. Each client gets its own upstream socket, so
+    the server sees one transfer ID per client; replies from the server's
+    per-transfer port are relayed back from the proxy's port, and later
+    client packets go to whichever server port answered last. Impairments
+    apply to both directions, each with its own counters in `stats`.
+    """
+
+    def __init__(
+        self,
+        target,
+        listen=("127.0.0.1", 0),
+        loss=0.0,
+        delay=0.0,
+        jitter=0.0,
+        duplicate=0.0,
+        reorder=0.0,
+        reorder_delay=0.01,
+        seed=None,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.target = target
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(listen)
+        self.address = self.sock.getsockname()
+        self.sessions = {}  # client address -> [upstream socket, server address]
+        self.upstreams = {}  # upstream socket -> client address
+        self.queue = []  # (due, seq, sock, packet, address)
+        self.seq = 0
+        self.condition = threading.Condition()
+        self.stats = {
+            direction: {
+                "packets": 0,
+                "dropped": 0,
+                "duplicated": 0,
+                "reordered": 0,
+            }
+            for direction in ("upstream", "downstream")
+        }
+        self.logger = logging.getLogger(__name__)
+        self._stop_event = threading.Event()
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+
+    def _schedule(self, direction, sock, packet, address):
+        stats = self.stats[direction]
+        stats["packets"] += 1
+        if self.random.random() < self.loss:
+            stats["dropped"] += 1
+            return
+        copies = 1
+        if self.random.random() < self.duplicate:
+            stats["duplicated"] += 1
+            copies = 2
+        now = time.monotonic()
+        with self.condition:
+            for _ in range(copies):
+                due = now + max(
+                    0.0, self.delay + self.random.uniform(-self.jitter, self.jitter)
+                )
+                if self.random.random() < self.reorder:
+                    # held back so packets sent after it overtake it
+                    stats["reordered"] += 1
+                    due += self.reorder_delay
+                self.seq += 1
+                heapq.heappush(self.queue, (due, self.seq, sock, packet, address))
+            self.condition.notify()
+
+    def _send_loop(self):
+        while not self._stop_event.is_set():
+            with self.condition:
+                if not self.queue:
+                    self.condition.wait(0.1)
+                    continue
+                due = self.queue[0][0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, sock, packet, address = heapq.heappop(self.queue)
+            try:
+                sock.sendto(packet, address)
+            except OSError as e:
+                self.logger.debug("Proxy send to {} failed: {}".format(address, e))
+
+    def _session(self, client):
+        session = self.sessions.get(client, None)
+        if session is None:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            upstream.bind((self.address[0], 0))
+            session = self.sessions[client] = [upstream, self.target]
+            self.upstreams[upstream] = client
+        return session
+
+    def run(self):
+        self._sender.start()
+        while not self._stop_event.is_set():
+            sockets = [self.sock] + list(self.upstreams)
+            readable, _, _ = select.select(sockets, [], [], 0.1)
+            for sock in readable:
+                try:
+                    packet, address = sock.recvfrom(65536)
+                except OSError:
+                    continue
+                if sock is self.sock:
+                    upstream, server = self._session(address)
+                    self._schedule("upstream", upstream, packet, server)
+                else:
+                    client = self.upstreams[sock]
+                    # follow the server to its transfer port
+                    self.sessions[client][1] = address
+                    self._schedule("downstream", self.sock, packet, client)
+        for sock in [self.sock] + list(self.upstreams):
+            sock.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="UDP impairment proxy for TFTP testing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("target", help="server address, host:port")
+    parser.add_argument("--listen", default="127.0.0.1:6969", help="host:port")
+    parser.add_argument("--loss", type=float, default=0.0, help="drop probability")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability")
+    parser.add_argument("--reorder-delay", type=float, default=0.01, help="seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    def address(value):
+        host, port = value.rsplit(":", 1)
+        return host, int(port)
+
+    proxy = ImpairmentProxy(
+        address(args.target),
+        address(args.listen),
+        loss=args.loss,
+        delay=args.delay,
+        jitter=args.jitter,
+        duplicate=args.duplicate,
+        reorder=args.reorder,
+        reorder_delay=args.reorder_delay,
+        seed=args.seed,
+    )
+    proxy.start()
+    print("Proxying {} -> {}".format(proxy.address, proxy.target), file=sys.stderr)
+    try:
+        while proxy.is_alive():
+            proxy.join(1)
+    except KeyboardInterrupt:
+        proxy.stop()
+    print(proxy.stats, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
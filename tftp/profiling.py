@@ -0,0 +1,238 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+# where a transfer's time goes: disk reads and writes, socket sends, waiting
+# for the next ACK or DATA, and waits that ended in a timeout (retransmits)
+PHASES = ("read", "write", "send", "wait", "timeout")
+
+
+def _timed(phase, method):
+    clock = time.perf_counter_ns
+
+    def timed(self, *args):
+        start = clock()
+        try:
+            return method(self, *args)
+        finally:
+            self.profile.add(phase, clock() - start)
+
+    return timed
+
+
+def _timed_recv(method):
+    clock = time.perf_counter_ns
+
+    def timed(self, *args):
+        start = clock()
+        packet = method(self, *args)
+        self.profile.add("wait" if packet is not None else "timeout", clock() - start)
+        return packet
+
+    return timed
+
+
+_profiled_classes = {}
+
+
+def profiled_class(cls):
+    """Subclass of a handler class timing its I/O methods into `profile`."""
+    profiled = _profiled_classes.get(cls, None)
+    if profiled is None:
+        profiled = _profiled_classes[cls] = type(
+            "Profiled" + cls.__name__,
+            (cls,),
+            {
+                "__slots__": (),
+                "read_block": _timed("read", cls.read_block),
+                "write_block": _timed("write", cls.write_block),
+                "send_data": _timed("send", cls.send_data),
+                "send_ack": _timed("send", cls.send_ack),
+                "recv_packet": _timed_recv(cls.recv_packet),
+            },
+        )
+    return profiled
+
+
+class TransferProfile:
+    """
+    Per-phase time of one transfer, measured with `perf_counter_ns`.
+
+    `instrument` switches the handler to a subclass with timed I/O methods,
+    so handlers created without a profile run the plain methods at no cost.
+    """
+
+    def __init__(self):
+        self.ns = dict.fromkeys(PHASES, 0)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.started = time.perf_counter_ns()
+
+    def add(self, phase, ns):
+        self.ns[phase] += ns
+        self.calls[phase] += 1
+
+    def instrument(self, handler):
+        handler.profile = self
+        handler.__class__ = profiled_class(type(handler))
+
+    def breakdown(self):
+        """Milliseconds and calls per phase, `other` being the rest."""
+        total = time.perf_counter_ns() - self.started
+        phases = {
+            phase: {"ms": self.ns[phase] / 1e6, "calls": self.calls[phase]}
+            for phase in PHASES
+        }
+        phases["other"] = {
+            "ms": max(0, total - sum(self.ns.values())) / 1e6,
+            "calls": 0,
+        }
+        return phases
+
+
+class SlowTransferLog:
+    """
+    Finish listener logging the phase breakdown of transfers slower than
+    `threshold` seconds, and appending it to `path` as json lines if set.
+    """
+
+    def __init__(self, threshold, path=None):
+        self.threshold = threshold
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, handler):
+        profile = getattr(handler, "profile", None)
+        if profile is None or handler.stats["elapsed"] < self.threshold:
+            return
+        phases = profile.breakdown()
+        handler.logger.warning(
+            "Slow transfer {} from {}: {:.3f}s, {}".format(
+                handler.filename,
+                handler.address,
+                handler.stats["elapsed"],
+                ", ".join(
+                    "{} {:.1f}ms".format(phase, value["ms"])
+                    for phase, value in phases.items()
+                ),
+            )
+        )
+        if self.path is None:
+            return
+        record = {
+            "time": handler.time_ns / 1e9,
+            "client": "{}:{}".format(*handler.address),
+            "opcode": handler.opcode,
+            "filename": handler.filename,
+            "error": handler.error_code,
+            "stats": handler.stats,
+            "phases": phases,
+        }
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+class SamplingProfiler:
+    """
+    Whole process sampling profiler writing collapsed stacks.
+
+    While running, a thread walks `sys._current_frames()` every `interval`
+    seconds and counts each thread's stack as "thread;outer;...;inner".
+    `stop` writes the counts in the format flamegraph.pl and speedscope
+    read. Nothing runs while stopped.
+    """
+
+    def __init__(self, output_dir=None, interval=0.005):
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.started = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def running(self):
+        return self.thread is not None
+
+    def _frame_name(self, frame):
+        code = frame.f_code
+        return "{} ({}:{})".format(
+            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+        )
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                # handler threads share one name, e.g. "Thread (run)"
+                names = {
+                    thread.ident: re.sub(r"-\d+", "", thread.name)
+                    for thread in threading.enumerate()
+                }
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return False, "Profiler is already running"
+            self.counts = Counter()
+            self.samples = 0
+            self.started = time.time()
+            self.stop_event.clear()
+            self.thread = threading.Thread(
+                target=self._run, name="tftp-profiler", daemon=True
+            )
+            self.thread.start()
+        self.logger.info("Sampling profiler started")
+        return True, self.status()[1]
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks, return their path."""
+        with self.lock:
+            if self.thread is None:
+                return False, "Profiler is not running"
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            path = os.path.join(
+                self.output_dir,
+                "tftp-profile-{}-{}.folded".format(
+                    os.getpid(), time.strftime("%Y%m%d-%H%M%S")
+                ),
+            )
+            with open(path, "w") as f:
+                for stack, count in self.counts.most_common():
+                    f.write("{} {}\n".format(stack, count))
+        self.logger.info("Sampling profile written to {}".format(path))
+        return True, {"path": path, "samples": self.samples, "stacks": len(self.counts)}
+
+    def toggle(self):
+        return self.stop() if self.running() else self.start()
+
+    def status(self):
+        return True, {
+            "running": self.running(),
+            "started": self.started,
+            "samples": self.samples,
+            "interval": self.interval,
+            "output_dir": self.output_dir,
+        }
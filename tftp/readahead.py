@@ -0,0 +1,177 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# page cache hints, not available on every platform
+FADVISE = hasattr(os, "posix_fadvise")
+
+
+def fadvise(fd, offset, length, advice):
+    if FADVISE:
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+class Readahead:
+    """
+    Sequential read policy shared by the download handlers of a server.
+
+    Every file is opened with POSIX_FADV_SEQUENTIAL and its first window
+    marked WILLNEED. While a handler sends one window of blocks, a helper
+    thread already reads the next one into the page cache, so the data is in
+    memory before the client's ACK asks for it. Handlers read their blocks
+    with os.pread and hold no window of their own, only the helper threads
+    have a buffer to read into. Files read fewer than `hot_reads` times among
+    the last `history` files opened are cold: with `dontneed`, their pages
+    are dropped once sent, so an image streamed once does not push hot boot
+    files out of the page cache. Coldness is looked up again before every
+    drop, a file that other clients started reading meanwhile is kept.
+    """
+
+    def __init__(
+        self, window=128 * 1024, workers=4, dontneed=True, hot_reads=2, history=1024
+    ):
+        self.window = window
+        self.dontneed = dontneed
+        self.hot_reads = hot_reads
+        self.history = history
+        self.reads = OrderedDict()  # (device, inode) -> times opened
+        self.opened = 0
+        self.cold = 0
+        self.prefetched = 0
+        self.waits = 0  # reads that had to wait for the helper thread
+        self.lock = threading.Lock()
+        self.buffers = threading.local()  # read buffer of each helper thread
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="tftp-readahead"
+        )
+        self.logger = logging.getLogger(__name__)
+
+    def _count(self, key):
+        with self.lock:
+            count = self.reads.pop(key, 0) + 1
+            self.reads[key] = count
+            while len(self.reads) > self.history:
+                self.reads.popitem(last=False)
+            self.opened += 1
+            if count < self.hot_reads:
+                self.cold += 1
+
+    def is_cold(self, key):
+        """Whether the (device, inode) file is read too rarely to keep cached."""
+        with self.lock:
+            return self.reads.get(key, 0) < self.hot_reads
+
+    def open(self, path):
+        """Open path for a sequential download, returns a readable file."""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            key = (st.st_dev, st.st_ino)
+            self._count(key)
+            return ReadaheadFile(self, fd, key if self.dontneed else None)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def _prefetch(self, fd, offset):
+        """Read a window into the page cache, returns the bytes read."""
+        fadvise(fd, offset, self.window, getattr(os, "POSIX_FADV_WILLNEED", 0))
+        if not hasattr(os, "preadv"):
+            return len(os.pread(fd, self.window, offset))
+        buffer = getattr(self.buffers, "buffer", None)
+        if buffer is None:
+            buffer = self.buffers.buffer = bytearray(self.window)
+        return os.preadv(fd, [buffer], offset)
+
+    def submit(self, fd, offset):
+        try:
+            return self.executor.submit(self._prefetch, fd, offset)
+        except RuntimeError:
+            # executor shut down, stop reading ahead
+            future = Future()
+            future.set_result(0)
+            return future
+
+    def status(self):
+        with self.lock:
+            return True, {
+                "window": self.window,
+                "dontneed": self.dontneed,
+                "fadvise": FADVISE,
+                "opened": self.opened,
+                "cold": self.cold,
+                "prefetched": self.prefetched,
+                "waits": self.waits,
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class ReadaheadFile:
+    """
+    File reader keeping one window read ahead into the page cache by a
+    helper thread, blocks are read with os.pread when asked for. With a
+    (device, inode) `key`, sent pages are dropped while the file is cold.
+    """
+
+    def __init__(self, readahead, fd, key=None):
+        self.readahead = readahead
+        self.fd = fd
+        self.key = key
+        self.offset = 0  # file offset of the next read
+        self.ahead = 0  # end of the windows read ahead
+        self.dropped = 0  # pages before this offset were dropped
+        fadvise(fd, 0, 0, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+        fadvise(fd, 0, readahead.window, getattr(os, "POSIX_FADV_WILLNEED", 0))
+        self.next = readahead.submit(fd, 0)
+
+    def _advance(self):
+        waited = not self.next.done()
+        length = self.next.result()
+        with self.readahead.lock:
+            self.readahead.waits += waited
+            self.readahead.prefetched += length
+        self.ahead += length
+        if length < self.readahead.window:
+            self.next = None
+        else:
+            self.next = self.readahead.submit(self.fd, self.ahead)
+        if (
+            self.key is not None
+            and self.offset > self.dropped
+            and self.readahead.is_cold(self.key)
+        ):
+            # these blocks are sent, a retransmission only needs the block
+            # the handler holds
+            fadvise(
+                self.fd,
+                self.dropped,
+                self.offset - self.dropped,
+                getattr(os, "POSIX_FADV_DONTNEED", 0),
+            )
+            self.dropped = self.offset
+
+    def read(self, size):
+        while self.offset + size > self.ahead and self.next is not None:
+            self._advance()
+        data = os.pread(self.fd, size, self.offset)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.next is not None:
+            # the helper may still be reading from fd
+            self.next.cancel() or self.next.exception()
+            self.next = None
+        if self.key is not None and self.readahead.is_cold(self.key):
+            fadvise(self.fd, 0, 0, getattr(os, "POSIX_FADV_DONTNEED", 0))
+        os.close(self.fd)
+        self.fd = None
@@ -1,7 +1,10 @@
 #!/bin/python3
 import os
 import sys
+import json
+import signal
 import argparse
+import threading
 try:
     from . import tftp
 except:
@@ -14,6 +17,17 @@ SETTINGS = {
     "TFTP_WRQ_ENABLE": False,
     "TFTP_RETRIES": 3,
     "TFTP_TIMEOUT": 5,
+    "TFTP_MIN_FREE_SPACE": 0,
+    "TFTP_TRACE": None,
+    "TFTP_PROFILE_SLOW": None,
+    "TFTP_PROFILE_DUMP": None,
+    "TFTP_PROFILE_DIR": None,
+    "TFTP_READAHEAD": 128 * 1024,
+    "TFTP_READAHEAD_WORKERS": 4,
+    "TFTP_READAHEAD_KEEP": False,
+    "TFTP_THREAD_STACK_SIZE": 0,
+    "TFTP_CONFIG": None,
+    "TFTP_AUDIT": None,
     "MODE_DEBUG": False,
     "MODE_VERBOSE": True,
 }
@@ -68,6 +82,88 @@ def parse_cli_arguments():
         help="TFTP Timeout",
         default=SETTINGS["TFTP_TIMEOUT"],
     )
+    parser.add_argument(
+        "--tftp-min-free-space",
+        action="store",
+        dest="TFTP_MIN_FREE_SPACE",
+        type=int,
+        help="TFTP disk space in bytes uploads must leave free",
+        default=SETTINGS["TFTP_MIN_FREE_SPACE"],
+    )
+    parser.add_argument(
+        "--tftp-trace",
+        action="store",
+        dest="TFTP_TRACE",
+        help="TFTP transfer trace file, replay with python3 -m tftp.trace",
+        default=SETTINGS["TFTP_TRACE"],
+    )
+    parser.add_argument(
+        "--tftp-profile-slow",
+        action="store",
+        dest="TFTP_PROFILE_SLOW",
+        type=float,
+        help="TFTP log time per phase of transfers slower than this (seconds)",
+        default=SETTINGS["TFTP_PROFILE_SLOW"],
+    )
+    parser.add_argument(
+        "--tftp-profile-dump",
+        action="store",
+        dest="TFTP_PROFILE_DUMP",
+        help="TFTP slow transfer breakdowns file (json lines)",
+        default=SETTINGS["TFTP_PROFILE_DUMP"],
+    )
+    parser.add_argument(
+        "--tftp-profile-dir",
+        action="store",
+        dest="TFTP_PROFILE_DIR",
+        help="TFTP sampling profiles folder, SIGUSR1 starts/stops sampling",
+        default=SETTINGS["TFTP_PROFILE_DIR"],
+    )
+    parser.add_argument(
+        "--tftp-readahead",
+        action="store",
+        dest="TFTP_READAHEAD",
+        type=int,
+        help="TFTP bytes read ahead of downloads on helper threads, 0 disables",
+        default=SETTINGS["TFTP_READAHEAD"],
+    )
+    parser.add_argument(
+        "--tftp-readahead-workers",
+        action="store",
+        dest="TFTP_READAHEAD_WORKERS",
+        type=int,
+        help="TFTP readahead helper threads",
+        default=SETTINGS["TFTP_READAHEAD_WORKERS"],
+    )
+    parser.add_argument(
+        "--tftp-readahead-keep",
+        action="store_true",
+        dest="TFTP_READAHEAD_KEEP",
+        help="TFTP keep files read once in the page cache",
+        default=SETTINGS["TFTP_READAHEAD_KEEP"],
+    )
+    parser.add_argument(
+        "--tftp-thread-stack-size",
+        action="store",
+        dest="TFTP_THREAD_STACK_SIZE",
+        type=int,
+        help="TFTP transfer thread stack size in bytes, 0: platform default",
+        default=SETTINGS["TFTP_THREAD_STACK_SIZE"],
+    )
+    parser.add_argument(
+        "--tftp-audit",
+        action="store",
+        dest="TFTP_AUDIT",
+        help="TFTP transfer audit log, sqlite (.db, .sqlite) or json lines",
+        default=SETTINGS["TFTP_AUDIT"],
+    )
+    parser.add_argument(
+        "--tftp-config",
+        action="store",
+        dest="TFTP_CONFIG",
+        help="TFTP settings json file over the arguments, SIGHUP reloads it",
+        default=SETTINGS["TFTP_CONFIG"],
+    )
 
     # TFTP server arguments
     parser.add_argument(
@@ -89,6 +185,14 @@ def parse_cli_arguments():
     return parser.parse_args()
 
 
+def load_config(path):
+    """TFTPD settings from a json file, e.g. {"retries": 5, "wrq_enable": true}"""
+    if path is None:
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
 def main():
     global SETTINGS, args
     # configure
@@ -96,19 +200,49 @@ def main():
 
     # warn the user that they are starting PyPXE as non-root user
     if os.getuid() != 0:
-        print(sys.stderr, "\nWARNING: Not root. Servers will probably fail to bind.\n")
+        print("\nWARNING: Not root. Servers will probably fail to bind.\n", file=sys.stderr)
 
     # setup TFTP
-    tftpd = tftp.TFTPD(
+    settings = dict(
         ip=args.TFTP_SERVER_IP,
         port=args.TFTP_SERVER_PORT,
         file_dir=args.TFTP_FILE_DIR,
         wrq_enable=args.TFTP_WRQ_ENABLE,
         retries=args.TFTP_RETRIES,
         timeout=args.TFTP_TIMEOUT,
+        min_free_space=args.TFTP_MIN_FREE_SPACE,
+        trace=args.TFTP_TRACE,
+        audit=args.TFTP_AUDIT,
+        profile_slow=args.TFTP_PROFILE_SLOW,
+        profile_dump=args.TFTP_PROFILE_DUMP,
+        profile_dir=args.TFTP_PROFILE_DIR,
+        readahead=args.TFTP_READAHEAD,
+        readahead_workers=args.TFTP_READAHEAD_WORKERS,
+        readahead_dontneed=not args.TFTP_READAHEAD_KEEP,
+        thread_stack_size=args.TFTP_THREAD_STACK_SIZE,
         mode_debug=args.MODE_DEBUG,
         mode_verbose=args.MODE_VERBOSE,
-        logger=None,
+    )
+    tftpd = tftp.TFTPD(logger=None, **dict(settings, **load_config(args.TFTP_CONFIG)))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: tftpd.profiler.toggle())
+
+    def reload():
+        # settings left out of the file go back to their argument value
+        try:
+            config = load_config(args.TFTP_CONFIG)
+        except (OSError, ValueError) as e:
+            tftpd.logger.warning("Cannot read config: {}".format(e))
+            return
+        success, data_or_error = tftpd.reload(**dict(settings, **config))
+        if not success:
+            tftpd.logger.warning("Reload failed: {}".format(data_or_error))
+
+    # the main thread may hold the reload lock when the signal arrives
+    signal.signal(
+        signal.SIGHUP,
+        lambda signum, frame: threading.Thread(
+            target=reload, name="tftpd-reload", daemon=True
+        ).start(),
     )
     tftpd.run()
 
@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from tftp import tftp, client, netem  # noqa: E402
+
+# stats of every transfer, printed at the end of the run
+TRANSFER_REPORTS = []
+
+
+@pytest.fixture
+def server(tmp_path):
+    """TFTP server on an ephemeral loopback port, serving tmp_path/files."""
+    file_dir = tmp_path / "files"
+    file_dir.mkdir()
+    tftpd = tftp.TFTPD(
+        ip="127.0.0.1",
+        port=0,
+        file_dir=str(file_dir),
+        wrq_enable=True,
+        retries=20,
+        timeout=0.05,
+        mode_verbose=False,
+    )
+    thread = threading.Thread(target=tftpd.run, daemon=True)
+    thread.start()
+    yield tftpd
+    tftpd.stop()
+    thread.join(2)
+
+
+@pytest.fixture
+def make_client(server):
+    """Return a client for `server`, through an impairment proxy if asked."""
+    proxies = []
+
+    def factory(timeout=0.05, retries=20, **impairments):
+        address = server.sock.getsockname()
+        if impairments:
+            proxy = netem.ImpairmentProxy(address, seed=1, **impairments)
+            proxy.start()
+            proxies.append(proxy)
+            address = proxy.address
+        tftp_client = client.TFTPClient(address[0], address[1], timeout, retries)
+        tftp_client.proxy = proxies[-1] if impairments else None
+        return tftp_client
+
+    yield factory
+    for proxy in proxies:
+        proxy.stop()
+        proxy.join(2)
+
+
+@pytest.fixture
+def report(request):
+    """Record the stats of a transfer for the end of run summary."""
+
+    def record(stats, tftp_client=None):
+        proxy = getattr(tftp_client, "proxy", None)
+        TRANSFER_REPORTS.append(
+            (request.node.name, stats, None if proxy is None else proxy.stats)
+        )
+
+    return record
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not TRANSFER_REPORTS:
+        return
+    terminalreporter.section("tftp transfers")
+    for name, stats, proxy_stats in TRANSFER_REPORTS:
+        line = (
+            "{}: {} bytes, {} blocks, {:.3f}s, {:.1f} KiB/s, "
+            "{} retransmits, {} timeouts, {} duplicates".format(
+                name,
+                stats["bytes"],
+                stats["blocks"],
+                stats["elapsed"],
+                stats["throughput"] / 1024,
+                stats["retransmits"],
+                stats["timeouts"],
+                stats["duplicates"],
+            )
+        )
+        if proxy_stats is not None:
+            line += ", dropped {}/{} up, {}/{} down".format(
+                proxy_stats["upstream"]["dropped"],
+                proxy_stats["upstream"]["packets"],
+                proxy_stats["downstream"]["dropped"],
+                proxy_stats["downstream"]["packets"],
+            )
+        terminalreporter.write_line(line)
@@ -0,0 +1,55 @@
+import os
+
+from tftp.cache import FileCache
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_stale_entry_rejected(tmp_path):
+    cache = FileCache(str(tmp_path))
+    path = str(tmp_path / "boot.cfg")
+    write(path, b"old")
+    assert cache.get(path) == b"old"
+    assert cache.get(path) == b"old"
+    # replaced on disk without a change event
+    write(path, b"newer")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+    assert cache.get(path, load=False) is None
+    assert cache.get(path) == b"newer"
+    status = cache.status()[1]
+    assert (status["hits"], status["misses"]) == (1, 3)
+    assert status["size"] == len(b"newer")
+
+
+def test_lru_eviction(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=250, max_file_size=200)
+    for name in "abcd":
+        write(str(tmp_path / name), name.encode() * 100)
+    write(str(tmp_path / "big"), bytes(201))
+    for name in "ab":
+        assert cache.get(str(tmp_path / name)) is not None
+    # a is used again, so b is the least recently used when c needs room
+    cache.get(str(tmp_path / "a"))
+    cache.get(str(tmp_path / "c"))
+    assert [f["path"] for f in cache.status()[1]["files"]] == ["c", "a"]
+    assert cache.get(str(tmp_path / "b"), load=False) is None
+    # files above max_file_size are never cached
+    assert cache.get(str(tmp_path / "big")) is None
+    assert cache.status()[1]["size"] == 200
+
+
+def test_apply_evicts(tmp_path):
+    cache = FileCache(str(tmp_path), warm_on_write=False)
+    (tmp_path / "images").mkdir()
+    for rel_path in ("a.bin", "images/b.bin", "images/c.bin"):
+        write(str(tmp_path / rel_path), b"x")
+        assert cache.get(str(tmp_path / rel_path)) == b"x"
+    cache.apply("delete", "a.bin")
+    cache.apply("modify", os.path.join("images", "b.bin"))
+    assert [f["path"] for f in cache.status()[1]["files"]] == ["images/c.bin"]
+    cache.apply("delete", "images", True)
+    assert cache.status()[1]["entries"] == 0
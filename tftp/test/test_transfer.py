@@ -0,0 +1,402 @@
+import io
+import os
+import time
+import socket
+import threading
+import pytest
+import json
+import tempfile
+from tftp import tftp, audit, bench, client, trace, profiling, readahead
+
+BLKSIZE = 512
+SIZES = [0, 1, BLKSIZE - 1, BLKSIZE, BLKSIZE + 1, 10 * BLKSIZE, 100000]
+IMPAIRMENTS = {
+    "loss": dict(loss=0.1),
+    "duplicate": dict(duplicate=0.3),
+    "reorder": dict(reorder=0.2, reorder_delay=0.01),
+    "jitter": dict(delay=0.002, jitter=0.002),
+    "mixed": dict(loss=0.05, duplicate=0.1, reorder=0.1, delay=0.001, jitter=0.001),
+}
+
+
+def write_file(server, name, size):
+    data = os.urandom(size)
+    with open(os.path.join(server.file_dir, name), "wb") as f:
+        f.write(data)
+    return data
+
+
+def read_file(server, name):
+    with open(os.path.join(server.file_dir, name), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_rrq(server, make_client, report, size):
+    data = write_file(server, "file.bin", size)
+    output = io.BytesIO()
+    stats = make_client().get("file.bin", output)
+    assert output.getvalue() == data
+    assert stats["blocks"] == size // BLKSIZE + 1
+    report(stats)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_wrq(server, make_client, report, size):
+    data = os.urandom(size)
+    stats = make_client().put("file.bin", io.BytesIO(data))
+    assert read_file(server, "file.bin") == data
+    assert stats["blocks"] == size // BLKSIZE + 1
+    report(stats)
+
+
+@pytest.mark.parametrize("impairment", list(IMPAIRMENTS))
+def test_rrq_impaired(server, make_client, report, impairment):
+    data = write_file(server, "file.bin", 200 * BLKSIZE + 7)
+    tftp_client = make_client(**IMPAIRMENTS[impairment])
+    output = io.BytesIO()
+    stats = tftp_client.get("file.bin", output)
+    assert output.getvalue() == data
+    report(stats, tftp_client)
+
+
+@pytest.mark.parametrize("impairment", list(IMPAIRMENTS))
+def test_wrq_impaired(server, make_client, report, impairment):
+    data = os.urandom(200 * BLKSIZE + 7)
+    tftp_client = make_client(**IMPAIRMENTS[impairment])
+    stats = tftp_client.put("file.bin", io.BytesIO(data))
+    assert read_file(server, "file.bin") == data
+    report(stats, tftp_client)
+
+
+def test_rrq_block_number_wraparound(server, make_client, report):
+    # more than 65535 blocks, block numbers wrap back to 0
+    blocks = 65536 + 100
+    data = write_file(server, "large.bin", blocks * BLKSIZE - 1)
+    output = io.BytesIO()
+    stats = make_client(duplicate=0.001).get("large.bin", output)
+    assert stats["blocks"] == blocks
+    assert output.getvalue() == data
+    report(stats)
+
+
+def test_wrq_block_number_wraparound(server, make_client, report):
+    blocks = 65536 + 100
+    data = os.urandom(blocks * BLKSIZE - 1)
+    stats = make_client().put("large.bin", io.BytesIO(data))
+    assert stats["blocks"] == blocks
+    assert read_file(server, "large.bin") == data
+    report(stats)
+
+
+def test_rrq_not_found(make_client):
+    with pytest.raises(client.TFTPError) as e:
+        make_client().get("missing.bin", io.BytesIO())
+    assert e.value.code == 1
+
+
+def test_rrq_path_traversal(make_client):
+    with pytest.raises(client.TFTPError) as e:
+        make_client().get("../../etc/passwd", io.BytesIO())
+    assert e.value.code == 1
+
+
+def test_wrq_disabled(server, make_client):
+    server.wrq_enable = False
+    with pytest.raises(client.TFTPError) as e:
+        make_client().put("file.bin", io.BytesIO(b"data"))
+    assert e.value.code == 4
+    assert not os.path.exists(os.path.join(server.file_dir, "file.bin"))
+
+
+def test_trace_replay(server, make_client, tmp_path):
+    trace_path = tmp_path / "transfers.trace"
+    server.trace = trace.TraceWriter(str(trace_path))
+    server.finish_listeners.append(server.trace.write)
+    data = write_file(server, "boot.img", 20 * BLKSIZE + 3)
+    tftp_client = make_client()
+    for _ in range(3):
+        tftp_client.get("boot.img", io.BytesIO())
+    with pytest.raises(client.TFTPError):
+        tftp_client.get("missing.img", io.BytesIO())
+    tftp_client.put("upload.bin", io.BytesIO(b"x" * 100), tsize=100)
+    # records are written once the handler thread is done
+    for _ in range(100):
+        records = list(trace.read_trace(str(trace_path)))
+        if len(records) == 5:
+            break
+        time.sleep(0.02)
+    assert [r["op"] for r in records].count("rrq") == 4
+    assert sorted(r["error"] for r in records if r["error"] is not None) == [1]
+    assert {r["filename"] for r in records} == {"boot.img", "missing.img", "upload.bin"}
+    assert [r["options"] for r in records if r["op"] == "wrq"] == [{"tsize": "100"}]
+    assert {r["bytes"] for r in records if r["filename"] == "boot.img"} == {len(data)}
+    address = server.sock.getsockname()
+    summary = trace.replay(records, address[0], address[1], speed=0, timeout=0.05)
+    assert summary["transfers"] == 4
+    assert summary["failed"] == 1
+    assert summary["bytes"] == 3 * len(data)
+
+
+def test_slow_transfer_profile(server, make_client, tmp_path):
+    dump_path = tmp_path / "slow.jsonl"
+    server.slow_log = profiling.SlowTransferLog(0, str(dump_path))
+    server.finish_listeners.append(server.slow_log.write)
+    write_file(server, "boot.img", 20 * BLKSIZE + 3)
+    tftp_client = make_client()
+    tftp_client.get("boot.img", io.BytesIO())
+    tftp_client.put("upload.bin", io.BytesIO(b"x" * 100))
+    for _ in range(100):
+        if dump_path.exists() and len(dump_path.read_text().splitlines()) == 2:
+            break
+        time.sleep(0.02)
+    records = [json.loads(line) for line in dump_path.read_text().splitlines()]
+    assert sorted(r["filename"] for r in records) == ["boot.img", "upload.bin"]
+    download = [r for r in records if r["filename"] == "boot.img"][0]
+    assert download["phases"]["read"]["calls"] == 21
+    assert download["phases"]["send"]["calls"] == 21
+    assert set(download["phases"]) == set(profiling.PHASES) | {"other"}
+
+
+def test_sampling_profiler(server, make_client, tmp_path):
+    profiler = profiling.SamplingProfiler(str(tmp_path), interval=0.001)
+    assert profiler.toggle()[0]
+    assert not profiler.start()[0]
+    write_file(server, "boot.img", 200 * BLKSIZE)
+    make_client().get("boot.img", io.BytesIO())
+    success, result = profiler.toggle()
+    assert success and result["samples"] > 0
+    with open(result["path"]) as f:
+        lines = f.read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert not profiler.stop()[0]
+
+
+@pytest.mark.parametrize("window", [1000, BLKSIZE, 64 * 1024])
+def test_rrq_readahead(server, make_client, report, window):
+    server.readahead = readahead.Readahead(window, workers=2, hot_reads=2)
+    data = write_file(server, "boot.img", 100 * BLKSIZE + 17)
+    tftp_client = make_client()
+    for _ in range(2):
+        output = io.BytesIO()
+        stats = tftp_client.get("boot.img", output)
+        assert output.getvalue() == data
+    report(stats)
+    _, status = server.readahead.status()
+    assert status["opened"] == 2
+    # read once, then hot
+    assert status["cold"] == 1
+    assert status["prefetched"] == 2 * len(data)
+    server.readahead.close()
+
+
+def test_readahead_keeps_files_turned_hot(tmp_path, monkeypatch):
+    dropped = []
+
+    def fadvise(fd, offset, length, advice):
+        if advice == getattr(os, "POSIX_FADV_DONTNEED", 0):
+            dropped.append((offset, length))
+
+    monkeypatch.setattr(readahead, "fadvise", fadvise)
+    path = tmp_path / "boot.img"
+    path.write_bytes(bytes(10 * 4096))
+    policy = readahead.Readahead(4096, workers=1, hot_reads=2)
+    first = policy.open(str(path))
+    # pages are dropped as the blocks after them are read
+    assert [len(first.read(4096)) for _ in range(3)] == [4096] * 3
+    assert dropped == [(0, 4096), (4096, 4096)]
+    # a second client makes it hot, the first one stops dropping its pages
+    second = policy.open(str(path))
+    first.read(5 * 4096)
+    first.close()
+    second.close()
+    assert dropped == [(0, 4096), (4096, 4096)]
+    # once out of the history it is cold again
+    policy.reads.clear()
+    policy.open(str(path)).close()
+    assert dropped[-1] == (0, 0)
+    policy.close()
+
+
+# memory an idle download may hold, thread stack included, so that tens of
+# thousands of them fit on a small machine
+MAX_BYTES_PER_SESSION = 64 * 1024
+
+
+@pytest.mark.parametrize("window", [None, 0])
+def test_idle_sessions(window, monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    result = bench.idle_sessions(sessions=200, settle=10, readahead=window)
+    assert result["idle"] == 200
+    assert 0 < result["bytes_per_session"] < MAX_BYTES_PER_SESSION
+    assert result["readahead"] == (128 * 1024 if window is None else 0)
+    assert not os.listdir(tmp_path)
+
+
+def test_session_state(server, make_client):
+    write_file(server, "boot.img", 10 * BLKSIZE)
+    make_client().get("boot.img", io.BytesIO())
+    for _ in range(100):
+        if not server.sessions:
+            break
+        time.sleep(0.02)
+    assert server.status()[1]["sessions"] == 0
+    handler = tftp.TFTPDClientHandler(server, b"", ("127.0.0.1", 0))
+    assert not hasattr(handler, "__dict__")
+    assert handler.state == tftp.STATE_NEW and handler.sock is None
+
+
+def test_reload_keeps_running_transfers(server, make_client, tmp_path):
+    data = write_file(server, "boot.img", 200 * BLKSIZE)
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    (other_dir / "boot.img").write_bytes(b"new")
+    slow_client = make_client(delay=0.002)
+    output = io.BytesIO()
+    download = threading.Thread(target=slow_client.get, args=("boot.img", output))
+    download.start()
+    for _ in range(100):
+        if server.status()[1]["states"]["sending"]:
+            break
+        time.sleep(0.01)
+    success, result = server.reload(file_dir=str(other_dir), wrq_enable=False)
+    assert success and result["changed"] == ["file_dir", "wrq_enable"]
+    new_output = io.BytesIO()
+    make_client().get("boot.img", new_output)
+    assert new_output.getvalue() == b"new"
+    download.join(10)
+    # the running download finished from the old folder
+    assert output.getvalue() == data
+    with pytest.raises(client.TFTPError):
+        make_client().put("file.bin", io.BytesIO(b"data"))
+
+
+def test_reload_rebinds(server, make_client, tmp_path):
+    data = write_file(server, "boot.img", 3 * BLKSIZE)
+    old_address = server.sock.getsockname()
+    assert not server.reload(file_dir=str(tmp_path / "missing"))[0]
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    success, result = server.reload(ip="127.0.0.1", port=port)
+    assert success and "port" in result["changed"]
+    output = io.BytesIO()
+    client.TFTPClient("127.0.0.1", port, 0.05, 20).get("boot.img", output)
+    assert output.getvalue() == data
+    time.sleep(1.2)
+    # the old socket is closed once drained
+    assert old_address != server.sock.getsockname()
+    assert not server.retired
+
+
+def test_reload_failure_keeps_settings(server, make_client, tmp_path):
+    assert server.reload(trace=str(tmp_path / "first.trace"))[0]
+    trace_writer, pool, retries = server.trace, server.readahead, server.retries
+    success, result = server.reload(
+        trace="/nonexistent/x.trace", readahead=4096, retries=9
+    )
+    assert not success and result.startswith("Reload failed")
+    assert (server.trace, server.readahead, server.retries) == (
+        trace_writer,
+        pool,
+        retries,
+    )
+    assert server.finish_listeners.count(trace_writer.write) == 1
+    assert server.settings().retries == retries
+    # the failed settings were not recorded, the next reload applies in full
+    success, result = server.reload(trace=str(tmp_path / "second.trace"))
+    assert success and result["changed"] == ["trace"]
+    assert server.trace is not trace_writer
+    assert server.finish_listeners == [server.trace.write]
+    data = write_file(server, "boot.img", 3 * BLKSIZE)
+    output = io.BytesIO()
+    make_client().get("boot.img", output)
+    assert output.getvalue() == data
+
+
+@pytest.mark.parametrize("name", ["audit.db", "audit.jsonl"])
+def test_audit(server, make_client, tmp_path, name):
+    server.reload(audit=str(tmp_path / name))
+    data = write_file(server, "boot.img", 20 * BLKSIZE + 3)
+    write_file(server, "kernel.img", 3 * BLKSIZE)
+    tftp_client = make_client()
+    for _ in range(3):
+        tftp_client.get("boot.img", io.BytesIO())
+    tftp_client.get("kernel.img", io.BytesIO())
+    with pytest.raises(client.TFTPError):
+        tftp_client.get("missing.img", io.BytesIO())
+    for _ in range(100):
+        if server.audit.status()[1]["queued"] == 0 and not server.sessions:
+            break
+        time.sleep(0.02)
+    success, result = server.audit.query()
+    assert success
+    assert result["transfers"] == 5
+    assert result["bytes"] == 3 * len(data) + 3 * BLKSIZE
+    assert result["outcomes"] == {"ok": 4, "error": 1}
+    assert result["top_files"][0] == {
+        "filename": "boot.img",
+        "transfers": 3,
+        "bytes": 3 * len(data),
+    }
+    assert [c["client"] for c in result["clients"]] == ["127.0.0.1"]
+    assert 0 < result["duration_p50"] <= result["duration_p95"]
+    assert server.audit.query(since=time.time() + 60)[1]["transfers"] == 0
+    _, status = server.audit.status()
+    assert status["written"] == 5 and status["dropped"] == 0
+    server.audit.close()
+
+
+def test_audit_drops_and_rotates(tmp_path):
+    class Handler:
+        time_ns = time.time_ns()
+        address = ("127.0.0.1", 1234)
+        opcode = tftp.OP_CODE_RRQ
+        filename = "boot.img"
+        bytes = 1000
+        blocks = 2
+        elapsed = 0.01
+        retransmits = timeouts = duplicates = 0
+        state = tftp.STATE_DONE
+        error_code = None
+
+    sink = audit.AuditSink(
+        str(tmp_path / "audit.jsonl"),
+        batch_size=10,
+        queue_size=50,
+        max_bytes=2000,
+        backups=2,
+    )
+    # the writer thread is stopped, records pile up in the queue
+    sink.stop_event.set()
+    sink.thread.join()
+    for _ in range(60):
+        sink.write(Handler())
+    assert sink.status()[1]["dropped"] == 10
+    sink.stop_event.clear()
+    sink.thread = threading.Thread(target=sink._run, daemon=True)
+    sink.thread.start()
+    assert sink.flush()
+    _, status = sink.status()
+    assert (status["written"], status["dropped"], status["batches"]) == (50, 10, 5)
+    # a batch of 10 lines is over max_bytes: every batch went to a new file
+    # and only the last three batches are kept
+    assert sorted(os.listdir(tmp_path)) == [
+        "audit.jsonl",
+        "audit.jsonl.1",
+        "audit.jsonl.2",
+    ]
+    assert sink.query()[1]["transfers"] == 30
+
+    # a record that cannot be written loses its batch, not the writer
+    bad = Handler()
+    bad.filename = object()
+    sink.write(bad)
+    assert sink.flush()
+    sink.write(Handler())
+    assert sink.flush()
+    _, status = sink.status()
+    assert (status["written"], status["errors"]) == (51, 1)
+    assert sink.thread.is_alive()
+    sink.close()
@@ -1,10 +1,18 @@
+import io
+import types
+import _thread
 import socket
 import os
+import time
+import uuid
+import errno
+import shutil
+import tempfile
 import struct
 import logging
 import select
 import threading
-from tftp import utils
+from tftp import utils, trace, profiling, readahead, audit
 
 # TFTP mode
 MODE_OCTET = "octet"
@@ -29,270 +37,418 @@ ERROR_CODE_EXISTS = 7  # File already exists.
 ERROR_CODE_NOUSER = 8  # No such user.
 
 
-class TFTPDClientHandler(threading.Thread):
-    """
-    This class implements a Client Handler to handle TFTP client requests.
-    """
+# transfer states, see TFTPDClientHandler.state
+STATE_NEW = 0  # request received
+STATE_SENDING = 1  # download, waiting for ACKs
+STATE_RECEIVING = 2  # upload, waiting for DATA
+STATE_DALLY = 3  # upload complete, answering a lost final ACK
+STATE_DONE = 4
+STATE_FAILED = 5  # error sent, aborted or timed out
+STATE_NAMES = ("new", "sending", "receiving", "dally", "done", "failed")
 
-    def __init__(
-        self,
-        sock: socket,
-        bind_ip,
-        file_dir,
-        wrq_enable=False,
-        retries=3,
-        timeout=5,
-        logger=None,
-        root_logger=None,
-        mode_verbose=True,
-        mode_debug=False,
-    ) -> None:
-        threading.Thread.__init__(self)
-
-        data, address = sock.recvfrom(1024)
+NO_OPTIONS = types.MappingProxyType({})
 
-        self.data = data
-        self.address = address
-        self.default_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.dl_sock = None
-        self.ul_sock = None
-        self.ip = bind_ip
-        self.file_dir = file_dir
-        self.wrq_enable = wrq_enable
-        self.default_retries = retries
-        self.timeout = timeout
-        self.retries = self.default_retries
-        self.blksize = 512
-        self.dl_file = None
-        self.dl_filename = ""
-        self.ul_file = None
-        self.ul_filename = ""
-
-        self.mode_verbose = mode_verbose  # verbose mode
-        self.mode_debug = mode_debug  # debug mode
-        self.logger = logger if logger is not None else None
-
-        if root_logger is not None:
-            self.logger = utils.get_child_logger(
-                root_logger, "Client-{}".format(address)
-            )
-
-        # setup logger
-        if self.logger == None:
-            self.logger = logging.getLogger("TFTP.Client.")
-            handler = logging.StreamHandler()
-            formatter = logging.Formatter(
-                "%(asctime)s [%(levelname)s] %(name)s %(message)s"
-            )
-            handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
 
-            if self.mode_debug:
-                self.logger.setLevel(logging.DEBUG)
-            elif self.mode_verbose:
-                self.logger.setLevel(logging.INFO)
-            else:
-                self.logger.setLevel(logging.WARN)
+class TFTPDClientHandler:
+    """
+    This class implements a Client Handler to handle TFTP client requests.
 
-        pass
+    One instance holds the state of one transfer in slots and shares its
+    settings, logger and caches with the other transfers of its server, so
+    tens of thousands of concurrent sessions stay small. The socket is
+    created on first use and the transfer runs on a bare thread started by
+    `start`.
+    """
 
-    def send_error(self, sock, error_code, error_message="", filename=""):
+    __slots__ = (
+        "server",
+        "settings",  # TransferSettings at the request
+        "address",
+        "data",
+        "time_ns",  # request arrival
+        "opcode",
+        "filename",  # as requested
+        "options",
+        "error_code",  # last error sent to the client
+        "state",
+        "sock",
+        "file",
+        "temp_filename",
+        "retries",
+        "bytes",
+        "blocks",
+        "retransmits",
+        "timeouts",
+        "duplicates",
+        "started",
+        "elapsed",
+        "profile",  # phase timings, see profiling.TransferProfile
+    )
+
+    blksize = 512
+
+    def __init__(self, server, data, address) -> None:
+        self.server = server
+        self.settings = server.settings()
+        self.address = address
+        self.data = data
+        self.time_ns = time.time_ns()
+        self.opcode = None
+        self.filename = ""
+        self.options = NO_OPTIONS
+        self.error_code = None
+        self.state = STATE_NEW
+        self.sock = None
+        self.file = None
+        self.temp_filename = None
+        self.retries = self.settings.retries
+        self.bytes = 0
+        self.blocks = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.duplicates = 0
+        self.started = time.monotonic()
+        self.elapsed = None
+        self.profile = None
+
+    @property
+    def logger(self):
+        return self.server.client_logger
+
+    @property
+    def stats(self):
+        """bytes, blocks, retransmits, timeouts, duplicates and times"""
+        stats = {
+            "bytes": self.bytes,
+            "blocks": self.blocks,
+            "retransmits": self.retransmits,
+            "timeouts": self.timeouts,
+            "duplicates": self.duplicates,
+            "started": self.started,
+        }
+        if self.elapsed is not None:
+            stats["elapsed"] = self.elapsed
+        return stats
+
+    def open_socket(self):
+        """the transfer socket, created on first use"""
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.settimeout(self.settings.timeout)
+        return self.sock
+
+    def send_error(self, error_code, error_message="", filename="", address=None):
         """send error"""
         msg = struct.pack("!H", OP_CODE_ERROR)  # error opcode
         msg += struct.pack("!H", error_code)  # error code
         msg += error_message.encode("ascii")
         msg += b"\x00"
-        sock.sendto(msg, self.address)
+        self.open_socket().sendto(msg, self.address if address is None else address)
+        if address is None:
+            self.error_code = error_code
+            self.state = STATE_FAILED
         self.logger.info(
-            "Sending Error {0}: {1} {2}".format(error_code, error_message, filename)
+            "Sending Error {0} to {1}: {2} {3}".format(
+                error_code,
+                self.address if address is None else address,
+                error_message,
+                filename,
+            )
         )
 
-    def send_data(self, sock, block_number, data):
+    def send_data(self, block_number, data):
         """send data"""
-        msg = struct.pack("!HH%ds" % len(data), OP_CODE_DATA, block_number, data)
-        sock.sendto(msg, self.address)
-        self.logger.debug("Sending Data {0}: {1}".format(block_number, data))
+        msg = struct.pack("!HH", OP_CODE_DATA, block_number) + data
+        self.sock.sendto(msg, self.address)
+        self.logger.debug(
+            "Sending Data {0} to {1}: {2} bytes".format(
+                block_number, self.address, len(data)
+            )
+        )
 
-    def send_ack(self, sock, block_number):
+    def send_ack(self, block_number):
         """send ack"""
         msg = struct.pack("!HH", OP_CODE_ACK, block_number)
-        sock.sendto(msg, self.address)
-        self.logger.debug("Sending ACK: {0}".format(block_number))
+        self.sock.sendto(msg, self.address)
+        self.logger.debug("Sending ACK to {0}: {1}".format(self.address, block_number))
+
+    def read_block(self):
+        """read the next block of the download"""
+        return self.file.read(self.blksize)
+
+    def write_block(self, data):
+        """write the next block of the upload"""
+        self.file.write(data)
+
+    def recv_packet(self):
+        """receive (opcode, block number, payload) from the client, None on timeout"""
+        while True:
+            try:
+                packet, address = self.sock.recvfrom(self.blksize + 4)
+            except socket.timeout:
+                self.timeouts += 1
+                return None
+            if address != self.address:
+                # packet from another transfer ID, tell its sender and go on
+                self.send_error(
+                    ERROR_CODE_BADOPID, "Unknown transfer ID", address=address
+                )
+                continue
+            if len(packet) < 4:
+                continue
+            opcode, block_number = struct.unpack("!HH", packet[:4])
+            return opcode, block_number, packet[4:]
+
+    def log_stats(self, action, filename):
+        """log throughput and retransmissions of the finished transfer"""
+        self.elapsed = elapsed = time.monotonic() - self.started
+        self.logger.info(
+            "{} {} to {} finish: {} bytes in {} blocks, {:.3f}s, {:.1f} KiB/s, "
+            "{} retransmits, {} timeouts, {} duplicates".format(
+                action,
+                filename,
+                self.address,
+                self.bytes,
+                self.blocks,
+                elapsed,
+                self.bytes / 1024 / max(elapsed, 1e-9),
+                self.retransmits,
+                self.timeouts,
+                self.duplicates,
+            )
+        )
 
     def handle_rrq(self, filename, mode):
         """handle read request"""
-        self.dl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # self.dl_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # self.dl_sock.bind((self.ip, 0))
+        settings = self.settings
         # Check if the file read mode octet; if not, send an error.
         if mode != MODE_OCTET:
             self.send_error(
-                self.dl_sock,
-                ERROR_CODE_BADOPID,
-                "Mode {0} not supported".format(mode),
-                filename,
+                ERROR_CODE_BADOPID, "Mode {0} not supported".format(mode), filename
             )
             return
         # Check if the file exists under the file_dir, and if it is a file; if not, send an error.
         try:
-            filename = utils.path_normalize(self.file_dir, filename)
+            filename = utils.path_normalize(settings.file_dir, filename)
         except Exception:
-            self.send_error(
-                self.dl_sock, ERROR_CODE_NOTFOUND, "Path traversal error", filename
-            )
+            self.send_error(ERROR_CODE_NOTFOUND, "Path traversal error", filename)
             return
         if not os.path.lexists(filename) or not os.path.isfile(filename):
-            self.send_error(
-                self.dl_sock, ERROR_CODE_NOTFOUND, "File Not Found", filename
-            )
+            self.send_error(ERROR_CODE_NOTFOUND, "File Not Found", filename)
             return
-        self.dl_filename = filename
         try:
-            self.dl_file = open(filename, "rb")
-            wrap = 0
-            arm_wrap = False
+            cached = (
+                settings.cache.get(filename) if settings.cache is not None else None
+            )
+            if cached is not None:
+                self.file = io.BytesIO(cached)
+            elif settings.readahead is not None:
+                self.file = settings.readahead.open(filename)
+            else:
+                self.file = open(filename, "rb")
+            self.open_socket()
+            self.state = STATE_SENDING
+            # block numbers are sent modulo 65536, wrapping to 0 after 65535
             block_number = 1
+            data = self.read_block()
+            self.send_data(block_number & 0xFFFF, data)
             while True:
-                self.dl_file.seek(self.blksize * (block_number - 1))
-                data = self.dl_file.read(self.blksize)
-                if not data:
-                    # EOF, send last zero-length block
-                    break
-                self.send_data(self.dl_sock, block_number, data)
-                if len(data) < self.blksize:
-                    # rrq finished
-                    self.logger.debug("Download {} finish".format(filename))
-                    return
-                try:
-                    self.dl_sock.settimeout(self.timeout)
-                    ack_data, addr = self.dl_sock.recvfrom(1024)
-                except Exception as e:
-                    self.logger.info("Download {} error: {}".format(filename, e))
-                    # timeout and retry
-                    if self.retries > 0:
-                        self.retries -= 1
-                        continue
-                    break
-                opcode, ack_block_number = struct.unpack("!HH", ack_data)
-                if ack_block_number != ack_block_number:
-                    # raise Exception("Incorrect block number in ACK")
-                    # data loss and resend
+                packet = self.recv_packet()
+                if packet is None:
+                    # timeout and resend
+                    if self.retries <= 0:
+                        raise Exception(
+                            "Timed out waiting for ACK {}".format(block_number)
+                        )
+                    self.retries -= 1
+                    self.retransmits += 1
+                    self.send_data(block_number & 0xFFFF, data)
+                    continue
+                opcode, ack_block_number, payload = packet
+                if opcode == OP_CODE_ERROR:
+                    self.state = STATE_FAILED
                     self.logger.info(
-                        "Incorrect block number: ack_block_number/block_number = {}/{}".format(
-                            ack_block_number, ack_block_number
+                        "Download {} aborted by client {}: {}".format(
+                            filename, self.address, payload.rstrip(b"\x00")
                         )
                     )
-                    pass
-                if opcode == OP_CODE_ACK:
-                    if ack_block_number == 0 and arm_wrap:
-                        wrap += 1
-                        arm_wrap = False
-                    if ack_block_number == 32768:
-                        arm_wrap = True
-                    if ack_block_number < block_number % 65536:
-                        self.logger.warning(
-                            "Ignoring duplicated ACK received for block {0}".format(
-                                block_number
-                            )
-                        )
-                    elif ack_block_number > block_number % 65536:
-                        self.logger.warning(
-                            "Ignoring out of sequence ACK received for block {0}".format(
-                                block_number
-                            )
-                        )
-                    elif ack_block_number + self.wrap * 65536 == self.lastblock:
-                        if self.filesize % self.blksize == 0:
-                            block_number = ack_block_number + 1
-                            self.send_block()
-                        self.logger.info("Completed sending {0}".format(self.filename))
-                        self.complete()
-                    else:
-                        # data loss and resend
-                        block_number = ack_block_number + 1
-                        self.retries = self.default_retries
-                        self.send_block()
-            # Send last zero-length block to indicate EOF
-            self.send_data(self.dl_sock, block_number, b"")
+                    return
+                if opcode != OP_CODE_ACK:
+                    continue
+                if ack_block_number != block_number & 0xFFFF:
+                    # a delayed or duplicated ACK of an earlier block; resending
+                    # on it would double every later block (Sorcerer's Apprentice)
+                    self.duplicates += 1
+                    continue
+                self.retries = settings.retries
+                self.blocks += 1
+                self.bytes += len(data)
+                if len(data) < self.blksize:
+                    # the short (possibly empty) last block is acknowledged
+                    break
+                block_number += 1
+                data = self.read_block()
+                self.send_data(block_number & 0xFFFF, data)
+            self.state = STATE_DONE
+            self.log_stats("Download", filename)
         except FileNotFoundError:
-            self.send_error(
-                self.dl_sock, ERROR_CODE_NOTFOUND, "File not found", filename
-            )
+            self.send_error(ERROR_CODE_NOTFOUND, "File not found", filename)
         except Exception as e:
-            self.send_error(self.dl_sock, ERROR_CODE_ILLEGAL, str(e), filename)
+            self.send_error(ERROR_CODE_ILLEGAL, str(e), filename)
+
+    def check_space(self, filename, size=None):
+        """
+        Check that `size` bytes (None when unknown) fit into filename.
+
+        Returns (True, max size allowed or None) or (False, reason).
+        """
+        settings = self.settings
+        if settings.usage is not None:
+            fits, limit = settings.usage.check(
+                os.path.relpath(filename, settings.file_dir), size
+            )
+            if not fits:
+                return fits, limit
+        else:
+            limit = None
+        if settings.min_free_space > 0 or size is not None:
+            free = shutil.disk_usage(os.path.dirname(filename)).free
+            free_limit = free - settings.min_free_space
+            if free_limit <= 0 or (size is not None and size > free_limit):
+                return False, "Disk full: {} bytes free".format(free)
+            if settings.min_free_space > 0 and (limit is None or free_limit < limit):
+                limit = free_limit
+        return True, limit
 
     def handle_wrq(self, filename, mode):
         """handle write request"""
-        self.ul_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        settings = self.settings
         # Check if the file read mode octet; if not, send an error.
         if mode != MODE_OCTET:
-            print("Not OCTET", mode)
             self.send_error(
-                self.ul_sock,
-                ERROR_CODE_BADOPID,
-                "Mode {0} not supported".format(mode),
-                filename,
+                ERROR_CODE_BADOPID, "Mode {0} not supported".format(mode), filename
             )
             return
         # Check if the file exists under the file_dir, and if it is a file; if not, send an error.
         try:
-            filename = utils.path_normalize(self.file_dir, filename)
+            filename = utils.path_normalize(settings.file_dir, filename)
         except Exception:
-            self.send_error(
-                self.ul_sock, ERROR_CODE_NOTFOUND, "Path traversal error", filename
-            )
+            self.send_error(ERROR_CODE_NOTFOUND, "Path traversal error", filename)
+            return
+        # Check the announced size (RFC2349 tsize) before any byte is written
+        try:
+            tsize = int(self.options["tsize"]) if "tsize" in self.options else None
+        except ValueError:
+            tsize = None
+        fits, limit = self.check_space(filename, tsize)
+        if not fits:
+            self.send_error(ERROR_CODE_DISKFULL, limit, filename)
             return
-        self.ul_filename = filename
+        # Receive into a temp file, renamed over the target once complete
+        self.temp_filename = "{}-{}.filepart".format(filename, uuid.uuid4())
         try:
-            self.ul_file = open(filename, "wb")
+            existed = os.path.exists(filename)
+            self.file = open(self.temp_filename, "wb")
+            self.open_socket()
+            self.state = STATE_RECEIVING
             block_number = 0
-            self.send_ack(self.ul_sock, block_number)
+            self.send_ack(block_number)
             block_number += 1
             while True:
-                data, addr = self.ul_sock.recvfrom(1024)
-                if len(data) < 4:
-                    # Invalid packet or EOF
-                    break
-                (
-                    opcode,
-                    recv_block_number,
-                ) = struct.unpack("!HH", data[:4])
-                if opcode != OP_CODE_DATA or recv_block_number != block_number:
-                    # raise Exception("Invalid DATA packet")
-                    # data loss and resend
-                    self.logger.info(
-                        "Invalid DATA packet: recv_block_number/block_number = {}/{}".format(
-                            recv_block_number, block_number
-                        )
+                packet = self.recv_packet()
+                if packet is None:
+                    # timeout and resend the last ACK
+                    if self.retries <= 0:
+                        raise Exception("Upload timed out")
+                    self.retries -= 1
+                    self.retransmits += 1
+                    self.send_ack((block_number - 1) & 0xFFFF)
+                    continue
+                opcode, recv_block_number, data = packet
+                if opcode == OP_CODE_ERROR:
+                    raise Exception(
+                        "Aborted by client: {}".format(data.rstrip(b"\x00"))
                     )
-                    self.send_ack(self.ul_sock, block_number - 1)
+                if opcode != OP_CODE_DATA or recv_block_number != block_number & 0xFFFF:
+                    # the previous block again, its ACK was lost
+                    self.duplicates += 1
+                    self.send_ack((block_number - 1) & 0xFFFF)
                     continue
-                self.ul_file.write(data[4:])
-                self.ul_file.flush()
-                self.send_ack(self.ul_sock, block_number)
+                self.bytes += len(data)
+                if limit is not None and self.bytes > limit:
+                    raise OSError(errno.ENOSPC, "Disk full or quota exceeded")
+                self.write_block(data)
+                self.retries = settings.retries
+                self.blocks += 1
+                if len(data) < self.blksize:
+                    # last block
+                    break
+                self.send_ack(block_number & 0xFFFF)
                 block_number += 1
+            self.file.close()
+            os.replace(self.temp_filename, filename)
+            # keep the shared usage totals and content cache current
+            for listener in (settings.usage, settings.cache):
+                if listener is not None:
+                    listener.apply(
+                        "modify" if existed else "create",
+                        os.path.relpath(filename, settings.file_dir),
+                        False,
+                    )
+            self.send_ack(block_number & 0xFFFF)
+            self.state = STATE_DALLY
+            self.log_stats("Upload", filename)
+            # dally: answer the last block again if the final ACK was lost
+            while True:
+                packet = self.recv_packet()
+                if packet is None:
+                    break
+                if packet[0] == OP_CODE_DATA and packet[1] == block_number & 0xFFFF:
+                    self.send_ack(block_number & 0xFFFF)
+            self.state = STATE_DONE
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                self.send_error(ERROR_CODE_DISKFULL, str(e), filename)
+            else:
+                self.send_error(ERROR_CODE_ILLEGAL, str(e), filename)
         except Exception as e:
-            self.send_error(self.ul_sock, ERROR_CODE_ILLEGAL, str(e), filename)
+            self.send_error(ERROR_CODE_ILLEGAL, str(e), filename)
+        finally:
+            try:
+                self.file.close()
+            except Exception:
+                pass
+            if os.path.exists(self.temp_filename):
+                os.unlink(self.temp_filename)
 
     def handle_request(self):
         """handle request from client"""
         (opcode,) = struct.unpack("!H", self.data[:2])
+        self.opcode = opcode
+        if opcode in (OP_CODE_RRQ, OP_CODE_WRQ):
+            fields = self.data[2:].split(b"\x00")
+            self.filename = fields[0].decode("ascii")
+            mode = fields[1].decode("ascii")
+            # options (RFC2347) follow as name/value pairs
+            options = {
+                name.decode("ascii").lower(): value.decode("ascii")
+                for name, value in zip(fields[2::2], fields[3::2])
+                if name
+            }
+            if options:
+                self.options = options
+        # the request is parsed, keep no copy of it
+        self.data = None
         if opcode == OP_CODE_RRQ:
-            filename = self.data[2:].split(b"\x00")[0].decode("ascii").lstrip("/")
-            mode = self.data[2:].split(b"\x00")[1].decode("ascii")
+            filename = self.filename.lstrip("/")
             self.logger.info(
                 "handle request rrq: [{}][{}][{}]".format(self.address, filename, mode)
             )
             self.handle_rrq(filename, mode)
         elif opcode == OP_CODE_WRQ:
-            filename = self.data[2:].split(b"\x00")[0].decode("ascii")
-            mode = self.data[2:].split(b"\x00")[1].decode("ascii")
-            if not self.wrq_enable:
-                self.send_error(
-                    self.default_socket,
-                    ERROR_CODE_ILLEGAL,
-                    "Write request is not enable",
-                )
+            filename = self.filename
+            if not self.settings.wrq_enable:
+                self.send_error(ERROR_CODE_ILLEGAL, "Write request is not enable")
             else:
                 self.logger.info(
                     "handle request wrq: [{}][{}][{}]".format(
@@ -301,36 +457,71 @@ class TFTPDClientHandler(threading.Thread):
                 )
                 self.handle_wrq(filename, mode)
         else:
-            self.send_error(
-                self.default_socket, ERROR_CODE_BADOPID, "Opcode not understood"
-            )
+            self.send_error(ERROR_CODE_BADOPID, "Opcode not understood")
+
+    def start(self):
+        """run the transfer on a new thread"""
+        self.server.sessions.add(self)
+        try:
+            _thread.start_new_thread(self.run, ())
+        except BaseException:
+            self.server.sessions.discard(self)
+            raise
 
     def run(self) -> None:
         # handel start
         self.logger.info("handle start: [{}]".format(self.address))
-        self.handle_request()
-        # handle end
         try:
-            self.dl_file.close()
-        except Exception:
-            pass
-        try:
-            self.dl_sock.close()
-        except Exception:
-            pass
-        try:
-            self.ul_file.close()
-        except Exception:
-            pass
+            self.handle_request()
+        except Exception as e:
+            self.state = STATE_FAILED
+            self.logger.warning("handle error: [{}] {}".format(self.address, e))
+        # handle end
         try:
-            self.ul_sock.close()
+            self.file.close()
         except Exception:
             pass
         try:
-            self.default_socket.close()
+            self.sock.close()
         except Exception:
             pass
+        self.file = None
+        self.sock = None
         self.logger.info("handle   end: [{}]".format(self.address))
+        if self.elapsed is None:
+            self.elapsed = time.monotonic() - self.started
+        self.server.sessions.discard(self)
+        try:
+            self.server.on_finish(self)
+        except Exception as e:
+            self.logger.warning("Finish callback error: {}".format(e))
+
+
+class TransferSettings:
+    """
+    Settings a transfer runs under. Handlers keep the instance current at
+    their request, so a reload only applies to transfers started after it.
+    """
+
+    __slots__ = (
+        "file_dir",
+        "wrq_enable",
+        "retries",
+        "timeout",
+        "min_free_space",
+        "usage",
+        "cache",
+        "readahead",
+    )
+
+    def __init__(self, server):
+        for name in self.__slots__:
+            setattr(self, name, getattr(server, name))
+
+    def current(self, server):
+        return all(
+            getattr(self, name) == getattr(server, name) for name in self.__slots__
+        )
 
 
 class TFTPD:
@@ -340,21 +531,7 @@ class TFTPD:
     """
 
     def __init__(self, **server_settings):
-        self.ip = server_settings.get("ip", "0.0.0.0")
-        self.port = int(server_settings.get("port", 69))
-        self.file_dir = server_settings.get("file_dir", "files")
-        self.wrq_enable = server_settings.get("wrq_enable", False)
-        self.mode_verbose = server_settings.get("mode_verbose", True)  # verbose mode
-        self.mode_debug = server_settings.get("mode_debug", False)  # debug mode
         self.logger = server_settings.get("logger", None)
-        self.retries = server_settings.get("retries", 3)
-        self.timeout = server_settings.get("timeout", 5)
-
-        # setup socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.ip, self.port))
-
         # setup logger
         if self.logger == None:
             self.logger = logging.getLogger("TFTP")
@@ -364,13 +541,28 @@ class TFTPD:
             )
             handler.setFormatter(formatter)
             self.logger.addHandler(handler)
+        # one logger for every transfer, messages carry the client address
+        self.client_logger = self.logger.getChild("Client")
+
+        # called with each finished TFTPDClientHandler
+        self.finish_listeners = []
+        self.readahead = None
+        self.trace = None
+        self.audit = None
+        self.slow_log = None
+        self.profiler = None
+        self.server_settings = None
+        self.reload_lock = threading.Lock()
+        self.configure(server_settings)
+        self.server_settings = dict(server_settings)
 
-        if self.mode_debug:
-            self.logger.setLevel(logging.DEBUG)
-        elif self.mode_verbose:
-            self.logger.setLevel(logging.INFO)
-        else:
-            self.logger.setLevel(logging.WARN)
+        # setup socket
+        self.ip = server_settings.get("ip", "0.0.0.0")
+        self.port = int(server_settings.get("port", 69))
+        self.sock = self.bind(self.ip, self.port)
+        # sockets replaced by a reload, closed by the listen loop
+        self.retired = []
+        self.transfer_settings = TransferSettings(self)
 
         self.logger.info(
             "NOTICE: TFTP server started in debug mode. TFTP server is using the following:"
@@ -379,34 +571,242 @@ class TFTPD:
         self.logger.info("Server Port: {0}".format(self.port))
         self.logger.info("TFTP File Root Directory: {0}".format(self.file_dir))
 
-        self.ongoing = []
+        # transfers in progress, see TFTPDClientHandler.state
+        self.sessions = set()
+        self.stopping = threading.Event()
+
+    def bind(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((ip, port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def configure(self, server_settings):
+        """
+        Apply settings, keeping the readahead pool, trace, audit log, slow
+        transfer log and profiler whose own settings are unchanged. Every
+        new component is created before anything is changed, so settings
+        that fail to apply leave the server as it was.
+        """
+        previous = self.server_settings
+
+        def changed(*names):
+            return previous is None or any(
+                server_settings.get(name) != previous.get(name) for name in names
+            )
+
+        values = {
+            "file_dir": server_settings.get("file_dir", "files"),
+            "wrq_enable": server_settings.get("wrq_enable", False),
+            "mode_verbose": server_settings.get("mode_verbose", True),
+            "mode_debug": server_settings.get("mode_debug", False),
+            "retries": server_settings.get("retries", 3),
+            "timeout": server_settings.get("timeout", 5),
+            # disk usage tracker checking uploads against quotas, see api.usage
+            "usage": server_settings.get("usage", None),
+            "min_free_space": int(server_settings.get("min_free_space", 0)),
+            # file content cache shared with the api, see cache.FileCache
+            "cache": server_settings.get("cache", None),
+            # smaller stacks fit more concurrent transfers, 0: platform default
+            "thread_stack_size": int(server_settings.get("thread_stack_size", 0)),
+        }
+        built = {}  # component attribute -> its replacement, None to remove
+        try:
+            # read the next window of a download while the current one is
+            # sent, 0 disables readahead
+            if changed("readahead", "readahead_workers", "readahead_dontneed"):
+                window = int(server_settings.get("readahead", 128 * 1024))
+                built["readahead"] = None
+                if window > 0:
+                    built["readahead"] = readahead.Readahead(
+                        window,
+                        int(server_settings.get("readahead_workers", 4)),
+                        server_settings.get("readahead_dontneed", True),
+                    )
+            if changed("trace"):
+                built["trace"] = None
+                if server_settings.get("trace", None):
+                    # append-only binary log of every transfer, see trace.py
+                    built["trace"] = trace.TraceWriter(server_settings["trace"])
+            if changed("audit"):
+                built["audit"] = None
+                if isinstance(server_settings.get("audit", None), audit.AuditSink):
+                    built["audit"] = server_settings["audit"]
+                elif server_settings.get("audit", None):
+                    # batched record of every transfer, see audit.py
+                    built["audit"] = audit.AuditSink(server_settings["audit"])
+            # phase timings of transfers slower than profile_slow seconds
+            if changed("profile_slow", "profile_dump"):
+                built["slow_log"] = None
+                if server_settings.get("profile_slow", None) is not None:
+                    built["slow_log"] = profiling.SlowTransferLog(
+                        float(server_settings["profile_slow"]),
+                        server_settings.get("profile_dump", None),
+                    )
+            # sampling profiler, toggled with SIGUSR1 or the api
+            if server_settings.get("profiler", None) is not None:
+                built["profiler"] = server_settings["profiler"]
+            elif self.profiler is None:
+                built["profiler"] = profiling.SamplingProfiler(
+                    server_settings.get("profile_dir", None)
+                )
+            if changed("thread_stack_size") and (
+                values["thread_stack_size"] or previous is not None
+            ):
+                # process wide, for the threads started from now on
+                threading.stack_size(values["thread_stack_size"])
+        except BaseException:
+            for name, component in built.items():
+                if component is not None and component is not server_settings.get(name):
+                    self._close(component)
+            raise
+
+        # nothing below fails, transfers see the old or the new settings as
+        # settings() takes the reload lock too
+        for name, value in values.items():
+            setattr(self, name, value)
+        if self.mode_debug:
+            self.logger.setLevel(logging.DEBUG)
+        elif self.mode_verbose:
+            self.logger.setLevel(logging.INFO)
+        else:
+            self.logger.setLevel(logging.WARN)
+        listeners = list(self.finish_listeners)
+        retired = []
+        for name, component in built.items():
+            old = getattr(self, name)
+            if old is not None and old is not component:
+                if getattr(old, "write", None) in listeners:
+                    listeners.remove(old.write)
+                retired.append(old)
+            setattr(self, name, component)
+            if name in ("trace", "audit", "slow_log") and component is not None:
+                listeners.append(component.write)
+        # a new list, on_finish may be iterating over the old one
+        self.finish_listeners = listeners
+        if "profiler" not in built and changed("profile_dir"):
+            self.profiler.output_dir = (
+                server_settings.get("profile_dir", None) or tempfile.gettempdir()
+            )
+        for old in retired:
+            # running downloads go on reading on their own threads
+            self._close(old)
+
+    def _close(self, component):
+        close = getattr(component, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            self.logger.warning("Close of {} failed: {}".format(component, e))
+
+    def reload(self, **server_settings):
+        """
+        Update settings without dropping transfers: running transfers finish
+        under the settings they started with, new ones get the new settings.
+        Settings not given keep their value. A new ip or port is bound
+        before the old socket is retired, a failed bind keeps the old one.
+
+        Returns (True, names of the changed settings) or (False, reason).
+        """
+        with self.reload_lock:
+            settings = dict(self.server_settings)
+            settings.update(server_settings)
+            file_dir = settings.get("file_dir", "files")
+            if not os.path.isdir(file_dir):
+                return False, "File directory {} does not exist".format(file_dir)
+            ip = settings.get("ip", "0.0.0.0")
+            port = int(settings.get("port", 69))
+            sock = None
+            if (ip, port) != (self.ip, self.port):
+                try:
+                    sock = self.bind(ip, port)
+                except OSError as e:
+                    return False, "Cannot bind {}:{}: {}".format(ip, port, e)
+            changes = sorted(
+                name
+                for name in set(settings) | set(self.server_settings)
+                if settings.get(name) != self.server_settings.get(name)
+            )
+            try:
+                self.configure(settings)
+            except Exception as e:
+                if sock is not None:
+                    sock.close()
+                return False, "Reload failed: {}".format(e)
+            self.server_settings = settings
+            if sock is not None:
+                self.retired.append(self.sock)
+                self.sock = sock
+                self.ip, self.port = ip, port
+            self.logger.info("Settings reloaded: {}".format(", ".join(changes)))
+            return True, {"changed": changes}
+
+    def settings(self):
+        """Shared TransferSettings for a new transfer."""
+        # not in the middle of a reload
+        with self.reload_lock:
+            transfer_settings = self.transfer_settings
+            if not transfer_settings.current(self):
+                transfer_settings = self.transfer_settings = TransferSettings(self)
+            return transfer_settings
 
     def listen(self):
         """This method listens for incoming requests."""
-        while True:
-            rlist, _, _ = select.select([self.sock], [], [], 1)
+        while not self.stopping.is_set():
+            sockets = [self.sock] + self.retired
+            rlist, _, _ = select.select(sockets, [], [], 1)
+            for retired in sockets[1:]:
+                if retired not in rlist:
+                    # drained since a reload bound a new socket
+                    self.retired.remove(retired)
+                    retired.close()
             for sock in rlist:
-                if sock == self.sock:
-                    # Create a new thread to handle the client request
-                    TFTPDClientHandler(
-                        sock=self.sock,
-                        bind_ip=self.ip,
-                        file_dir=self.file_dir,
-                        wrq_enable=self.wrq_enable,
-                        retries=self.retries,
-                        timeout=self.timeout,
-                        logger=None,
-                        root_logger=self.logger,
-                        mode_verbose=self.mode_verbose,
-                        mode_debug=self.mode_debug,
-                    ).start()
-                else:
-                    # client socket, so tell the client object it's ready
-                    sock.parent.ready()
+                # Create a new thread to handle the client request
+                data, address = sock.recvfrom(1024)
+                handler = TFTPDClientHandler(self, data, address)
+                if self.slow_log is not None:
+                    profiling.TransferProfile().instrument(handler)
+                try:
+                    handler.start()
+                except RuntimeError as e:
+                    # out of threads, the client will retry
+                    self.logger.warning(
+                        "Cannot start transfer for {}: {}".format(address, e)
+                    )
+        self.sock.close()
+        for sock in self.retired:
+            sock.close()
+        if self.readahead is not None:
+            # ongoing downloads go on reading on their own threads
+            self.readahead.close()
+
+    def on_finish(self, handler):
+        for listener in self.finish_listeners:
+            try:
+                listener(handler)
+            except Exception as e:
+                self.logger.warning("Finish listener error: {}".format(e))
+
+    def status(self):
+        """Number of transfers in progress, in total and per state."""
+        states = dict.fromkeys(STATE_NAMES, 0)
+        for handler in list(self.sessions):
+            states[STATE_NAMES[handler.state]] += 1
+        return True, {"sessions": sum(states.values()), "states": states}
 
     def run(self):
         self.listen()
 
+    def stop(self):
+        """Stop listening within a second, ongoing transfers finish."""
+        self.stopping.set()
+
 
 if __name__ == "__main__":
     TFTPD().run()
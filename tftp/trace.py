@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"TFTPTRC\x01"
+# time_ns, duration_us, ip, port, opcode, error_code (0xFFFF: none), bytes,
+# blocks, retransmits, timeouts, duplicates, filename length, options length
+RECORD = struct.Struct("!qI4sHBHQIIIIHH")
+NO_ERROR = 0xFFFF
+OPCODES = {1: "rrq", 2: "wrq"}
+
+
+class TraceWriter:
+    """
+    Append-only binary log with one record per finished transfer.
+
+    A record is a fixed `RECORD` header followed by the requested filename
+    and the raw options (name\\0value\\0...), written with a single write
+    so concurrent handlers never interleave. A reader stops at a torn tail
+    record, so the log survives a crash mid-write.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.file = open(self.path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+
+    def write(self, handler):
+        """Finish listener, see `TFTPD.finish_listeners`."""
+        if handler.opcode not in OPCODES:
+            return
+        try:
+            ip = socket.inet_aton(handler.address[0])
+        except OSError:
+            ip = bytes(4)
+        filename = handler.filename.encode("ascii", "replace")[:0xFFFF]
+        options = b"".join(
+            "{}\x00{}\x00".format(name, value).encode("ascii", "replace")
+            for name, value in handler.options.items()
+        )[:0xFFFF]
+        stats = handler.stats
+        record = RECORD.pack(
+            handler.time_ns,
+            min(int(stats["elapsed"] * 1e6), 0xFFFFFFFF),
+            ip,
+            handler.address[1],
+            handler.opcode,
+            NO_ERROR if handler.error_code is None else handler.error_code,
+            stats["bytes"],
+            stats["blocks"],
+            stats["retransmits"],
+            stats["timeouts"],
+            stats["duplicates"],
+            len(filename),
+            len(options),
+        )
+        with self.lock:
+            self.file.write(record + filename + options)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_trace(path):
+    """Yield the records of a trace as dicts."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a tftp trace".format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            fields = RECORD.unpack(header)
+            filename = f.read(fields[11])
+            options = f.read(fields[12])
+            if len(filename) < fields[11] or len(options) < fields[12]:
+                return
+            options = options.split(b"\x00")
+            yield {
+                "time_ns": fields[0],
+                "duration": fields[1] / 1e6,
+                "client": "{}:{}".format(socket.inet_ntoa(fields[2]), fields[3]),
+                "op": OPCODES.get(fields[4], str(fields[4])),
+                "error": None if fields[5] == NO_ERROR else fields[5],
+                "bytes": fields[6],
+                "blocks": fields[7],
+                "retransmits": fields[8],
+                "timeouts": fields[9],
+                "duplicates": fields[10],
+                "filename": filename.decode("ascii"),
+                "options": {
+                    name.decode("ascii"): value.decode("ascii")
+                    for name, value in zip(options[0::2], options[1::2])
+                    if name
+                },
+            }
+
+
+class _Discard:
+    def write(self, data):
+        return len(data)
+
+
+class _Zeros:
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return bytes(size)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def replay(
+    records, host, port=69, speed=1.0, workers=64, timeout=1.0, retries=5, wrq=False
+):
+    """
+    Re-issue recorded transfers against a server, keeping their relative
+    timing divided by `speed` (0 for as fast as possible). Reads are
+    discarded, writes (only with `wrq`) upload zeros of the recorded size.
+    Returns a summary with the lateness of the schedule, so an overloaded
+    client is not mistaken for a slow server.
+    """
+    from tftp.client import TFTPClient, TFTPError
+
+    # records are appended as transfers finish, replay them as they started
+    records = sorted(
+        (r for r in records if r["op"] == "rrq" or (wrq and r["op"] == "wrq")),
+        key=lambda r: r["time_ns"],
+    )
+    tftp_client = TFTPClient(host, port, timeout, retries)
+    results = []
+    lock = threading.Lock()
+
+    def run(record, due):
+        started = time.monotonic()
+        # behind schedule, waiting for a worker or for the scheduler
+        late = max(0.0, started - start - due)
+        try:
+            if record["op"] == "rrq":
+                stats = tftp_client.get(record["filename"], _Discard())
+            else:
+                stats = tftp_client.put(
+                    record["filename"], _Zeros(record["bytes"]), record["bytes"]
+                )
+            error = None
+        except (TFTPError, OSError) as e:
+            stats, error = None, str(e)
+        with lock:
+            results.append((record, stats, error, time.monotonic() - started, late))
+
+    if records:
+        first = records[0]["time_ns"]
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for record in records:
+                due = (record["time_ns"] - first) / 1e9 / speed if speed > 0 else 0
+                wait = due - (time.monotonic() - start)
+                if wait > 0:
+                    time.sleep(wait)
+                executor.submit(run, record, due)
+        elapsed = time.monotonic() - start
+    else:
+        elapsed = 0.0
+
+    durations = [duration for _, stats, _, duration, _ in results if stats]
+    recorded = [record["duration"] for record, stats, _, _, _ in results if stats]
+    total = sum(stats["bytes"] for _, stats, _, _, _ in results if stats)
+    return {
+        "transfers": len(results),
+        "failed": sum(1 for _, stats, _, _, _ in results if stats is None),
+        "errors": sorted({error for _, _, error, _, _ in results if error}),
+        "bytes": total,
+        "elapsed": elapsed,
+        "throughput": total / max(elapsed, 1e-9),
+        "retransmits": sum(s["retransmits"] for _, s, _, _, _ in results if s),
+        "duration_p50": _percentile(durations, 0.5),
+        "duration_p95": _percentile(durations, 0.95),
+        "duration_max": max(durations, default=0.0),
+        "recorded_p50": _percentile(recorded, 0.5),
+        "recorded_p95": _percentile(recorded, 0.95),
+        "late_max": max((late for _, _, _, _, late in results), default=0.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Dump or replay a TFTP transfer trace",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump = commands.add_parser("dump", help="print records as json lines")
+    dump.add_argument("trace")
+    play = commands.add_parser("replay", help="re-issue the recorded workload")
+    play.add_argument("trace")
+    play.add_argument("--host", default="127.0.0.1")
+    play.add_argument("--port", type=int, default=69)
+    play.add_argument(
+        "--speed", type=float, default=1.0, help="time acceleration, 0: no waits"
+    )
+    play.add_argument("--workers", type=int, default=64, help="concurrent transfers")
+    play.add_argument("--timeout", type=float, default=1.0, help="seconds")
+    play.add_argument("--retries", type=int, default=5)
+    play.add_argument("--wrq", action="store_true", help="replay uploads too")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        for record in read_trace(args.trace):
+            print(json.dumps(record))
+        return
+    summary = replay(
+        list(read_trace(args.trace)),
+        args.host,
+        args.port,
+        args.speed,
+        args.workers,
+        args.timeout,
+        args.retries,
+        args.wrq,
+    )
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()